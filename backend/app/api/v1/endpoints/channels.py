@@ -1,76 +1,73 @@
-from fastapi import APIRouter, HTTPException, status
-from typing import Dict, List
-
-from app.core.state import active_clients, notify_client, active_channels
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from typing import List
+
+from app.core.catalog import catalog, etag_matches
+from app.core.handlers import apply_codec_profiles, forget_channel
+from app.core.opus import codec_profiles
+from app.core.replay import replay_buffer
+from app.core.state import active_clients
 from app.models.channel import Channel, ChannelCreate, ChannelUpdate
 
 router = APIRouter()
 
-# Example in-memory storage for channels (consider moving to state.py or a dedicated channel manager)
-# channels: Dict[str, Channel] = {}
-# channel_id_counter = 0
+# Channels are read from the catalog, which serves cached encoded bodies with
+# ETags; changes go through it too, so they are persisted (write-behind) and
+# pushed to clients as channel_added / channel_updated / channel_removed deltas.
 
-@router.post("/", response_model=Channel, status_code=status.HTTP_201_CREATED)
-async def create_channel(channel_in: ChannelCreate):
-    global channel_id_counter
-    channel_id_counter += 1
-    channel_id = str(channel_id_counter)
-    new_channel = Channel(**channel_in.model_dump(), id=channel_id)
-    active_channels[channel_id] = new_channel
+def conditional_response(request: Request, body: bytes, etag: str) -> Response:
+    """ 304 if the client already has this version, otherwise the cached body. """
+    headers = {"ETag": etag, "Cache-Control": "no-cache"} # Always revalidate, but reuse on 304
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-    # Notify all authorized clients about the new channel list
-    updated_channel_list = list(active_channels.values())
-    for client_id, client in active_clients.items():
-        if client.status == client.status.AUTHORIZED:
-            await notify_client(client_id, {"type": "channel_list_update", "channels": [ch.model_dump() for ch in updated_channel_list]})
+def validate_codec_profile(name):
+    if name is not None and codec_profiles.get(name) is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown codec profile '{name}'. Available: {sorted(codec_profiles.profiles)}"
+        )
 
-    return new_channel
+@router.post("/", response_model=Channel, status_code=status.HTTP_201_CREATED)
+async def create_channel(channel_in: ChannelCreate):
+    validate_codec_profile(channel_in.codec_profile)
+    new_channel = Channel(**channel_in.model_dump()) # ID is a generated UUID
+    return await catalog.add(new_channel)
 
+@router.get("", response_model=List[Channel], include_in_schema=False)
 @router.get("/", response_model=List[Channel])
-async def get_channels():
-    # Return channels from state.py
-    return list(active_channels.values())
+async def get_channels(request: Request):
+    """ The full channel list. Supports If-None-Match against the catalog's ETag. """
+    return conditional_response(request, catalog.body(), catalog.etag)
 
 @router.get("/{channel_id}", response_model=Channel)
-async def get_channel(channel_id: str):
-    channel = active_channels.get(channel_id)
-    if not channel:
+async def get_channel(channel_id: str, request: Request):
+    body = catalog.channel_body(channel_id)
+    if body is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Channel not found")
-    return channel
-
-# TODO: Add endpoints for updating and deleting channels
+    return conditional_response(request, body, catalog.channel_etag(channel_id))
 
 @router.put("/{channel_id}", response_model=Channel)
 async def update_channel(channel_id: str, channel_update: ChannelUpdate):
-    channel = active_channels.get(channel_id)
+    channel = catalog.get(channel_id)
     if not channel:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Channel not found")
 
     update_data = channel_update.model_dump(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(channel, key, value)
-    active_channels[channel_id] = channel # Update in storage (state.py)
-
-    # Notify all authorized clients about the updated channel list
-    updated_channel_list = list(active_channels.values())
-    for client_id, client in active_clients.items():
-        if client.status == client.status.AUTHORIZED:
-            await notify_client(client_id, {"type": "channel_list_update", "channels": [ch.model_dump() for ch in updated_channel_list]})
-
-    return channel
+    validate_codec_profile(update_data.get("codec_profile"))
+    updated = await catalog.update(channel.model_copy(update=update_data))
+    if updated.codec_profile != channel.codec_profile:
+        await apply_codec_profiles([c.id for c in active_clients.values() if c.current_channel_id == channel_id])
+    if updated.replay_seconds != channel.replay_seconds:
+        replay_buffer.configure(channel_id) # Reallocated at the new size; what was recorded is dropped
+    return updated
 
 @router.delete("/{channel_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_channel(channel_id: str):
-    if channel_id not in active_channels:
+    if await catalog.remove(channel_id) is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Channel not found")
-
-    del active_channels[channel_id]
-
-    # Notify all authorized clients about the updated channel list
-    updated_channel_list = list(active_channels.values())
-    for client_id, client in active_clients.items():
-        if client.status == client.status.AUTHORIZED:
-            await notify_client(client_id, {"type": "channel_list_update", "channels": [ch.model_dump() for ch in updated_channel_list]})
+    replay_buffer.configure(channel_id)
+    await forget_channel(channel_id)
 
     # TODO: Check if any clients were in this channel and move them/notify them?
     return
@@ -1,14 +1,19 @@
 from fastapi import APIRouter, HTTPException, status, Depends
 from typing import List, Dict
-import json # For sending WS messages
+import logging
 
 # Assuming main.py holds the active_clients dict for now
 # In a more robust app, this state might be managed by a dedicated service/class
-from app.core.state import active_clients, notify_client_status # Import shared state/helpers
-from app.models.client import Client, ClientStatus, ClientPublic # Client models
-from app.models.permissions import ClientPermissions # Permissions model
+from app.core.state import active_clients, notify_client_status, known_channel_ids # Import shared state/helpers
+from app.core.permissions import permission_engine
+from app.core.handlers import apply_permissions, apply_codec_profiles
+from app.core.opus import codec_profiles
+from app.core.store import store
+from app.models.client import Client, ClientStatus, ClientPublic, CodecProfileUpdate, ClientCodecProfile # Client models
+from app.models.permissions import ClientPermissions, ChannelPermissions, PermissionMatrixPatch, PermissionMatrixResult, ClientPreset # Permissions models
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 # --- Dependency to get the active clients dict ---
 def get_active_clients() -> Dict[str, Client]:
@@ -26,7 +31,7 @@ async def get_clients(
     """
     # Filter out disconnected clients if any linger temporarily and convert to public model
     public_clients = [
-        ClientPublic.model_validate(client)
+        client.public()
         for client in clients.values()
         if client.status != ClientStatus.DISCONNECTED
     ]
@@ -54,14 +59,14 @@ async def authorize_client(
         )
 
     client.status = ClientStatus.AUTHORIZED
-    print(f"Authorized client: {client.id} (Name: {client.name})") # Server log
+    logger.info(f"Authorized client: {client.id} (Name: {client.name})")
 
     # Notify the client they are now authorized
     await notify_client_status(client_id, ClientStatus.AUTHORIZED, "You have been authorized.")
 
     # TODO: Send initial state to the newly authorized client (e.g., channel list, current permissions)
 
-    return ClientPublic.model_validate(client)
+    return client.public()
 
 @router.post("/{client_id}/reject", status_code=status.HTTP_200_OK)
 async def reject_client(
@@ -85,7 +90,7 @@ async def reject_client(
         )
 
     client.status = ClientStatus.REJECTED
-    print(f"Rejected client: {client.id} (Name: {client.name})") # Server log
+    logger.info(f"Rejected client: {client.id} (Name: {client.name})")
 
     # Notify the client they were rejected and close connection
     await notify_client_status(client_id, ClientStatus.REJECTED, "Your connection request was rejected by the server admin.")
@@ -93,14 +98,68 @@ async def reject_client(
         try:
             await client.websocket.close(code=1008, reason="Connection rejected by admin")
         except Exception as e:
-            print(f"Error closing websocket for rejected client {client_id}: {e}") # Log error
+            logger.warning(f"Error closing websocket for rejected client {client_id}: {e}")
 
     # Remove from active list after attempting closure
     # Note: The websocket handler's finally block will also try to remove it, pop is safe
     clients.pop(client_id, None)
+    permission_engine.forget(client_id)
 
     return {"message": f"Client '{client_id}' rejected and disconnected."}
 
+@router.patch("/permissions", response_model=PermissionMatrixResult)
+async def patch_permission_matrix(
+    matrix: PermissionMatrixPatch,
+    clients: Dict[str, Client] = Depends(get_active_clients)
+):
+    """
+    Apply a clients x channels talk/listen diff in one request.
+
+    The whole diff is validated first (every client must be connected and
+    every channel must exist) and rejected as a unit if anything is wrong.
+    It is then applied in a single pass: each affected client is notified
+    once and each PC that changed is renegotiated once, however many cells
+    of its row were touched.
+    """
+    missing_clients = sorted(
+        cid for cid in matrix.changes
+        if cid not in clients or clients[cid].status == ClientStatus.DISCONNECTED
+    )
+    if missing_clients:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Clients not found or disconnected: {missing_clients}"
+        )
+    requested_channels = {channel_id for row in matrix.changes.values() for channel_id in row}
+    unknown_channels = requested_channels - known_channel_ids()
+    if unknown_channels:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown channel IDs in permission matrix: {sorted(unknown_channels)}"
+        )
+
+    # Build every new matrix up front so nothing is applied unless all of it is valid
+    updates: Dict[str, ClientPermissions] = {}
+    for client_id, row in matrix.changes.items():
+        cells = dict(clients[client_id].permissions.channel_permissions)
+        for channel_id, patch in row.items():
+            if patch is None:
+                cells.pop(channel_id, None)
+                continue
+            current = cells.get(channel_id) or ChannelPermissions(
+                talk=permission_engine.may_talk(client_id, channel_id),
+                listen=permission_engine.may_listen(client_id, channel_id)
+            )
+            cells[channel_id] = current.model_copy(update=patch.model_dump(exclude_none=True))
+        updates[client_id] = clients[client_id].permissions.model_copy(update={"channel_permissions": cells})
+
+    renegotiated = await apply_permissions(updates)
+    logger.info(f"Applied permission matrix for {len(updates)} clients, renegotiated {len(renegotiated)}")
+    return PermissionMatrixResult(
+        permissions={client_id: clients[client_id].permissions for client_id in updates if client_id in clients},
+        renegotiated=sorted(renegotiated)
+    )
+
 @router.get("/{client_id}/permissions", response_model=ClientPermissions)
 async def get_client_permissions(
     client_id: str,
@@ -127,8 +186,8 @@ async def set_client_permissions(
     Set or update the permission matrix for a specific client.
 
     This completely replaces the client's existing permissions with the provided ones.
-    Ensure the provided dictionary contains valid Channel IDs known to the system
-    (validation against existing channels could be added).
+    Every channel ID must be known to the system. To change many clients at
+    once, use PATCH /permissions instead.
     """
     client = clients.get(client_id)
     if not client or client.status == ClientStatus.DISCONNECTED:
@@ -137,29 +196,100 @@ async def set_client_permissions(
             detail=f"Client with ID '{client_id}' not found or is disconnected."
         )
 
-    # TODO: Validate that channel IDs in permissions_in.channel_permissions exist
-    # channel_ids_from_request = permissions_in.channel_permissions.keys()
-    # known_channel_ids = channels_db.keys() # Need access to channels_db here
-    # if not set(channel_ids_from_request).issubset(known_channel_ids):
-    #     raise HTTPException(status_code=400, detail="Invalid channel ID in permissions")
-
-    client.permissions = permissions_in
-    print(f"Updated permissions for client: {client.id} (Name: {client.name})") # Server log
-    print(f"New permissions: {client.permissions.model_dump_json(indent=2)}") # Server log
-
-    # Notify the client about the permission update
-    if client.websocket and client.status == ClientStatus.AUTHORIZED:
-        perm_update_message = {
-            "type": "permissions_update",
-            "permissions": client.permissions.model_dump() # Send the updated permissions
-        }
-        try:
-            await client.websocket.send_text(json.dumps(perm_update_message))
-            print(f"Sent permission update to client {client_id}")
-        except Exception as e:
-            print(f"Failed to send permission update to {client_id}: {e}")
+    unknown_channels = set(permissions_in.channel_permissions) - known_channel_ids()
+    if unknown_channels:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown channel IDs in permissions: {sorted(unknown_channels)}"
+        )
+
+    # Recompiles only this client's matrix, tears down routes it no longer allows and notifies everyone
+    await apply_permissions({client_id: permissions_in})
+    logger.info(f"Updated permissions for client: {client.id} (Name: {client.name})")
+    logger.debug(f"New permissions for {client.id}: {client.permissions.model_dump_json()}")
 
     return client.permissions
 
+@router.get("/{client_id}/preset", response_model=ClientPreset)
+async def get_client_preset(client_id: str):
+    """
+    Retrieve the stored permission preset for a client ID. Presets persist
+    across restarts and apply whenever that client authenticates.
+    """
+    preset = store.presets.get(client_id)
+    if preset is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No preset for client '{client_id}'.")
+    return preset
+
+@router.put("/{client_id}/preset", response_model=ClientPreset)
+async def set_client_preset(
+    client_id: str,
+    preset: ClientPreset,
+    clients: Dict[str, Client] = Depends(get_active_clients)
+):
+    """
+    Store a permission preset for a client ID, referencing a template or with
+    its own matrix. If the client is connected it is applied right away.
+    """
+    if preset.template_id is None and preset.permissions is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="A preset needs a template_id or permissions.")
+    if preset.template_id is not None and preset.template_id not in store.templates:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown template '{preset.template_id}'.")
+    if preset.permissions is not None:
+        unknown_channels = set(preset.permissions.channel_permissions) - known_channel_ids()
+        if unknown_channels:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown channel IDs in preset: {sorted(unknown_channels)}"
+            )
+
+    store.save_preset(client_id, preset)
+    client = clients.get(client_id)
+    if client and client.status == ClientStatus.AUTHORIZED:
+        await apply_permissions({client_id: store.resolve_preset(client_id)})
+    return preset
+
+@router.delete("/{client_id}/preset", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_client_preset(client_id: str):
+    """ Remove a client's preset. Permissions of a connected client are left as they are. """
+    if store.delete_preset(client_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No preset for client '{client_id}'.")
+    return
+
+def codec_profile_state(client_id: str) -> ClientCodecProfile:
+    return ClientCodecProfile(
+        client_id=client_id,
+        override=codec_profiles.client_override(client_id),
+        effective=codec_profiles.resolve(client_id).name,
+    )
+
+@router.get("/{client_id}/codec-profile", response_model=ClientCodecProfile)
+async def get_client_codec_profile(client_id: str):
+    """ The Opus profile a client uses, and whether it was set for that client explicitly. """
+    return codec_profile_state(client_id)
+
+@router.put("/{client_id}/codec-profile", response_model=ClientCodecProfile)
+async def set_client_codec_profile(client_id: str, update: CodecProfileUpdate):
+    """
+    Pin a client to an Opus profile regardless of its channel. Streams sent to
+    a connected client switch immediately; its own uplink follows after the
+    renegotiation this triggers.
+    """
+    if codec_profiles.get(update.profile) is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown codec profile '{update.profile}'. Available: {sorted(codec_profiles.profiles)}"
+        )
+    codec_profiles.set_client_override(client_id, update.profile)
+    await apply_codec_profiles([client_id])
+    return codec_profile_state(client_id)
+
+@router.delete("/{client_id}/codec-profile", response_model=ClientCodecProfile)
+async def clear_client_codec_profile(client_id: str):
+    """ Drop a client's codec profile override; it goes back to its channel's profile. """
+    codec_profiles.set_client_override(client_id, None)
+    await apply_codec_profiles([client_id])
+    return codec_profile_state(client_id)
+
 # TODO: Add endpoint for forcefully disconnecting an AUTHORIZED client
 # DELETE /{client_id}
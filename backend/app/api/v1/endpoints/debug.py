@@ -0,0 +1,160 @@
+import threading
+
+from fastapi import APIRouter, HTTPException, status, Query
+from fastapi.responses import PlainTextResponse
+
+from app.core import config
+from app.core.watchdog import loop_watchdog
+from app.core.profiler import profiler, ProfilerBusyError
+from app.core.handlers import dispatcher
+from app.core.admission import admission, media_scheduler
+from app.core.sessions import session_manager
+from app.core.heartbeat import heartbeat
+from app.core.permissions import permission_engine
+from app.core.store import store
+from app.core.catalog import catalog
+from app.core.udpmux import udp_mux
+from app.core.pcfactory import pc_factory
+from app.core.ice import candidate_buffer
+from app.core.opus import codec_profiles
+from app.core.congestion import bandwidth_controller
+from app.core.replay import replay_buffer
+from app.core.direct import direct_routes
+from app.core.logs import log_pipeline
+from app.core.adminstream import admin_stream
+from app.core.shards import media_shards
+from app.core.resources import resources
+from app.core.ratelimit import rest_read_limiter, rest_write_limiter, ws_connect_limiter
+
+router = APIRouter()
+
+@router.get("/loop")
+async def get_loop_stats():
+    """
+    Event loop lag statistics and the most recent stall reports,
+    including the captured stack of the code that blocked the loop.
+    """
+    return {
+        "stats": loop_watchdog.stats(),
+        "stalls": loop_watchdog.recent_reports(),
+    }
+
+@router.get("/handlers")
+async def get_handler_stats():
+    """ Per message type call counts, errors, rate-limit drops and handler latency. """
+    return dispatcher.stats_snapshot()
+
+@router.get("/limits")
+async def get_limit_stats():
+    """ Rate limiter and connection admission counters. """
+    return {
+        "admission": admission.stats(),
+        "media_setup": media_scheduler.stats(),
+        "ws_connect": ws_connect_limiter.stats(),
+        "ws_messages": dispatcher.limiter_snapshot(),
+        "rest": {"read": rest_read_limiter.stats(), "write": rest_write_limiter.stats()},
+    }
+
+@router.get("/sessions")
+async def get_session_stats():
+    """ Suspended (resumable) sessions and resume/expiry counters. """
+    return session_manager.stats()
+
+@router.get("/heartbeat")
+async def get_heartbeat_stats():
+    """ Heartbeat counters and signaling RTT across tracked clients. """
+    return heartbeat.stats()
+
+@router.get("/permissions")
+async def get_permission_stats():
+    """ Permission engine defaults and compile counters. """
+    return permission_engine.stats()
+
+@router.get("/store")
+async def get_store_stats():
+    """ Persistent store cache sizes, load time and write-behind flush counters. """
+    return {**store.stats(), "catalog": catalog.stats()}
+
+@router.get("/media")
+async def get_media_stats():
+    """ Shared UDP mux counters (when SOUNDMESH_MEDIA_UDP_MUX is enabled), PC pool, time-to-answer and trickle ICE. """
+    return {"udp_mux": udp_mux.stats(), "peer_connections": pc_factory.stats(), "ice_candidates": candidate_buffer.stats()}
+
+@router.get("/codecs")
+async def get_codec_stats():
+    """
+    Opus profiles with their expected wire bandwidth and algorithmic latency
+    per stream, how many clients use each, encoders created and SDP munging cost.
+    """
+    return codec_profiles.stats()
+
+@router.get("/bandwidth")
+async def get_bandwidth_stats():
+    """ Per-listener bandwidth estimates, loss, RTT, muted talkers and recent congestion control decisions. """
+    return bandwidth_controller.stats()
+
+@router.get("/replay")
+async def get_replay_stats():
+    """
+    Instant replay rings per channel: memory allocated and in use, frames
+    kept, append cost, plus replays served and the cost of snapshotting them.
+    """
+    return replay_buffer.stats()
+
+@router.get("/logging")
+async def get_logging_stats():
+    """ Log pipeline health: emit cost on the event loop, queue depth, drops and what sampling skipped. """
+    return log_pipeline.stats()
+
+@router.get("/direct")
+async def get_direct_route_stats():
+    """ Active direct (IFB) routes, how their legs were set up (parked sender, shared, renegotiated) and setup latency. """
+    return direct_routes.stats()
+
+@router.get("/admin-stream")
+async def get_admin_stream_stats():
+    """ Admin state stream: tick cost, connected dashboards and their backlog, events and bytes sent. """
+    return admin_stream.stats()
+
+@router.get("/shards")
+async def get_shard_stats():
+    """ Media shards: clients placed on each, its loop lag and CPU use, and frames bridged between shards. """
+    return media_shards.stats()
+
+@router.get("/resources")
+async def get_resource_stats(
+    memory: bool = Query(False, description="Estimate memory per client by walking its objects (slow with many clients)"),
+    collect: bool = Query(False, description="Run the garbage collector first, so retired_alive only counts real leaks"),
+):
+    """
+    Live media objects (PCs by state, transceivers, senders, event handlers,
+    owned tracks, relay subscriptions) and how many torn-down PCs and tracks
+    are still referenced. Over a long show these should track the number of
+    connected clients, not the number that ever connected.
+    """
+    return resources.stats(memory=memory, collect=collect)
+
+@router.get("/profile", response_class=PlainTextResponse)
+async def get_profile(
+    seconds: float = Query(5.0, gt=0, description="How long to sample for"),
+    interval_ms: float = Query(config.PROFILER_DEFAULT_INTERVAL * 1000, gt=0, description="Milliseconds between samples"),
+    all_threads: bool = Query(False, description="Sample every thread instead of only the event loop thread"),
+):
+    """
+    Runs a sampling profiler against the live server for `seconds` and returns
+    folded stacks ("frame;frame;frame count" per line), which can be fed
+    directly into flamegraph.pl or loaded in speedscope.
+    """
+    if seconds > config.PROFILER_MAX_SECONDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Profile duration is limited to {config.PROFILER_MAX_SECONDS} seconds."
+        )
+    thread_id = None if all_threads else loop_watchdog.loop_thread_id
+    if thread_id is None and not all_threads:
+        # Watchdog not running; fall back to the current (event loop) thread
+        thread_id = threading.get_ident()
+    try:
+        return await profiler.profile(seconds, interval_ms / 1000, thread_id)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
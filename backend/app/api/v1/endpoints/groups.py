@@ -0,0 +1,56 @@
+from fastapi import APIRouter, HTTPException, status
+from typing import List
+
+from app.core.state import known_channel_ids
+from app.core.store import store
+from app.models.channel import ChannelGroup, ChannelGroupCreate, ChannelGroupUpdate
+
+router = APIRouter()
+
+# Channel groups are named sets of channels a talker can all-call at once
+# (all_call_start over the WebSocket). Editing a group does not move an
+# all-call already in progress; it applies from the next one.
+
+def validate_channels(channel_ids: List[str]) -> List[str]:
+    unknown_channels = set(channel_ids) - known_channel_ids()
+    if unknown_channels:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown channel IDs in group: {sorted(unknown_channels)}"
+        )
+    return list(dict.fromkeys(channel_ids)) # Drop duplicates, keep order
+
+@router.get("/", response_model=List[ChannelGroup])
+async def get_groups():
+    return list(store.groups.values())
+
+@router.post("/", response_model=ChannelGroup, status_code=status.HTTP_201_CREATED)
+async def create_group(group_in: ChannelGroupCreate):
+    group = ChannelGroup(**{**group_in.model_dump(), "channel_ids": validate_channels(group_in.channel_ids)})
+    store.save_group(group)
+    return group
+
+@router.get("/{group_id}", response_model=ChannelGroup)
+async def get_group(group_id: str):
+    group = store.groups.get(group_id)
+    if not group:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Channel group not found")
+    return group
+
+@router.put("/{group_id}", response_model=ChannelGroup)
+async def update_group(group_id: str, group_update: ChannelGroupUpdate):
+    group = store.groups.get(group_id)
+    if not group:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Channel group not found")
+    update_data = group_update.model_dump(exclude_unset=True)
+    if "channel_ids" in update_data:
+        update_data["channel_ids"] = validate_channels(update_data["channel_ids"])
+    updated = group.model_copy(update=update_data)
+    store.save_group(updated)
+    return updated
+
+@router.delete("/{group_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_group(group_id: str):
+    if store.delete_group(group_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Channel group not found")
+    return
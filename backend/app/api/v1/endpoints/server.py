@@ -0,0 +1,42 @@
+from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import StreamingResponse
+from typing import Dict
+
+from app.core.adminstream import admin_stream
+from app.core.drain import drain
+from app.models.server import DrainRequest
+
+router = APIRouter()
+
+# Drain is also started by SOUNDMESH_DRAIN_SIGNAL (SIGUSR1 by default), e.g.
+# from a deploy script before the new build takes over the address.
+
+@router.get("/drain")
+async def get_drain_status() -> Dict[str, object]:
+    return drain.stats()
+
+@router.post("/drain", status_code=status.HTTP_202_ACCEPTED)
+async def start_drain(request: DrainRequest) -> Dict[str, object]:
+    """ Stops admitting clients and moves connected ones away in paced batches; the process exits once empty. """
+    if not drain.start(request.target_url, request.batch_size, request.batch_interval, request.deadline):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Already draining")
+    return drain.stats()
+
+@router.delete("/drain")
+async def cancel_drain() -> Dict[str, object]:
+    if not await drain.cancel():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Not draining")
+    return drain.stats()
+
+@router.get("/stream")
+async def stream_state():
+    """
+    Server-Sent Events for admin dashboards: a `snapshot` event with every
+    client and channel, then `diff` events with what changed since, sent at
+    most once per SOUNDMESH_ADMIN_STREAM_TICK.
+    """
+    return StreamingResponse(
+        admin_stream.events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
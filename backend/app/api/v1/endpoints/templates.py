@@ -0,0 +1,52 @@
+from fastapi import APIRouter, HTTPException, status
+from typing import List
+import uuid
+
+from app.core.state import known_channel_ids
+from app.core.store import store
+from app.models.permissions import PermissionTemplate, PermissionTemplateBase
+
+router = APIRouter()
+
+def validate_channels(template_in: PermissionTemplateBase):
+    unknown_channels = set(template_in.permissions.channel_permissions) - known_channel_ids()
+    if unknown_channels:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown channel IDs in template: {sorted(unknown_channels)}"
+        )
+
+@router.get("/", response_model=List[PermissionTemplate])
+async def get_templates():
+    return list(store.templates.values())
+
+@router.post("/", response_model=PermissionTemplate, status_code=status.HTTP_201_CREATED)
+async def create_template(template_in: PermissionTemplateBase):
+    validate_channels(template_in)
+    template = PermissionTemplate(id=str(uuid.uuid4()), **template_in.model_dump())
+    store.save_template(template)
+    return template
+
+@router.get("/{template_id}", response_model=PermissionTemplate)
+async def get_template(template_id: str):
+    template = store.templates.get(template_id)
+    if not template:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template not found")
+    return template
+
+@router.put("/{template_id}", response_model=PermissionTemplate)
+async def put_template(template_id: str, template_in: PermissionTemplateBase):
+    """
+    Create or replace a template. Clients whose preset references it pick up
+    the change the next time they authenticate.
+    """
+    validate_channels(template_in)
+    template = PermissionTemplate(id=template_id, **template_in.model_dump())
+    store.save_template(template)
+    return template
+
+@router.delete("/{template_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_template(template_id: str):
+    if store.delete_template(template_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template not found")
+    return
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from . import config
+from ..models.client import Client
+from .catalog import catalog
+from .replay import replay_buffer, SILENCE_LEVEL
+from .state import active_clients, active_channels
+
+logger = logging.getLogger(__name__)
+
+TALKING_WINDOW = 0.5 # Seconds after a talker's last non-silent frame it still counts as talking
+LEVEL_STEP = 6 # dB; levels are reported in steps so small fluctuations don't produce diffs
+
+
+class _Subscriber:
+    def __init__(self, queue_size: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.connected = time.monotonic()
+
+
+class AdminStream:
+    """
+    Live server state for admin dashboards, as a Server-Sent Events stream.
+
+    A dashboard first gets one snapshot of every client and channel, then
+    diffs. State is not pushed as it changes: every `tick` seconds each
+    client's compact view (name, status, channels, listen set, PC state,
+    talking and level, permissions) is rebuilt and compared with the one
+    published last, and whatever changed goes out as a single diff event
+    listing joined, left and changed clients, with only the changed fields.
+    A burst of joins or a talker's level moving every frame therefore costs
+    at most one event per tick. Each event is encoded once and the same
+    bytes are queued for every dashboard; one that falls `queue_size`
+    events behind is disconnected and gets a fresh snapshot when it
+    reconnects. The tick only runs while someone is watching.
+    """
+
+    def __init__(self, tick: float, queue_size: int, keepalive: float):
+        self.tick = tick
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self._subscribers: Set[_Subscriber] = set()
+        self._views: Dict[str, Dict[str, object]] = {} # client_id -> view last published
+        self._catalog_version: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self.seq = 0
+        self.ticks = 0
+        self.tick_time = 0.0
+        self.last_tick_ms = 0.0
+        self.snapshots = 0
+        self.diffs = 0
+        self.bytes_queued = 0
+        self.dropped_subscribers = 0
+
+    @staticmethod
+    def view(client: Client, now: float) -> Dict[str, object]:
+        """ The compact per-client state dashboards see. Keys are short since most events carry many of them. """
+        level = replay_buffer.levels.get(client.id) if client.audio_track is not None else None
+        talking = level is not None and level[0] < SILENCE_LEVEL and now - level[1] <= TALKING_WINDOW
+        return {
+            "n": client.name,
+            "s": client.status.value,
+            "ch": client.current_channel_id,
+            "ac": sorted(client.all_call_channels),
+            "l": sorted(client.listening_channels),
+            "pc": client.pc.connectionState if client.pc is not None else None,
+            "t": talking,
+            "lv": -(level[0] // LEVEL_STEP) * LEVEL_STEP if talking else None, # dBov
+            "p": client.public()["permissions"],
+        }
+
+    @staticmethod
+    def _channels() -> List[Dict[str, object]]:
+        return [channel.model_dump() for channel in active_channels.values()]
+
+    @staticmethod
+    def _encode(event: str, payload: Dict[str, object]) -> bytes:
+        return f"id: {payload['seq']}\nevent: {event}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n".encode()
+
+    def _collect(self) -> Dict[str, Dict[str, object]]:
+        now = time.monotonic()
+        return {client.id: self.view(client, now) for client in list(active_clients.values())}
+
+    def _publish(self, chunk: bytes):
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.queue.put_nowait(chunk)
+                self.bytes_queued += len(chunk)
+            except asyncio.QueueFull:
+                # Too far behind to catch up with diffs; it starts over with a snapshot when it reconnects
+                self._subscribers.discard(subscriber)
+                self.dropped_subscribers += 1
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+                logger.warning(f"Admin stream subscriber dropped after falling {self.queue_size} events behind")
+
+    def step(self):
+        """ One tick: diffs the current state against the last published views and sends the changes. """
+        started = time.perf_counter()
+        views = self._collect()
+        previous = self._views
+        joined = {client_id: view for client_id, view in views.items() if client_id not in previous}
+        left = [client_id for client_id in previous if client_id not in views]
+        changed: Dict[str, Dict[str, object]] = {}
+        for client_id, view in views.items():
+            old = previous.get(client_id)
+            if old is None:
+                continue
+            fields = {key: value for key, value in view.items() if old[key] != value}
+            if fields:
+                changed[client_id] = fields
+        self._views = views
+        diff: Dict[str, object] = {}
+        if joined:
+            diff["joined"] = joined
+        if left:
+            diff["left"] = left
+        if changed:
+            diff["changed"] = changed
+        if catalog.version != self._catalog_version:
+            self._catalog_version = catalog.version
+            diff["channels"] = self._channels()
+        if diff:
+            self.seq += 1
+            self.diffs += 1
+            self._publish(self._encode("diff", {"seq": self.seq, **diff}))
+        self.ticks += 1
+        self.last_tick_ms = (time.perf_counter() - started) * 1000
+        self.tick_time += self.last_tick_ms
+
+    async def _run(self):
+        while self._subscribers:
+            await asyncio.sleep(self.tick)
+            try:
+                self.step()
+            except Exception as e:
+                logger.error(f"Admin stream tick failed: {e}", exc_info=True)
+        self._task = None
+
+    async def stop(self):
+        for subscriber in list(self._subscribers):
+            subscriber.queue.put_nowait(None)
+        self._subscribers.clear()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _subscribe(self) -> _Subscriber:
+        if not self._subscribers:
+            # Nobody was watching, so the last published views are stale; start from the present
+            self._views = self._collect()
+            self._catalog_version = catalog.version
+        subscriber = _Subscriber(self.queue_size)
+        self._subscribers.add(subscriber)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return subscriber
+
+    async def events(self) -> AsyncIterator[bytes]:
+        """ The SSE body for one dashboard: a snapshot, then diffs as they are published, with keepalives while idle. """
+        subscriber = self._subscribe()
+        try:
+            self.snapshots += 1
+            yield self._encode("snapshot", {"seq": self.seq, "clients": self._views, "channels": self._channels()})
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(subscriber.queue.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            self._subscribers.discard(subscriber)
+
+    def stats(self) -> Dict[str, object]:
+        now = time.monotonic()
+        return {
+            "running": self._task is not None,
+            "tick": self.tick,
+            "seq": self.seq,
+            "ticks": self.ticks,
+            "tick_avg_ms": round(self.tick_time / self.ticks, 3) if self.ticks else None,
+            "last_tick_ms": round(self.last_tick_ms, 3),
+            "clients_tracked": len(self._views),
+            "subscribers": [
+                {"backlog": subscriber.queue.qsize(), "connected_s": round(now - subscriber.connected, 1)}
+                for subscriber in self._subscribers
+            ],
+            "snapshots": self.snapshots,
+            "diffs": self.diffs,
+            "bytes_queued": self.bytes_queued,
+            "dropped_subscribers": self.dropped_subscribers,
+        }
+
+
+admin_stream = AdminStream(
+    tick=config.ADMIN_STREAM_TICK,
+    queue_size=config.ADMIN_STREAM_QUEUE,
+    keepalive=config.ADMIN_STREAM_KEEPALIVE,
+)
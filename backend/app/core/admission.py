@@ -0,0 +1,228 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# Called with (position, queue_length) while a caller waits; position is 1-based
+PositionCallback = Callable[[int, int], Awaitable[None]]
+
+
+class AdmissionRejected(Exception):
+    """ Raised when a connection can't be admitted (queue full or wait timed out). """
+
+
+async def _notify_position(notify: PositionCallback, position: int, total: int):
+    """ A failed position update (e.g. the socket already closed) must not cost the caller its place or a slot. """
+    try:
+        await notify(position, total)
+    except Exception as e:
+        logger.debug(f"Failed to send queue position: {e}")
+
+
+class _PositionBroadcaster:
+    """
+    Tells queued callers their position. Updates are coalesced: however many
+    slots are released, waiters are notified at most once per `interval`.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending: Optional[asyncio.Task] = None
+
+    def schedule(self, snapshot: Callable[[], List[Tuple[PositionCallback, int, int]]]):
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.get_running_loop().create_task(self._broadcast(snapshot))
+
+    async def _broadcast(self, snapshot):
+        await asyncio.sleep(self.interval)
+        for notify, position, total in snapshot():
+            await _notify_position(notify, position, total)
+
+
+class AdmissionController:
+    """
+    Global cap on concurrently served WebSocket connections.
+
+    Up to `max_active` connections are admitted immediately. Beyond that,
+    up to `max_queued` wait in FIFO order for a slot to free up; anything
+    past the queue, or waiting longer than `queue_timeout`, is rejected.
+    """
+
+    def __init__(self, max_active: int, max_queued: int, queue_timeout: float, position_interval: float = 1.0):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self._waiters: Deque[Tuple[asyncio.Future, Optional[PositionCallback]]] = deque()
+        self._positions = _PositionBroadcaster(position_interval)
+        self.admitted_total = 0
+        self.rejected_total = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _position_snapshot(self):
+        total = len(self._waiters)
+        return [(notify, i + 1, total) for i, (_, notify) in enumerate(self._waiters) if notify]
+
+    async def acquire(self, on_position: Optional[PositionCallback] = None):
+        if self.active < self.max_active and not self._waiters:
+            self.active += 1
+            self.admitted_total += 1
+            return
+
+        if len(self._waiters) >= self.max_queued:
+            self.rejected_total += 1
+            raise AdmissionRejected("Server is at capacity")
+
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (waiter, on_position)
+        self._waiters.append(entry)
+        try:
+            # Inside the try, so a caller cancelled while being told its position still leaves the queue
+            if on_position:
+                await _notify_position(on_position, len(self._waiters), len(self._waiters))
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # A slot was handed to us just as we gave up; pass it on
+                self.release()
+            else:
+                waiter.cancel()
+                try:
+                    self._waiters.remove(entry)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rejected_total += 1
+            raise AdmissionRejected("Timed out waiting for a free connection slot")
+        self.admitted_total += 1
+
+    def release(self):
+        # Hand the slot directly to the next live waiter so `active` stays accurate
+        while self._waiters:
+            waiter, _ = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                if self._waiters:
+                    self._positions.schedule(self._position_snapshot)
+                return
+        self.active = max(0, self.active - 1)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_active": self.max_active,
+            "max_queued": self.max_queued,
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+# Priorities for paced media work (lower runs first)
+PRIORITY_SIGNALING = 0     # Completes a negotiation already in flight
+PRIORITY_RENEGOTIATION = 1 # Server-initiated offer on an existing PC
+PRIORITY_NEW_PC = 2        # PeerConnection creation + first SDP exchange
+
+
+class PacedScheduler:
+    """
+    Limits how much expensive media setup (PC creation, SDP offer/answer) runs
+    at once. After a reconnect storm every client wants a new PC at the same
+    moment; running them all concurrently starves the event loop and the RTP
+    of everyone already connected. Work beyond `concurrency` waits in a
+    priority queue (then FIFO), so cheap work that finishes negotiations runs
+    before brand-new PCs, and queued clients are told their position.
+    """
+
+    def __init__(self, concurrency: int, position_interval: float = 1.0):
+        self.concurrency = concurrency
+        self.running = 0
+        self._heap: List[Tuple[int, int, asyncio.Future, Optional[PositionCallback]]] = []
+        self._seq = itertools.count()
+        self._positions = _PositionBroadcaster(position_interval)
+        self.completed_total = 0
+        self.max_queued = 0
+        self.total_wait = 0.0
+
+    @property
+    def queued(self) -> int:
+        return len(self._heap)
+
+    def _position_snapshot(self):
+        ordered = sorted(self._heap)
+        total = len(ordered)
+        return [(notify, i + 1, total) for i, (_, _, _, notify) in enumerate(ordered) if notify]
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_NEW_PC, on_position: Optional[PositionCallback] = None):
+        loop = asyncio.get_running_loop()
+        queued_at = loop.time()
+        if self.running < self.concurrency and not self._heap:
+            self.running += 1
+        else:
+            waiter = loop.create_future()
+            entry = (priority, next(self._seq), waiter, on_position)
+            heapq.heappush(self._heap, entry)
+            self.max_queued = max(self.max_queued, len(self._heap))
+            try:
+                if on_position:
+                    position = sum(1 for e in self._heap if e[:2] <= entry[:2])
+                    await _notify_position(on_position, position, len(self._heap))
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release()
+                else:
+                    self._heap.remove(entry)
+                    heapq.heapify(self._heap)
+                raise
+        self.total_wait += loop.time() - queued_at
+        try:
+            yield
+        finally:
+            self.completed_total += 1
+            self._release()
+
+    def _release(self):
+        while self._heap:
+            _, _, waiter, _ = heapq.heappop(self._heap)
+            if not waiter.done():
+                waiter.set_result(None)
+                if self._heap:
+                    self._positions.schedule(self._position_snapshot)
+                return
+        self.running = max(0, self.running - 1)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "concurrency": self.concurrency,
+            "running": self.running,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "completed_total": self.completed_total,
+            "avg_wait_ms": round(self.total_wait / self.completed_total * 1000, 1) if self.completed_total else 0.0,
+        }
+
+
+admission = AdmissionController(
+    max_active=config.MAX_ACTIVE_CONNECTIONS,
+    max_queued=config.MAX_QUEUED_CONNECTIONS,
+    queue_timeout=config.ADMISSION_QUEUE_TIMEOUT,
+    position_interval=config.QUEUE_POSITION_INTERVAL,
+)
+
+media_scheduler = PacedScheduler(
+    concurrency=config.MEDIA_SETUP_CONCURRENCY,
+    position_interval=config.QUEUE_POSITION_INTERVAL,
+)
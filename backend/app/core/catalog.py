@@ -0,0 +1,118 @@
+import json
+import logging
+import secrets
+from typing import Dict, List, Optional
+
+from ..models.channel import Channel
+from .state import active_channels, notify_authorized
+from .store import store
+
+logger = logging.getLogger(__name__)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """ True if an If-None-Match header value matches `etag` (weak comparison, as RFC 9110 requires for it). """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+class ChannelCatalog:
+    """
+    Versioned view of the channel list.
+
+    Every change bumps the catalog version and is pushed to clients as a
+    single channel_added / channel_updated / channel_removed delta, encoded
+    once for all recipients. The REST list and per-channel bodies are
+    encoded lazily and cached until the next change, and ETags derived from
+    the version let clients revalidate with If-None-Match instead of
+    downloading the list again.
+    """
+
+    def __init__(self):
+        self._epoch = secrets.token_hex(4) # ETags from a previous process must never match
+        self.version = 0
+        self._body: Optional[bytes] = None
+        self._revisions: Dict[str, int] = {} # channel_id -> catalog version it last changed at
+        self._channel_bodies: Dict[str, bytes] = {}
+        self.bodies_encoded = 0
+
+    @property
+    def etag(self) -> str:
+        return f'"{self._epoch}-{self.version}"'
+
+    def channel_etag(self, channel_id: str) -> str:
+        return f'"{self._epoch}-{channel_id}-{self._revisions.get(channel_id, 0)}"'
+
+    def channels(self) -> List[Channel]:
+        return list(active_channels.values())
+
+    def get(self, channel_id: str) -> Optional[Channel]:
+        return active_channels.get(channel_id)
+
+    def body(self) -> bytes:
+        """ The encoded channel list, cached until the next change. """
+        if self._body is None:
+            self._body = json.dumps([ch.model_dump() for ch in active_channels.values()]).encode()
+            self.bodies_encoded += 1
+        return self._body
+
+    def channel_body(self, channel_id: str) -> Optional[bytes]:
+        channel = active_channels.get(channel_id)
+        if channel is None:
+            return None
+        body = self._channel_bodies.get(channel_id)
+        if body is None:
+            body = self._channel_bodies[channel_id] = channel.model_dump_json().encode()
+            self.bodies_encoded += 1
+        return body
+
+    def _changed(self, channel_id: str):
+        self.version += 1
+        self._body = None
+        self._revisions[channel_id] = self.version
+        self._channel_bodies.pop(channel_id, None)
+
+    async def _publish(self, message_type: str, payload: dict):
+        message = {"type": message_type, "version": self.version, **payload}
+        await notify_authorized(json.dumps(message))
+
+    async def add(self, channel: Channel) -> Channel:
+        store.save_channel(channel)
+        self._changed(channel.id)
+        await self._publish("channel_added", {"channel": channel.model_dump()})
+        return channel
+
+    async def update(self, channel: Channel) -> Channel:
+        store.save_channel(channel)
+        self._changed(channel.id)
+        await self._publish("channel_updated", {"channel": channel.model_dump()})
+        return channel
+
+    async def remove(self, channel_id: str) -> Optional[Channel]:
+        channel = store.delete_channel(channel_id)
+        if channel is None:
+            return None
+        self._changed(channel_id)
+        await self._publish("channel_removed", {"channel_id": channel_id})
+        return channel
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "version": self.version,
+            "etag": self.etag,
+            "channels": len(active_channels),
+            "bodies_encoded": self.bodies_encoded,
+        }
+
+
+catalog = ChannelCatalog()
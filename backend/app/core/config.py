@@ -0,0 +1,170 @@
+"""
+Runtime configuration for the SoundMesh backend.
+
+Every setting is read once from an environment variable (prefixed with
+``SOUNDMESH_``) at import time, falling back to the default shown here.
+"""
+import os
+from typing import Dict, List, Tuple
+
+
+def _env_str(name: str, default: str) -> str:
+    return os.environ.get(name, default)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_list(name: str, default: str = "") -> List[str]:
+    """ Parses a comma separated list, ignoring blanks. """
+    return [item.strip() for item in os.environ.get(name, default).split(",") if item.strip()]
+
+
+def _env_rate_map(name: str) -> Dict[str, Tuple[float, float]]:
+    """ Parses "key=rate:burst,key2=rate:burst" into {key: (rate, burst)}. """
+    limits: Dict[str, Tuple[float, float]] = {}
+    for item in os.environ.get(name, "").split(","):
+        if not item.strip():
+            continue
+        key, _, spec = item.partition("=")
+        rate, _, burst = spec.partition(":")
+        limits[key.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+# --- Logging ---
+LOG_LEVEL = _env_str("SOUNDMESH_LOG_LEVEL", "INFO")
+LOG_FORMAT = _env_str("SOUNDMESH_LOG_FORMAT", "json") # "json" (one object per line) or "text"
+LOG_QUEUE_SIZE = _env_int("SOUNDMESH_LOG_QUEUE_SIZE", 10000) # Records waiting for the writer thread before new ones are dropped
+LOG_MAX_MESSAGE = _env_int("SOUNDMESH_LOG_MAX_MESSAGE", 2000) # Characters kept per message after redaction
+# Per subsystem (a record's `subsystem` extra, else its logger name) sampling of records below WARNING, as rate:burst
+LOG_SAMPLE_RATES = _env_rate_map("SOUNDMESH_LOG_SAMPLE_RATES") or {"ice": (20.0, 50.0), "presence": (10.0, 30.0)}
+
+# --- Event loop watchdog ---
+LOOP_WATCHDOG_ENABLED = _env_bool("SOUNDMESH_LOOP_WATCHDOG", True)
+LOOP_WATCHDOG_INTERVAL = _env_float("SOUNDMESH_LOOP_WATCHDOG_INTERVAL", 0.05) # Seconds between lag probes
+LOOP_LAG_THRESHOLD = _env_float("SOUNDMESH_LOOP_LAG_THRESHOLD", 0.1) # Seconds of lag before a stack is captured
+LOOP_STALL_REPORTS = _env_int("SOUNDMESH_LOOP_STALL_REPORTS", 20) # Number of recent stall reports kept in memory
+
+# --- Sampling profiler ---
+PROFILER_MAX_SECONDS = _env_float("SOUNDMESH_PROFILER_MAX_SECONDS", 60.0)
+PROFILER_DEFAULT_INTERVAL = _env_float("SOUNDMESH_PROFILER_INTERVAL", 0.005) # Seconds between stack samples
+
+# --- WebSocket message dispatch ---
+# Run handlers for independent message types concurrently (SDP/ICE stay ordered in their own lane)
+WS_CONCURRENT_HANDLERS = _env_bool("SOUNDMESH_WS_CONCURRENT_HANDLERS", True)
+
+# --- Rate limiting and flood protection ---
+RATE_LIMIT_MAX_KEYS = _env_int("SOUNDMESH_RATE_LIMIT_MAX_KEYS", 10000) # Buckets kept per limiter before LRU eviction
+# Per message type overrides of the handler defaults, e.g. "join_channel=0.5:3,candidate=20:50"
+WS_RATE_LIMITS = _env_rate_map("SOUNDMESH_WS_RATE_LIMITS")
+# Per-IP buckets allow this many times the per-client rate (several clients may share a NAT)
+WS_IP_RATE_MULTIPLIER = _env_float("SOUNDMESH_WS_IP_RATE_MULTIPLIER", 4.0)
+WS_MESSAGE_RATE = _env_float("SOUNDMESH_WS_MESSAGE_RATE", 50.0) # Any message type, per client
+WS_MESSAGE_BURST = _env_float("SOUNDMESH_WS_MESSAGE_BURST", 100.0)
+# Rate-limit violations tolerated (refilling at 1/s) before the socket is closed
+WS_MAX_RATE_VIOLATIONS = _env_float("SOUNDMESH_WS_MAX_RATE_VIOLATIONS", 20.0)
+WS_CONNECT_RATE = _env_float("SOUNDMESH_WS_CONNECT_RATE", 1.0) # New connections per IP per second
+WS_CONNECT_BURST = _env_float("SOUNDMESH_WS_CONNECT_BURST", 10.0)
+REST_READ_RATE = _env_float("SOUNDMESH_REST_READ_RATE", 10.0) # Per route and IP
+REST_READ_BURST = _env_float("SOUNDMESH_REST_READ_BURST", 30.0)
+REST_WRITE_RATE = _env_float("SOUNDMESH_REST_WRITE_RATE", 2.0)
+REST_WRITE_BURST = _env_float("SOUNDMESH_REST_WRITE_BURST", 10.0)
+
+# --- Connection admission ---
+MAX_ACTIVE_CONNECTIONS = _env_int("SOUNDMESH_MAX_ACTIVE_CONNECTIONS", 500)
+MAX_QUEUED_CONNECTIONS = _env_int("SOUNDMESH_MAX_QUEUED_CONNECTIONS", 100)
+ADMISSION_QUEUE_TIMEOUT = _env_float("SOUNDMESH_ADMISSION_QUEUE_TIMEOUT", 30.0) # Seconds a connection may wait for a slot
+MEDIA_SETUP_CONCURRENCY = _env_int("SOUNDMESH_MEDIA_SETUP_CONCURRENCY", 4) # PC creations / SDP exchanges run at once
+QUEUE_POSITION_INTERVAL = _env_float("SOUNDMESH_QUEUE_POSITION_INTERVAL", 1.0) # Min seconds between queue position updates
+
+# --- Session resumption ---
+# Seconds a dropped client's PC and subscriptions are kept for a resume (0 disables)
+SESSION_RESUME_GRACE = _env_float("SOUNDMESH_SESSION_RESUME_GRACE", 30.0)
+
+# --- Graceful drain ---
+DRAIN_SIGNAL = _env_str("SOUNDMESH_DRAIN_SIGNAL", "SIGUSR1") # Starts a drain; empty to disable
+DRAIN_TARGET_URL = _env_str("SOUNDMESH_DRAIN_TARGET_URL", "") # Server clients are sent to; empty means reconnect to the same address
+DRAIN_BATCH_SIZE = _env_int("SOUNDMESH_DRAIN_BATCH_SIZE", 10) # Clients told to migrate per batch
+DRAIN_BATCH_INTERVAL = _env_float("SOUNDMESH_DRAIN_BATCH_INTERVAL", 2.0) # Seconds between batches, and the spread of each batch's reconnects
+DRAIN_DEADLINE = _env_float("SOUNDMESH_DRAIN_DEADLINE", 120.0) # Seconds after which remaining clients are disconnected
+DRAIN_EXIT = _env_bool("SOUNDMESH_DRAIN_EXIT", True) # Shut the process down once drained
+
+# --- Heartbeat ---
+HEARTBEAT_INTERVAL = _env_float("SOUNDMESH_HEARTBEAT_INTERVAL", 10.0) # Seconds between pings to each client
+HEARTBEAT_TIMEOUT = _env_float("SOUNDMESH_HEARTBEAT_TIMEOUT", 30.0) # Seconds of silence before a socket is considered dead
+HEARTBEAT_TICK = _env_float("SOUNDMESH_HEARTBEAT_TICK", 0.5) # Timing wheel resolution
+HEARTBEAT_WHEEL_SLOTS = _env_int("SOUNDMESH_HEARTBEAT_WHEEL_SLOTS", 512)
+HEARTBEAT_EVICT_BATCH = _env_int("SOUNDMESH_HEARTBEAT_EVICT_BATCH", 50) # Max evictions processed per tick
+HEARTBEAT_SEND_TIMEOUT = _env_float("SOUNDMESH_HEARTBEAT_SEND_TIMEOUT", 5.0) # Seconds a ping may wait on a full socket buffer
+
+# --- Permissions ---
+# Applied to channels missing from a client's permission matrix
+PERMISSIONS_DEFAULT_TALK = _env_bool("SOUNDMESH_PERMISSIONS_DEFAULT_TALK", True)
+PERMISSIONS_DEFAULT_LISTEN = _env_bool("SOUNDMESH_PERMISSIONS_DEFAULT_LISTEN", True)
+
+# --- Persistent store ---
+DB_PATH = _env_str("SOUNDMESH_DB_PATH", "soundmesh.db") # SQLite file for channels, templates and presets
+STORE_FLUSH_INTERVAL = _env_float("SOUNDMESH_STORE_FLUSH_INTERVAL", 0.25) # Seconds writes are batched before hitting disk
+
+# --- Media transport ---
+# Share one UDP socket between all PeerConnections instead of binding sockets per PC
+MEDIA_UDP_MUX = _env_bool("SOUNDMESH_MEDIA_UDP_MUX", False)
+MEDIA_UDP_MUX_BIND = _env_str("SOUNDMESH_MEDIA_UDP_MUX_BIND", "0.0.0.0")
+MEDIA_UDP_MUX_PORT = _env_int("SOUNDMESH_MEDIA_UDP_MUX_PORT", 40000)
+# Host candidate addresses handed to clients (e.g. the venue LAN IP); defaults to the local interfaces
+MEDIA_ADVERTISED_HOSTS = _env_list("SOUNDMESH_MEDIA_ADVERTISED_HOSTS")
+# Declare a=ice-lite in answers so browsers take the controlling role and nominate straight away
+MEDIA_ICE_LITE = _env_bool("SOUNDMESH_MEDIA_ICE_LITE", False)
+# Media event loops (threads) PeerConnections are spread over; 0 runs all media on the main loop.
+# Ignored while the UDP mux is on, since the mux delivers every PC's packets on the main loop.
+MEDIA_SHARDS = _env_int("SOUNDMESH_MEDIA_SHARDS", 0)
+
+# --- PeerConnection factory ---
+# STUN/TURN URLs handed to every PeerConnection, comma separated. None by default: venue networks are often
+# isolated, and an unreachable STUN server holds up every PC's (and every pooled PC's) gathering until it times out.
+# Sites whose clients reach the server through NAT set e.g. "stun:stun.example.org:3478", or a TURN URL plus credentials.
+ICE_SERVERS = _env_list("SOUNDMESH_ICE_SERVERS")
+ICE_USERNAME = _env_str("SOUNDMESH_ICE_USERNAME", "") # TURN credentials, if any
+ICE_CREDENTIAL = _env_str("SOUNDMESH_ICE_CREDENTIAL", "")
+PC_POOL_SIZE = _env_int("SOUNDMESH_PC_POOL_SIZE", 2) # PeerConnections kept pre-warmed with gathering done
+PC_POOL_MAX_AGE = _env_float("SOUNDMESH_PC_POOL_MAX_AGE", 30.0) # Seconds a warm PC is kept before it's replaced
+DTLS_CERT_ROTATION = _env_float("SOUNDMESH_DTLS_CERT_ROTATION", 86400.0) # Seconds the shared DTLS certificate is used for
+
+# --- Opus codec profiles (talent, crew, listen_only, program) ---
+CODEC_DEFAULT_PROFILE = _env_str("SOUNDMESH_CODEC_DEFAULT_PROFILE", "crew") # For channels without their own profile
+CODEC_LISTEN_ONLY_PROFILE = _env_str("SOUNDMESH_CODEC_LISTEN_ONLY_PROFILE", "listen_only") # Clients not talking in any channel
+
+# --- Per-listener congestion control ---
+CONGESTION_CONTROL = _env_bool("SOUNDMESH_CONGESTION_CONTROL", True)
+CONGESTION_INTERVAL = _env_float("SOUNDMESH_CONGESTION_INTERVAL", 1.0) # Seconds between receiver report samples
+CONGESTION_MIN_STREAM_BITRATE = _env_int("SOUNDMESH_CONGESTION_MIN_STREAM_BITRATE", 8000) # Below this, non-priority talkers are muted
+
+# --- Instant replay ---
+REPLAY_SECONDS = _env_int("SOUNDMESH_REPLAY_SECONDS", 20) # Kept per channel unless the channel sets replay_seconds; 0 disables
+REPLAY_BYTES_PER_SECOND = _env_int("SOUNDMESH_REPLAY_BYTES_PER_SECOND", 16000) # Ring size per second kept: ~2-3 simultaneous talkers at 32-48 kbit/s
+REPLAY_FRAMES_PER_SECOND = _env_int("SOUNDMESH_REPLAY_FRAMES_PER_SECOND", 200) # Frame slots per second kept: two talkers at 10 ms ptime
+REPLAY_MAX_STREAMS = _env_int("SOUNDMESH_REPLAY_MAX_STREAMS", 4) # Talkers played back per replay, most talkative first
+REPLAY_START_TIMEOUT = _env_float("SOUNDMESH_REPLAY_START_TIMEOUT", 15.0) # Seconds for the client to accept the replay renegotiation
+
+# --- Direct (IFB) routes ---
+DIRECT_DUCK_GAIN = _env_float("SOUNDMESH_DIRECT_DUCK_GAIN", 0.25) # Gain applied to a listener's other audio while a direct route talks to it
+
+# --- Admin state stream ---
+ADMIN_STREAM_TICK = _env_float("SOUNDMESH_ADMIN_STREAM_TICK", 0.5) # Seconds changes are coalesced for before a diff goes out
+ADMIN_STREAM_QUEUE = _env_int("SOUNDMESH_ADMIN_STREAM_QUEUE", 64) # Events buffered per dashboard before it is dropped as too slow
+ADMIN_STREAM_KEEPALIVE = _env_float("SOUNDMESH_ADMIN_STREAM_KEEPALIVE", 15.0) # Seconds of quiet before a keepalive comment is sent
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from aiortc import RTCRtpSender
+
+from . import config
+from ..models.client import Client, ClientStatus
+from .opus import codec_profiles
+from .shards import media_shards, origin
+from .state import active_clients, active_channels
+
+logger = logging.getLogger(__name__)
+
+LOSS_DECREASE = 0.10 # Above this loss the estimate is cut (GCC's loss-based controller)
+LOSS_INCREASE = 0.02 # Below this loss the estimate grows
+INCREASE_FACTOR = 1.08
+RESTORE_TICKS = 3 # Consecutive healthy ticks before a dropped talker is restored
+MIN_RECONFIGURE_INTERVAL = 2.0 # Seconds; reopening an encoder is not free
+RECONFIGURE_THRESHOLD = 0.15 # Relative bitrate change worth reconfiguring encoders for
+DECISION_HISTORY = 20
+
+
+class ListenerLink:
+    """ Congestion state of one listener's downlink, shared by every stream sent to it. """
+
+    def __init__(self, client_id: str):
+        self.client_id = client_id
+        self.estimate_bps: Optional[float] = None # Total the link is believed to carry
+        self.loss = 0.0 # Smoothed fraction lost, from receiver reports
+        self.rtt_ms: Optional[float] = None
+        self.remb_bps: Optional[int] = None
+        self.send_bps = 0.0 # Measured, across all streams
+        self.streams = 0
+        self.stream_cap: Optional[int] = None # Per-stream bitrate last applied to encoders
+        self.loss_hint: Optional[int] = None
+        self.last_reconfigure = 0.0
+        self.dropped: List[str] = [] # Talker IDs muted for this listener only, in drop order
+        self.healthy_ticks = 0
+        self._last_report: Dict[int, object] = {} # id(sender) -> timestamp of the last receiver report used
+        self._last_bytes: Dict[int, Tuple[float, int]] = {} # id(sender) -> (time, bytesSent)
+        self.decisions: Deque[Dict[str, object]] = deque(maxlen=DECISION_HISTORY)
+
+    def decide(self, action: str, **details):
+        decision = {"at": round(time.time(), 3), "action": action, **details}
+        self.decisions.append(decision)
+        logger.info(f"Congestion control for {self.client_id}: {action} {details}")
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "estimate_kbps": round(self.estimate_bps / 1000, 1) if self.estimate_bps else None,
+            "send_kbps": round(self.send_bps / 1000, 1),
+            "stream_cap_kbps": round(self.stream_cap / 1000, 1) if self.stream_cap else None,
+            "loss_pct": round(self.loss * 100, 1),
+            "rtt_ms": round(self.rtt_ms, 1) if self.rtt_ms is not None else None,
+            "remb_kbps": round(self.remb_bps / 1000, 1) if self.remb_bps else None,
+            "streams": self.streams,
+            "dropped_talkers": list(self.dropped),
+            "decisions": list(self.decisions),
+        }
+
+
+class BandwidthController:
+    """
+    Per-listener congestion control for the streams the server sends.
+
+    Every `interval` seconds each listener's senders are sampled: loss and RTT
+    come from the RTCP receiver reports the browser sends for them, and REMB
+    (when the browser sends it) bounds the estimate. A loss-based controller
+    keeps one bandwidth estimate per listener, which is split evenly across
+    the streams it receives; the resulting per-stream bitrate and the
+    measured loss (as the FEC loss hint) are pushed to that listener's
+    encoders. When even the floor bitrate no longer fits, talkers from
+    non-priority channels are muted for that listener only, latest first,
+    and restored once the link has been healthy for a while.
+    """
+
+    def __init__(self, interval: float, min_stream_bitrate: int):
+        self.interval = interval
+        self.min_stream_bitrate = min_stream_bitrate
+        self.links: Dict[str, ListenerLink] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.ticks = 0
+        self.reconfigurations = 0
+        self.drops = 0
+        self.restores = 0
+        self.last_tick_ms = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            started = time.perf_counter()
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error(f"Congestion control tick failed: {e}", exc_info=True)
+            self.last_tick_ms = (time.perf_counter() - started) * 1000
+
+    async def tick(self):
+        self.ticks += 1
+        for client_id in list(self.links):
+            if client_id not in active_clients:
+                del self.links[client_id]
+        # Whose track is this? Senders carry talkers' tracks directly, or through a bridge from another shard
+        talkers = {id(client.audio_track): client for client in active_clients.values() if client.audio_track}
+        for listener in list(active_clients.values()):
+            if listener.pc is None or listener.status != ClientStatus.AUTHORIZED:
+                continue
+            senders = [sender for sender in listener.pc.getSenders() if sender.track is not None]
+            if not senders:
+                continue
+            link = self.links.get(listener.id)
+            if link is None:
+                link = self.links[listener.id] = ListenerLink(listener.id)
+            await self._sample(link, senders)
+            self._update(link, listener, senders, talkers)
+
+    async def _sample(self, link: ListenerLink, senders: List[RTCRtpSender]):
+        now = time.monotonic()
+        losses, rtts, send_bps = [], [], 0.0
+        for sender in senders:
+            report = await media_shards.run(link.client_id, sender.getStats()) # On the listener PC's shard
+            for stats in report.values():
+                if stats.type == "outbound-rtp":
+                    previous = link._last_bytes.get(id(sender))
+                    if previous and now > previous[0]:
+                        send_bps += (stats.bytesSent - previous[1]) * 8 / (now - previous[0])
+                    link._last_bytes[id(sender)] = (now, stats.bytesSent)
+                elif stats.type == "remote-inbound-rtp":
+                    if link._last_report.get(id(sender)) == stats.timestamp:
+                        continue # No new receiver report since the last tick
+                    link._last_report[id(sender)] = stats.timestamp
+                    losses.append((stats.fractionLost or 0) / 256)
+                    if stats.roundTripTime is not None:
+                        rtts.append(stats.roundTripTime * 1000)
+        live = {id(sender) for sender in senders}
+        for key in [key for key in link._last_bytes if key not in live]:
+            link._last_bytes.pop(key, None)
+            link._last_report.pop(key, None)
+        link.send_bps = send_bps
+        if losses:
+            # The streams share one path, so the worst of them speaks for the link
+            link.loss = link.loss * 0.5 + max(losses) * 0.5
+        if rtts:
+            link.rtt_ms = sum(rtts) / len(rtts)
+        rembs = [encoder.remb_bps for encoder in codec_profiles.encoders(link.client_id) if encoder.remb_bps]
+        link.remb_bps = min(rembs) if rembs else None
+
+    def _update(self, link: ListenerLink, listener: Client, senders: List[RTCRtpSender], talkers: Dict[int, Client]):
+        profile = codec_profiles.resolve(listener.id)
+        active = [sender for sender in senders if sender._enabled]
+        muted = {talkers[id(origin(sender.track))].id for sender in senders if not sender._enabled and id(origin(sender.track)) in talkers}
+        link.dropped = [talker_id for talker_id in link.dropped if talker_id in muted] # Talkers that left meanwhile
+        link.streams = len(active)
+        ceiling = profile.bitrate * max(len(senders), 1)
+        if link.estimate_bps is None:
+            link.estimate_bps = float(ceiling)
+
+        # Loss-based estimate, bounded by REMB and by what the profile would use anyway
+        if link.loss > LOSS_DECREASE:
+            link.estimate_bps *= 1 - 0.5 * link.loss
+        elif link.loss < LOSS_INCREASE:
+            link.estimate_bps *= INCREASE_FACTOR
+        if link.remb_bps:
+            link.estimate_bps = min(link.estimate_bps, link.remb_bps)
+        link.estimate_bps = max(min(link.estimate_bps, ceiling), self.min_stream_bitrate)
+
+        # At the extreme, shed non-priority talkers for this listener only
+        if link.estimate_bps / max(len(active), 1) < self.min_stream_bitrate:
+            link.healthy_ticks = 0
+            droppable = [sender for sender in reversed(active) if not self._is_priority(talkers.get(id(origin(sender.track))))]
+            while droppable and link.estimate_bps / max(len(active), 1) < self.min_stream_bitrate:
+                sender = droppable.pop(0)
+                sender._enabled = False # aiortc stops encoding and sending for this sender
+                active.remove(sender)
+                talker = talkers.get(id(origin(sender.track)))
+                link.dropped.append(talker.id if talker else str(id(sender.track)))
+                self.drops += 1
+                link.decide("drop_talker", talker=link.dropped[-1], estimate_kbps=round(link.estimate_bps / 1000, 1))
+        elif link.dropped and link.loss < LOSS_INCREASE:
+            link.healthy_ticks += 1
+            restore_needs = (len(active) + 1) * self.min_stream_bitrate * 1.5
+            if link.healthy_ticks >= RESTORE_TICKS and link.estimate_bps >= restore_needs:
+                talker_id = link.dropped.pop()
+                for sender in senders:
+                    talker = talkers.get(id(origin(sender.track)))
+                    if not sender._enabled and (talker.id if talker else str(id(sender.track))) == talker_id:
+                        sender._enabled = True
+                        active.append(sender)
+                self.restores += 1
+                link.healthy_ticks = 0
+                link.decide("restore_talker", talker=talker_id, estimate_kbps=round(link.estimate_bps / 1000, 1))
+        link.streams = len(active)
+
+        # Split what is left across the remaining streams and tell the encoders
+        stream_cap = int(min(profile.bitrate, max(link.estimate_bps / max(len(active), 1), self.min_stream_bitrate)))
+        loss_hint = min(int(link.loss * 100) + 5, 30) if link.loss > 0.01 else None
+        now = time.monotonic()
+        changed = (link.stream_cap is None or abs(stream_cap - link.stream_cap) / link.stream_cap >= RECONFIGURE_THRESHOLD
+                   or loss_hint != link.loss_hint)
+        if changed and now - link.last_reconfigure >= MIN_RECONFIGURE_INTERVAL:
+            cap = stream_cap if stream_cap < profile.bitrate else None
+            for encoder in codec_profiles.encoders(listener.id):
+                encoder.adapt(cap, loss_hint)
+            if link.stream_cap is not None:
+                self.reconfigurations += 1
+                link.decide("set_bitrate", stream_kbps=round(stream_cap / 1000, 1), loss_hint=loss_hint)
+            link.stream_cap = stream_cap
+            link.loss_hint = loss_hint
+            link.last_reconfigure = now
+
+    @staticmethod
+    def _is_priority(talker: Optional[Client]) -> bool:
+        if talker is None:
+            return False
+        return any(active_channels[channel_id].priority for channel_id in talker.talk_channels() if channel_id in active_channels)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self._task is not None,
+            "interval": self.interval,
+            "min_stream_kbps": self.min_stream_bitrate / 1000,
+            "ticks": self.ticks,
+            "last_tick_ms": round(self.last_tick_ms, 2),
+            "reconfigurations": self.reconfigurations,
+            "drops": self.drops,
+            "restores": self.restores,
+            "listeners": {client_id: link.snapshot() for client_id, link in self.links.items()},
+        }
+
+
+bandwidth_controller = BandwidthController(
+    interval=config.CONGESTION_INTERVAL,
+    min_stream_bitrate=config.CONGESTION_MIN_STREAM_BITRATE,
+)
@@ -0,0 +1,252 @@
+import asyncio
+import fractions
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from av import AudioFrame
+from aiortc import RTCPeerConnection, RTCRtpSender
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+
+from .shards import call_in
+
+logger = logging.getLogger(__name__)
+
+LEG_QUEUE_FRAMES = 10 # Frames a leg buffers before dropping the oldest; bounds added latency to ~200 ms
+_SETUP_SAMPLES = 256
+
+
+class DirectTrack(MediaStreamTrack):
+    """
+    One leg's copy of the talker's audio, fed from a relay subscription.
+
+    A pump task moves frames into a short queue, so when the leg ends the
+    sender's pending recv() can be answered with one frame of silence. An
+    aiortc sender whose track raises MediaStreamError exits for good, and a
+    parked sender must stay alive to be reused. The subscription and pump
+    start on the first recv(), on the loop of the listener's PC, which may
+    be a media shard rather than the loop the route was set up on.
+    """
+
+    kind = "audio"
+
+    def __init__(self, relay: MediaRelay, origin: MediaStreamTrack):
+        super().__init__()
+        self._relay = relay
+        self._origin = origin
+        self._source: Optional[MediaStreamTrack] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=LEG_QUEUE_FRAMES)
+        self._last: Optional[AudioFrame] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pump: Optional[asyncio.Future] = None
+
+    @property
+    def subscribed(self) -> bool:
+        """ Whether this leg holds a live subscription to the talker's track on the relay. """
+        return self._source is not None and self._source.readyState == "live"
+
+    async def _run(self):
+        try:
+            while True:
+                frame = await self._source.recv()
+                if self._queue.full():
+                    self._queue.get_nowait() # A sender that isn't pulling yet must not build up latency
+                self._queue.put_nowait(frame)
+        except (MediaStreamError, asyncio.CancelledError):
+            pass
+
+    async def recv(self) -> AudioFrame:
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self._pump is None:
+            self._loop = asyncio.get_running_loop()
+            self._source = self._relay.subscribe(self._origin)
+            self._pump = asyncio.ensure_future(self._run())
+        frame = await self._queue.get()
+        if frame is None:
+            return self._silence()
+        self._last = frame
+        return frame
+
+    def _silence(self) -> AudioFrame:
+        last = self._last
+        frame = AudioFrame(format="s16", layout=last.layout.name if last else "mono", samples=last.samples if last else 960)
+        for plane in frame.planes:
+            plane.update(bytes(plane.buffer_size))
+        frame.sample_rate = last.sample_rate if last else 48000
+        frame.time_base = last.time_base if last and last.time_base else fractions.Fraction(1, frame.sample_rate)
+        frame.pts = last.pts + last.samples if last and last.pts is not None else 0
+        return frame
+
+    def _release(self):
+        self._pump.cancel()
+        self._source.stop()
+        while self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None) # Releases a sender still waiting in recv()
+
+    def stop(self):
+        if self.readyState == "live" and self._pump is not None:
+            call_in(self._loop, self._release)
+        super().stop()
+
+
+@dataclass
+class DirectLeg:
+    """ One listener of a direct route and the sender carrying the talker to it. """
+    listener_id: str
+    sender: RTCRtpSender
+    track: Optional[DirectTrack] # None when the listener already hears the talker through a channel
+    fast: bool # Went live without renegotiation
+
+    @property
+    def stream_id(self) -> str:
+        return self.sender._stream_id # The msid stream ID the browser sees for this sender
+
+
+@dataclass
+class DirectRoute:
+    id: str
+    talker_id: str
+    duck_gain: float
+    legs: Dict[str, DirectLeg] = field(default_factory=dict)
+    created: float = field(default_factory=time.monotonic)
+
+
+class DirectRouteTable:
+    """
+    Point-to-point (IFB) routes: one talker's audio sent straight to chosen
+    listeners, outside channel routing, while their other audio is ducked.
+
+    Each leg normally gets its own relayed copy of the talker's track on its
+    own sender. When a leg ends its sender is parked rather than removed:
+    the track is detached but the transceiver stays negotiated for sending,
+    so the next route to that listener attaches its track with replaceTrack
+    and goes live without renegotiation. Only a listener's first route pays
+    for an offer/answer round trip. Ducking happens in the listener's client,
+    which does the mixing: it is told the gain and which streams to leave alone.
+    """
+
+    def __init__(self):
+        self.routes: Dict[str, DirectRoute] = {}
+        self._parked: Dict[str, List[RTCRtpSender]] = {} # listener_id -> idle senders still negotiated for sending
+        self._setup_ms: Deque[float] = deque(maxlen=_SETUP_SAMPLES)
+        self.started = 0
+        self.ended = 0
+        self.legs_fast = 0
+        self.legs_renegotiated = 0
+        self.legs_shared = 0
+
+    def take_parked(self, listener_id: str, pc: RTCPeerConnection) -> Optional[RTCRtpSender]:
+        """ An idle sender on the listener's current PC that can carry a track right away, if any. """
+        parked = self._parked.get(listener_id)
+        senders = pc.getSenders()
+        while parked:
+            sender = parked.pop()
+            if sender.track is None and sender in senders:
+                return sender
+        return None
+
+    def add(self, route: DirectRoute):
+        self.routes[route.id] = route
+        self.started += 1
+        for leg in route.legs.values():
+            if leg.track is None:
+                self.legs_shared += 1
+            elif leg.fast:
+                self.legs_fast += 1
+            else:
+                self.legs_renegotiated += 1
+
+    def record_setup(self, seconds: float):
+        """ Time from a route request to every leg being live or its renegotiation started. """
+        self._setup_ms.append(seconds * 1000)
+
+    def routes_from(self, talker_id: str) -> List[DirectRoute]:
+        return [route for route in self.routes.values() if route.talker_id == talker_id]
+
+    def routes_to(self, listener_id: str) -> List[DirectRoute]:
+        return [route for route in self.routes.values() if listener_id in route.legs]
+
+    def holds(self, sender: RTCRtpSender) -> bool:
+        """ Whether a route's leg is carried by `sender`, so channel routing must leave it in place. """
+        return any(leg.sender is sender for route in self.routes.values() for leg in route.legs.values())
+
+    def remove_leg(self, route: DirectRoute, listener_id: str, park: bool = True) -> Optional[DirectLeg]:
+        leg = route.legs.pop(listener_id, None)
+        if leg is None or leg.track is None:
+            return leg
+        leg.sender.replaceTrack(None)
+        leg.sender._enabled = True # Un-muted by congestion control, for the next route it carries
+        leg.track.stop()
+        if park:
+            self._parked.setdefault(listener_id, []).append(leg.sender)
+        return leg
+
+    def end(self, route_id: str) -> Optional[DirectRoute]:
+        route = self.routes.pop(route_id, None)
+        if route is None:
+            return None
+        for listener_id in list(route.legs):
+            self.remove_leg(route, listener_id)
+        route.legs.clear()
+        self.ended += 1
+        logger.info(f"Direct route {route.id} from {route.talker_id} ended after {time.monotonic() - route.created:.1f}s")
+        return route
+
+    def forget(self, client_id: str) -> Tuple[Set[str], List[DirectRoute]]:
+        """
+        Drops a departing client from every route: routes it was talking on
+        end, and it is removed as a listener elsewhere (routes left without
+        listeners end too). Returns the listeners whose ducking changed and
+        the routes that ended under a talker who is still connected.
+        """
+        listeners: Set[str] = set()
+        orphaned: List[DirectRoute] = []
+        for route in list(self.routes.values()):
+            if route.talker_id == client_id:
+                listeners.update(route.legs)
+                self.end(route.id)
+            elif client_id in route.legs:
+                self.remove_leg(route, client_id, park=False)
+                if not route.legs:
+                    self.end(route.id)
+                    orphaned.append(route)
+        self._parked.pop(client_id, None)
+        listeners.discard(client_id)
+        return listeners, orphaned
+
+    def ducking(self, listener_id: str) -> Dict[str, object]:
+        """ What a listener's client should do with its mix: gain for everything except the direct streams. """
+        legs = [(route, route.legs[listener_id]) for route in self.routes_to(listener_id)]
+        return {
+            "gain": min((route.duck_gain for route, _ in legs), default=1.0),
+            "except_streams": [leg.stream_id for _, leg in legs],
+            "routes": [{"route_id": route.id, "talker_id": route.talker_id, "stream_id": leg.stream_id} for route, leg in legs],
+        }
+
+    def stats(self) -> Dict[str, object]:
+        samples = sorted(self._setup_ms)
+        return {
+            "active_routes": len(self.routes),
+            "active_legs": sum(len(route.legs) for route in self.routes.values()),
+            "parked_senders": sum(len(senders) for senders in self._parked.values()),
+            "started": self.started,
+            "ended": self.ended,
+            "legs_fast": self.legs_fast,
+            "legs_renegotiated": self.legs_renegotiated,
+            "legs_shared": self.legs_shared,
+            "setup_avg_ms": round(sum(samples) / len(samples), 2) if samples else None,
+            "setup_p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2) if samples else None,
+            "routes": [
+                {"route_id": route.id, "talker_id": route.talker_id, "listeners": sorted(route.legs),
+                 "duck_gain": route.duck_gain, "age_s": round(time.monotonic() - route.created, 1)}
+                for route in self.routes.values()
+            ],
+        }
+
+
+direct_routes = DirectRouteTable()
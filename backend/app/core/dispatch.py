@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Type
+
+from pydantic import BaseModel, ValidationError
+
+from .ratelimit import KeyedRateLimiter
+from .logs import log_context
+
+logger = logging.getLogger(__name__)
+
+# Handlers receive the per-connection context and the validated message
+Handler = Callable[[Any, BaseModel], Awaitable[None]]
+
+DEFAULT_LANE = "default"
+LANE_QUEUE_SIZE = 256
+
+
+class FloodDetected(Exception):
+    """ Raised by dispatch() once a connection keeps exceeding its rate limits. """
+
+
+@dataclass
+class HandlerSpec:
+    msg_type: str
+    handler: Handler
+    schema: Type[BaseModel]
+    lane: str = DEFAULT_LANE
+    rate: Optional[float] = None # Tokens per second, None disables the per-type limit
+    burst: Optional[float] = None
+
+
+@dataclass
+class HandlerStats:
+    """ Per message type counters and latency figures (seconds). """
+    calls: int = 0
+    errors: int = 0
+    invalid: int = 0
+    rate_limited: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    last_time: float = 0.0
+
+    def record(self, duration: float):
+        self.calls += 1
+        self.total_time += duration
+        self.last_time = duration
+        if duration > self.max_time:
+            self.max_time = duration
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "invalid": self.invalid,
+            "rate_limited": self.rate_limited,
+            "avg_ms": round(self.total_time / self.calls * 1000, 3) if self.calls else 0.0,
+            "max_ms": round(self.max_time * 1000, 3),
+            "last_ms": round(self.last_time * 1000, 3),
+        }
+
+
+class MessageDispatcher:
+    """
+    Registry mapping WebSocket message types to handlers.
+
+    Each handler is registered with a pydantic schema (validated only when a
+    message of that type is dispatched), an optional per-type rate limit
+    (enforced per client ID and, scaled up, per source IP) and a lane.
+    Messages in the same lane are processed strictly in arrival order;
+    different lanes run concurrently when a session is opened with
+    `concurrent=True`, so e.g. a slow channel join never delays ICE candidates.
+    """
+
+    def __init__(self, rate_overrides: Optional[Dict[str, tuple]] = None, ip_rate_multiplier: float = 1.0,
+                 message_rate: Optional[float] = None, message_burst: Optional[float] = None,
+                 max_violations: Optional[float] = None):
+        self._handlers: Dict[str, HandlerSpec] = {}
+        self._stats: Dict[str, HandlerStats] = {}
+        self._rate_overrides = rate_overrides or {}
+        self._ip_rate_multiplier = ip_rate_multiplier
+        # Buckets are keyed by client ID / IP and shared by all sessions,
+        # so reconnecting doesn't hand a client a fresh allowance
+        self._client_limiters: Dict[str, KeyedRateLimiter] = {}
+        self._ip_limiters: Dict[str, KeyedRateLimiter] = {}
+        self._message_limiter = KeyedRateLimiter(message_rate, message_burst or message_rate) if message_rate else None
+        self._violation_limiter = KeyedRateLimiter(1.0, max_violations) if max_violations else None
+
+    def register(self, msg_type: str, schema: Type[BaseModel], lane: str = DEFAULT_LANE,
+                 rate: Optional[float] = None, burst: Optional[float] = None):
+        """ Decorator registering `handler(ctx, message)` for `msg_type`. """
+        def decorator(handler: Handler) -> Handler:
+            if msg_type in self._handlers:
+                raise ValueError(f"Handler already registered for message type '{msg_type}'")
+            spec_rate, spec_burst = self._rate_overrides.get(msg_type, (rate, burst))
+            spec = HandlerSpec(msg_type, handler, schema, lane, spec_rate, spec_burst)
+            self._handlers[msg_type] = spec
+            self._stats[msg_type] = HandlerStats()
+            if spec.rate is not None:
+                spec_burst = spec.burst if spec.burst is not None else spec.rate
+                self._client_limiters[msg_type] = KeyedRateLimiter(spec.rate, spec_burst)
+                self._ip_limiters[msg_type] = KeyedRateLimiter(spec.rate * self._ip_rate_multiplier,
+                                                               spec_burst * self._ip_rate_multiplier)
+            return handler
+        return decorator
+
+    def get(self, msg_type: str) -> Optional[HandlerSpec]:
+        return self._handlers.get(msg_type)
+
+    def stats(self, msg_type: str) -> HandlerStats:
+        return self._stats[msg_type]
+
+    def stats_snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {msg_type: stats.snapshot() for msg_type, stats in self._stats.items()}
+
+    def limiter_snapshot(self) -> Dict[str, Any]:
+        return {
+            "messages": self._message_limiter.stats() if self._message_limiter else None,
+            "per_client": {t: l.stats() for t, l in self._client_limiters.items()},
+            "per_ip": {t: l.stats() for t, l in self._ip_limiters.items()},
+        }
+
+    def allow(self, msg_type: Optional[str], client_id: str, remote_ip: Optional[str]) -> bool:
+        """ Checks the all-message bucket and, for known types, the per-client and per-IP buckets. """
+        if self._message_limiter and not self._message_limiter.allow(client_id):
+            return False
+        client_limiter = self._client_limiters.get(msg_type)
+        if client_limiter and not client_limiter.allow(client_id):
+            return False
+        ip_limiter = self._ip_limiters.get(msg_type)
+        if ip_limiter and remote_ip and not ip_limiter.allow(remote_ip):
+            return False
+        return True
+
+    def record_violation(self, client_id: str) -> bool:
+        """ Records a rate-limit violation; returns True once the client should be cut off. """
+        return self._violation_limiter is not None and not self._violation_limiter.allow(client_id)
+
+    def open_session(self, ctx: Any, concurrent: bool = False,
+                     on_error: Optional[Callable[[Any, str], Awaitable[None]]] = None) -> "DispatchSession":
+        return DispatchSession(self, ctx, concurrent, on_error)
+
+
+class DispatchSession:
+    """ Per-connection dispatch state: the context handed to handlers and the lane workers. """
+
+    def __init__(self, dispatcher: MessageDispatcher, ctx: Any, concurrent: bool,
+                 on_error: Optional[Callable[[Any, str], Awaitable[None]]]):
+        self.dispatcher = dispatcher
+        self.ctx = ctx
+        self.concurrent = concurrent
+        self._on_error = on_error
+        self._client_id = getattr(ctx, "client_id", "?")
+        self._remote_ip = getattr(ctx, "remote_ip", None)
+        self._lanes: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+
+    async def _report(self, message: str):
+        if self._on_error:
+            await self._on_error(self.ctx, message)
+
+    async def dispatch(self, raw: Dict[str, Any]):
+        """
+        Validates `raw` against its type's schema and runs (or queues) the handler.
+        Raises FloodDetected when the client keeps ignoring its rate limits.
+        """
+        msg_type = raw.get("type")
+        spec = self.dispatcher.get(msg_type) if isinstance(msg_type, str) else None
+
+        if not self.dispatcher.allow(msg_type if spec else None, self._client_id, self._remote_ip):
+            if spec:
+                self.dispatcher.stats(msg_type).rate_limited += 1
+            logger.warning(f"Rate limit exceeded for '{msg_type}' from {self._client_id} ({self._remote_ip})")
+            if self.dispatcher.record_violation(self._client_id):
+                raise FloodDetected(f"Client {self._client_id} exceeded rate limits repeatedly")
+            await self._report(f"Rate limit exceeded for {msg_type}")
+            return
+
+        if spec is None:
+            logger.warning(f"Unknown message type {msg_type!r} from {self._client_id}")
+            await self._report(f"Unknown message type: {msg_type}")
+            return
+
+        stats = self.dispatcher.stats(msg_type)
+
+        try:
+            message = spec.schema.model_validate(raw)
+        except ValidationError as e:
+            stats.invalid += 1
+            logger.warning(f"Invalid '{msg_type}' message from {self._client_id}: {e.errors()}")
+            await self._report(f"Invalid {msg_type} message")
+            return
+
+        if not self.concurrent:
+            await self._run(spec, message)
+            return
+
+        queue = self._lanes.get(spec.lane)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=LANE_QUEUE_SIZE)
+            self._lanes[spec.lane] = queue
+            self._workers[spec.lane] = asyncio.create_task(self._lane_worker(spec.lane, queue))
+        await queue.put((spec, message)) # Blocks the reader (backpressure) only if the lane is full
+
+    async def _lane_worker(self, lane: str, queue: asyncio.Queue):
+        while True:
+            spec, message = await queue.get()
+            try:
+                await self._run(spec, message)
+            finally:
+                queue.task_done()
+
+    async def _run(self, spec: HandlerSpec, message: BaseModel):
+        stats = self.dispatcher.stats(spec.msg_type)
+        started = time.perf_counter()
+        try:
+            with log_context(channel_id=getattr(message, "channel_id", None)): # Tags what the handler logs about a channel
+                await spec.handler(self.ctx, message)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stats.errors += 1
+            logger.exception(f"Error handling '{spec.msg_type}' for {self._client_id}: {e}", exc_info=e)
+        finally:
+            stats.record(time.perf_counter() - started)
+
+    async def close(self):
+        """ Cancels lane workers; queued but unprocessed messages are dropped. """
+        for task in self._workers.values():
+            task.cancel()
+        for task in self._workers.values():
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._workers.clear()
+        self._lanes.clear()
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import random
+import signal
+import time
+from typing import Dict, List, Optional, Set
+
+from fastapi import WebSocket
+
+from . import config
+from ..models.client import Client, ClientStatus
+from .direct import direct_routes
+from .sessions import session_manager
+from .state import active_clients, notify_client, handle_disconnect
+
+logger = logging.getLogger(__name__)
+
+
+class DrainController:
+    """
+    Empties the server ahead of a restart without a reconnect stampede.
+
+    Once draining, new WebSocket connections are turned away with a migrate
+    message, suspended sessions are ended (they could not be resumed here
+    anyway), and connected clients are told to migrate to `target_url` in
+    batches of `batch_size` every `batch_interval` seconds, each with a
+    random reconnect delay spread over the interval. Clients go in order of
+    how little they would notice: pending ones first, then listeners, then
+    talkers, and talkers on an all-call or private route last. Clients
+    reconnect with the same client_id, so the new server's reconnect logic
+    in websocket_endpoint applies unchanged. Whoever is left at the deadline
+    is disconnected, and the process then shuts itself down (SIGTERM, so
+    the usual shutdown handlers run).
+    """
+
+    def __init__(self, target_url: str, batch_size: int, batch_interval: float, deadline: float, exit_when_done: bool):
+        self.target_url = target_url or None
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.deadline = deadline
+        self.exit_when_done = exit_when_done
+        self.draining = False
+        self.reason: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._told: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.migrate_sent = 0
+        self.turned_away = 0
+        self.forced = 0
+
+    def install_signal_handler(self, signal_name: str):
+        """ Starts a drain when the process receives `signal_name` (e.g. SIGUSR1). """
+        if not signal_name:
+            return
+        try:
+            signum = getattr(signal, signal_name)
+            asyncio.get_running_loop().add_signal_handler(signum, lambda: self.start(reason=f"signal {signal_name}"))
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError) as e:
+            logger.warning(f"Cannot drain on {signal_name}: {e}")
+
+    def start(self, target_url: Optional[str] = None, batch_size: Optional[int] = None, batch_interval: Optional[float] = None,
+              deadline: Optional[float] = None, reason: str = "admin") -> bool:
+        """ Begins draining; settings not given keep their configured values. Returns False if already draining. """
+        if self.draining:
+            return False
+        if target_url is not None:
+            self.target_url = target_url or None
+        self.batch_size = batch_size or self.batch_size
+        self.batch_interval = batch_interval or self.batch_interval
+        self.deadline = deadline or self.deadline
+        self.draining = True
+        self.reason = reason
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._told.clear()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.warning(f"Draining ({reason}): {len(active_clients)} clients to move to {self.target_url or 'the same address'} "
+                       f"in batches of {self.batch_size} every {self.batch_interval:.1f}s, deadline {self.deadline:.0f}s")
+        return True
+
+    async def cancel(self) -> bool:
+        """ Stops draining and admits clients again. Clients already told to migrate are not called back. """
+        if not self.draining:
+            return False
+        self.draining = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        logger.warning(f"Drain cancelled after telling {len(self._told)} clients to migrate")
+        return True
+
+    def _migrate_message(self, delay: float) -> Dict[str, object]:
+        return {"type": "migrate", "url": self.target_url, "reason": "drain", "delay_ms": int(delay * 1000)}
+
+    async def turn_away(self, websocket: WebSocket, client_id: str):
+        """ Answers a connection attempt made while draining: where to go instead, then close. """
+        self.turned_away += 1
+        logger.info(f"Turning away {client_id}: server is draining")
+        try:
+            await websocket.send_json(self._migrate_message(random.uniform(0, self.batch_interval)))
+            await websocket.close(code=1013, reason="Server is draining")
+        except Exception:
+            pass
+
+    @staticmethod
+    def _rank(client: Client) -> int:
+        """ Lower goes first: how much a client would notice being moved. """
+        if client.status != ClientStatus.AUTHORIZED:
+            return 0
+        if client.audio_track is None or not client.talk_channels():
+            return 1 if not direct_routes.routes_from(client.id) else 3
+        return 3 if client.all_call_channels or direct_routes.routes_from(client.id) else 2
+
+    def _next_batch(self) -> List[Client]:
+        waiting = [client for client in active_clients.values() if client.id not in self._told and client.websocket]
+        waiting.sort(key=self._rank)
+        return waiting[:self.batch_size]
+
+    async def _run(self):
+        try:
+            for client_id in session_manager.suspended_ids():
+                await session_manager.end(client_id)
+            deadline = self.started_at + self.deadline
+            while active_clients and time.monotonic() < deadline:
+                for client in self._next_batch():
+                    self._told.add(client.id)
+                    self.migrate_sent += 1
+                    await notify_client(client.id, self._migrate_message(random.uniform(0, self.batch_interval)))
+                await asyncio.sleep(self.batch_interval)
+            if active_clients:
+                logger.warning(f"Drain deadline reached with {len(active_clients)} clients left. Disconnecting them.")
+                for client_id in list(active_clients):
+                    self.forced += 1
+                    await handle_disconnect(client_id)
+            self.finished_at = time.monotonic()
+            logger.warning(f"Drained in {self.finished_at - self.started_at:.1f}s: {self.migrate_sent} told to migrate, "
+                           f"{self.forced} disconnected at the deadline, {self.turned_away} connections turned away")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Drain failed: {e}", exc_info=True)
+            return
+        if self.exit_when_done:
+            os.kill(os.getpid(), signal.SIGTERM) # Let the server run its normal shutdown
+
+    def stats(self) -> Dict[str, object]:
+        now = time.monotonic()
+        return {
+            "draining": self.draining,
+            "reason": self.reason,
+            "target_url": self.target_url,
+            "batch_size": self.batch_size,
+            "batch_interval": self.batch_interval,
+            "deadline": self.deadline,
+            "elapsed": round((self.finished_at or now) - self.started_at, 1) if self.started_at else None,
+            "finished": self.finished_at is not None,
+            "clients_left": len(active_clients),
+            "migrate_sent": self.migrate_sent,
+            "turned_away": self.turned_away,
+            "forced": self.forced,
+        }
+
+
+drain = DrainController(
+    target_url=config.DRAIN_TARGET_URL,
+    batch_size=config.DRAIN_BATCH_SIZE,
+    batch_interval=config.DRAIN_BATCH_INTERVAL,
+    deadline=config.DRAIN_DEADLINE,
+    exit_when_done=config.DRAIN_EXIT,
+)
@@ -0,0 +1,895 @@
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import WebSocket
+from aiortc import RTCPeerConnection, RTCRtpSender, RTCSessionDescription
+
+from ..models.client import Client, ClientStatus
+from ..models.permissions import ClientPermissions
+from ..schemas.messages import (
+    OfferMessage, AnswerMessage, CandidateMessage, CandidatesMessage, IceCandidatePayload, JoinChannelMessage,
+    UpdateListenChannelsMessage, ReplayMessage, DirectRouteStartMessage, DirectRouteStopMessage,
+    AllCallStartMessage, AllCallStopMessage, EchoMessage, PongMessage
+)
+from . import config
+from .dispatch import MessageDispatcher
+from .admission import media_scheduler, PRIORITY_SIGNALING, PRIORITY_RENEGOTIATION, PRIORITY_NEW_PC
+from .sessions import session_manager
+from .heartbeat import heartbeat
+from .permissions import permission_engine
+from .udpmux import udp_mux, advertise_ice_lite
+from .pcfactory import pc_factory
+from .shards import media_shards
+from .resources import resources, release_sender
+from .ice import candidate_buffer, parse_candidate
+from .opus import codec_profiles
+from .replay import replay_buffer, ReplaySession
+from .direct import direct_routes, DirectLeg, DirectRoute, DirectTrack
+from .store import store
+from .state import (
+    active_clients, pcs, relay, known_channel_ids, get_negotiation_lock,
+    notify_client, notify_clients_update, notify_ducking, handle_disconnect
+)
+
+logger = logging.getLogger(__name__)
+
+# Lanes: messages within a lane keep their order, lanes run independently.
+# SDP and ICE share a lane so candidates are never applied before their offer.
+SIGNALING_LANE = "signaling"
+ROUTING_LANE = "routing"
+HEARTBEAT_LANE = "heartbeat" # Own lane so RTT isn't inflated by queued routing work
+
+dispatcher = MessageDispatcher(
+    rate_overrides=config.WS_RATE_LIMITS,
+    ip_rate_multiplier=config.WS_IP_RATE_MULTIPLIER,
+    message_rate=config.WS_MESSAGE_RATE,
+    message_burst=config.WS_MESSAGE_BURST,
+    max_violations=config.WS_MAX_RATE_VIOLATIONS,
+)
+
+
+@dataclass
+class ConnectionContext:
+    """ Per-WebSocket state handed to every message handler. """
+    client_id: str
+    websocket: WebSocket
+    remote_ip: Optional[str] = None
+
+    @property
+    def client(self) -> Optional[Client]:
+        return active_clients.get(self.client_id)
+
+
+async def report_error(ctx: ConnectionContext, message: str):
+    """ Dispatcher error callback: tells the client why its message was dropped. """
+    await notify_client(ctx.client_id, {"type": "error", "message": message})
+
+
+def queue_position_notifier(client_id: str, stage: str):
+    """ Returns a callback telling a client where it is in a setup queue. """
+    async def notify(position: int, queue_length: int):
+        await notify_client(client_id, {
+            "type": "queue_position", "stage": stage,
+            "position": position, "queue_length": queue_length
+        })
+    return notify
+
+
+# --- Helper Function for Renegotiation ---
+async def trigger_renegotiation(client_id: str):
+    """Initiates SDP renegotiation by sending a new offer to the client."""
+    listener_client = active_clients.get(client_id)
+    if listener_client and listener_client.pc and session_manager.is_suspended(client_id):
+        # Tracks changed while the client's WebSocket is gone; send the offer once it resumes
+        session_manager.pending_renegotiation.add(client_id)
+        return
+    if not listener_client or not listener_client.pc or not listener_client.websocket:
+        logger.warning(f"Cannot trigger renegotiation for {client_id}: client/PC/websocket not found or not ready.")
+        return
+
+    pc = listener_client.pc
+    try:
+        async with media_scheduler.slot(PRIORITY_RENEGOTIATION), get_negotiation_lock(client_id):
+            logger.info(f"Triggering renegotiation for {client_id}...")
+            offer = await media_shards.run(client_id, pc.createOffer())
+            if not offer:
+                 logger.error(f"Failed to create renegotiation offer for {client_id}")
+                 return
+            with codec_profiles.negotiating(client_id):
+                await media_shards.run(client_id, pc.setLocalDescription(offer))
+        logger.info(f"Sending renegotiation offer to {client_id}")
+        await notify_client(client_id, {
+            "type": "offer",
+            "sdp": codec_profiles.munge(pc.localDescription.sdp, codec_profiles.for_sdp(client_id))
+        })
+    except Exception as e:
+        logger.exception(f"Error during renegotiation trigger for {client_id}: {e}", exc_info=e)
+
+
+def _carrying(talker: Client, listener: Client):
+    """ The track `listener`'s PC sends for `talker`: the talker's own, or a bridge when their PCs are on different shards. """
+    return media_shards.bridge(talker.audio_track, talker.id, listener.id)
+
+
+def _sender_for(pc: RTCPeerConnection, track) -> Optional[RTCRtpSender]:
+    for sender in pc.getSenders():
+        if sender.track == track:
+            return sender
+    return None
+
+
+def _remove_track(pc: RTCPeerConnection, track) -> bool:
+    """ Stops sending `track` on `pc` if it is being sent there. Returns whether anything changed. """
+    sender = _sender_for(pc, track)
+    if sender is None or direct_routes.holds(sender):
+        return False # A direct route shares this sender and still needs it
+    release_sender(pc, sender)
+    return True
+
+
+def hearers(talker: Client, channel_ids: Set[str]) -> Set[str]:
+    """
+    Clients that hear `talker` while it talks to `channel_ids`. A listener
+    monitoring several of those channels is counted once, since it gets one
+    stream of the talker however many of its channels carry it.
+    """
+    if not channel_ids:
+        return set()
+    candidates = [
+        client for client in active_clients.values()
+        if (client.id != talker.id and client.status == ClientStatus.AUTHORIZED and client.pc
+            and not client.listening_channels.isdisjoint(channel_ids))
+    ]
+    heard: Set[str] = set()
+    for channel_id in channel_ids:
+        heard.update(permission_engine.may_hear(channel_id, [c.id for c in candidates if channel_id in c.listening_channels]))
+    return heard
+
+
+def route_talker(talker: Client, old_channels: Set[str], new_channels: Set[str]) -> Set[str]:
+    """
+    Moves `talker`'s audio from `old_channels` to `new_channels` by diffing
+    who hears it before and after: listeners who hear it either way keep
+    their sender untouched, and the rest get one sender added or released.
+    Returns the IDs of clients whose PC changed; the caller renegotiates them.
+    """
+    track = talker.audio_track
+    if track is None:
+        return set()
+    before = hearers(talker, old_channels)
+    after = hearers(talker, new_channels)
+    changed: Set[str] = set()
+    for listener_id in after - before:
+        listener = active_clients[listener_id]
+        if _sender_for(listener.pc, _carrying(talker, listener)) is None:
+            logger.info(f"Adding track {track.id} from {talker.id} to listener {listener_id}")
+            try:
+                listener.pc.addTrack(_carrying(talker, listener))
+                changed.add(listener_id)
+            except Exception as e:
+                logger.error(f"Error adding track {track.id} to {listener_id}'s PC: {e}")
+    for listener_id in before - after:
+        listener = active_clients.get(listener_id)
+        if listener and listener.pc and _remove_track(listener.pc, _carrying(talker, listener)):
+            logger.info(f"Removed track {track.id} from {talker.id} from listener {listener_id}")
+            changed.add(listener_id)
+    return changed
+
+
+def apply_permission_revocations(client: Client, revoked_talk: Set[str], revoked_listen: Set[str]) -> Set[str]:
+    """
+    Tears down the routes a permission change no longer allows: the client's
+    own track if it lost talk in its current channel, and tracks from the
+    channels it may no longer listen to. Returns the IDs of clients whose PC
+    changed; the caller decides when to renegotiate them.
+    """
+    client_id = client.id
+    needs_renegotiation: Set[str] = set()
+
+    old_talk = client.talk_channels()
+    if client.current_channel_id in revoked_talk:
+        logger.info(f"Client {client_id} may no longer talk in {client.current_channel_id}. Removing it from the channel.")
+        client.current_channel_id = None
+    if not client.all_call_channels.isdisjoint(revoked_talk):
+        logger.info(f"Client {client_id} may no longer talk in {client.all_call_channels & revoked_talk}. Dropping them from its all-call.")
+        client.all_call_channels = client.all_call_channels - revoked_talk
+    new_talk = client.talk_channels()
+    if new_talk != old_talk:
+        needs_renegotiation |= route_talker(client, old_talk, new_talk)
+
+    lost_channels = client.listening_channels & revoked_listen
+    if lost_channels:
+        logger.info(f"Client {client_id} may no longer listen to {lost_channels}. Removing their tracks.")
+        client.listening_channels -= lost_channels
+        if client.pc:
+            for talker_id, talker_client in active_clients.items():
+                talk_channels = talker_client.talk_channels()
+                if (talker_id != client_id and talker_client.audio_track and
+                        not talk_channels.isdisjoint(lost_channels) and talk_channels.isdisjoint(client.listening_channels)):
+                    try:
+                        if _remove_track(client.pc, _carrying(talker_client, client)):
+                            needs_renegotiation.add(client_id)
+                    except Exception as e:
+                        logger.error(f"Error removing track from {talker_id} from {client_id}'s PC: {e}")
+
+    return needs_renegotiation
+
+
+def revoke_direct_legs(talker_ids: Set[str]) -> Tuple[Set[str], List[DirectRoute]]:
+    """
+    Ends the legs of direct routes from `talker_ids` to listeners they may no
+    longer reach. Returns the listeners whose ducking changed and the routes
+    that ended because no listener was left.
+    """
+    ducked: Set[str] = set()
+    ended: List[DirectRoute] = []
+    for route in list(direct_routes.routes.values()):
+        if route.talker_id not in talker_ids:
+            continue
+        for listener_id in list(route.legs):
+            if not permission_engine.may_direct(route.talker_id, listener_id):
+                direct_routes.remove_leg(route, listener_id)
+                ducked.add(listener_id)
+        if not route.legs:
+            ended.append(direct_routes.end(route.id))
+    return ducked, ended
+
+
+async def apply_permissions(updates: Dict[str, ClientPermissions]) -> Set[str]:
+    """
+    Applies new permission matrices to one or more clients as a single change.
+
+    Every matrix is compiled and every revoked route torn down before the
+    first await, so no message handler ever sees a half-applied set. Then each
+    changed client gets one permissions_update, every other client one
+    clients_update covering all of them, and each PC that changed is
+    renegotiated once. Returns the IDs of the renegotiated clients.
+    """
+    changed = []
+    needs_renegotiation: Set[str] = set()
+    for client_id, permissions in updates.items():
+        client = active_clients.get(client_id)
+        if not client:
+            continue
+        client.permissions = permissions
+        revoked_talk, revoked_listen = permission_engine.compile(client_id, permissions)
+        needs_renegotiation |= apply_permission_revocations(client, revoked_talk, revoked_listen)
+        changed.append(client)
+    if not changed:
+        return set()
+    ducked, ended_routes = revoke_direct_legs({client.id for client in changed})
+
+    changed_ids = [client.id for client in changed]
+    for client in changed:
+        if client.websocket and client.status == ClientStatus.AUTHORIZED:
+            message = {
+                "type": "permissions_update",
+                "permissions": client.permissions.model_dump(),
+                "current_channel_id": client.current_channel_id,
+                "listening_channels": sorted(client.listening_channels),
+                "all_call_channels": sorted(client.all_call_channels),
+            }
+            # Fold the other changed clients into the same message rather than sending a clients_update too
+            peers = [other.public() for other in changed if other is not client and other.status == ClientStatus.AUTHORIZED]
+            if peers:
+                message["clients"] = peers
+            await notify_client(client.id, message)
+
+    others = [c for c in active_clients.values() if c.id not in changed_ids and c.status == ClientStatus.AUTHORIZED]
+    if others:
+        await notify_clients_update(changed_ids, others)
+
+    await notify_ducking(ducked)
+    for route in ended_routes:
+        await notify_client(route.talker_id, {"type": "direct_route_ended", "route_id": route.id, "reason": "permissions"})
+
+    # A revoked talk right can leave a client talking nowhere, which changes its codec profile
+    needs_renegotiation |= {client_id for client_id in changed_ids if codec_profiles.refresh(client_id)}
+    if needs_renegotiation:
+        logger.info(f"Permission change requires renegotiation for {len(needs_renegotiation)} clients")
+        await asyncio.gather(*(trigger_renegotiation(client_id) for client_id in needs_renegotiation))
+    return needs_renegotiation
+
+
+async def apply_codec_profiles(client_ids: Iterable[str]) -> Set[str]:
+    """
+    Re-resolves the codec profile of each client after a channel or override
+    change. Encoders sending to them switch on their next frame; clients whose
+    last SDP used another profile are renegotiated. Returns their IDs.
+    """
+    changed = {client_id for client_id in client_ids if codec_profiles.refresh(client_id)}
+    if changed:
+        await asyncio.gather(*(trigger_renegotiation(client_id) for client_id in changed))
+    return changed
+
+
+@dispatcher.register("offer", OfferMessage, lane=SIGNALING_LANE, rate=1.0, burst=5)
+async def handle_offer(ctx: ConnectionContext, message: OfferMessage):
+    client_id = ctx.client_id
+    client = ctx.client
+    if not client:
+        return
+
+    logger.info(f"Received offer from {client_id}")
+    received = time.perf_counter()
+    offer = RTCSessionDescription(sdp=message.sdp, type="offer")
+
+    # PC creation and SDP work is paced so a reconnect storm can't starve the loop;
+    # offers on a live PC go ahead of clients that still need a brand-new one
+    reusable = client.pc and client.pc.connectionState not in ("failed", "closed")
+    priority = PRIORITY_RENEGOTIATION if reusable else PRIORITY_NEW_PC
+    async with media_scheduler.slot(priority, queue_position_notifier(client_id, "media")):
+        warm = await apply_offer(client_id, client, offer)
+    # Includes time spent queued for a media setup slot, since the client waits for that too
+    pc_factory.record_answer(time.perf_counter() - received, warm)
+
+
+async def apply_offer(client_id: str, client: Client, offer: RTCSessionDescription) -> bool:
+    """
+    Creates or reuses the client's PC, applies its offer and sends back the answer.
+    Returns True unless a PC had to be built from scratch for this offer.
+    """
+    warm = True
+    # Check if we need to close an existing peer connection
+    if client.pc and (client.pc.connectionState == "failed" or client.pc.connectionState == "closed"):
+        logger.info(f"Closing existing failed/closed PeerConnection for {client_id} before creating a new one")
+        await resources.close_pc(client_id, client.pc)
+        if client_id in pcs:
+            del pcs[client_id]
+        client.pc = None
+
+    # Create new PC if needed
+    if not client.pc:
+        logger.info(f"Creating new PeerConnection for {client_id}")
+        if media_shards.assign(client_id) is None:
+            pc, warm = pc_factory.acquire()
+        else:
+            # Built on the client's shard so its sockets and tasks live there; the warm pool is gathered on this loop
+            pc, warm = await media_shards.call(client_id, pc_factory.create), False
+        pcs[client_id] = pc
+        client.pc = pc
+    else:
+        logger.info(f"Reusing existing PeerConnection for {client_id}")
+        pc = client.pc
+    resources.attach_pc(client_id, pc)
+
+    async def on_connectionstatechange():
+        logger.info(f"PC state for {client_id}: {pc.connectionState}")
+        if pc.connectionState == "failed" or pc.connectionState == "closed":
+            logger.warning(f"PC for {client_id} failed or closed unexpectedly.")
+            failed_client = active_clients.get(client_id)
+            if failed_client and session_manager.is_suspended(client_id):
+                # Media is gone too, so there is nothing left to resume
+                await session_manager.end(client_id)
+            elif failed_client:
+                # Notify client about the connection failure
+                await notify_client(client_id, {
+                    "type": "connection_status",
+                    "status": "failed",
+                    "message": "WebRTC connection failed. You may need to reconnect."
+                })
+                # Don't disconnect immediately, let the client attempt to reconnect
+            else:
+                await handle_disconnect(client_id)
+
+    async def on_track(track):
+        if track.kind == "audio":
+            logger.info(f"Audio track {track.id} received from {client_id}")
+            sender_client = active_clients.get(client_id)
+            if not sender_client:
+                logger.warning(f"Track received for unknown client {client_id}")
+                track.stop()
+                return
+
+            # Store the track on the client object
+            sender_client.audio_track = track
+            logger.info(f"Stored audio track {track.id} for client {client_id}")
+            replay_buffer.capture(client_id, pc, track)
+
+            # Add track to the listeners of every channel the client talks to, once each
+            talk_channels = sender_client.talk_channels()
+            if talk_channels:
+                logger.info(f"Client {client_id} talks to {talk_channels}, adding track to listeners")
+                listeners_needing_update = route_talker(sender_client, set(), talk_channels)
+                if listeners_needing_update:
+                    logger.info(f"Triggering renegotiation for {len(listeners_needing_update)} listeners after receiving track from {client_id}")
+                    for listener_id in listeners_needing_update:
+                        await trigger_renegotiation(listener_id)
+            else:
+                logger.info(f"Client {client_id} is not in any channel yet, track will be added to listeners when they join a channel")
+
+            async def on_track_ended():
+                logger.info(f"Track {track.id} from {client_id} ended, removing from listeners")
+                resources.off(client_id, track)
+                # Remove track from all listeners when it ends
+                listeners_needing_update = set()
+                for listener_id, listener_client in active_clients.items():
+                    if listener_id != client_id and listener_client.pc:
+                        try:
+                            if _remove_track(listener_client.pc, media_shards.bridge(track, client_id, listener_id)):
+                                listeners_needing_update.add(listener_id)
+                        except Exception as e:
+                            logger.error(f"Error removing ended track {track.id} from {listener_id}'s PC: {e}")
+
+                # Trigger renegotiation for affected listeners
+                if listeners_needing_update:
+                    for listener_id in listeners_needing_update:
+                        await trigger_renegotiation(listener_id)
+
+                # Direct routes carry copies of this track; they have nothing left to send
+                for route in direct_routes.routes_from(client_id):
+                    await end_direct_route(route.id, "track_ended")
+                media_shards.drop_track(track)
+
+            resources.on(client_id, track, "ended", on_track_ended)
+
+        elif track.kind == "video":
+            logger.info(f"Video track received from {client_id}, stopping as it is not supported.")
+            track.stop()
+
+    # Registered through the registry so an offer on a reused PC replaces these rather than adding more.
+    # PC events fire on the PC's shard; the registry hands them to the main loop, where signaling state lives.
+    resources.on(client_id, pc, "connectionstatechange", on_connectionstatechange)
+    resources.on(client_id, pc, "track", on_track)
+
+    async with get_negotiation_lock(client_id):
+        with codec_profiles.negotiating(client_id): # Senders started from here encode with the client's profile
+            await media_shards.run(client_id, pc.setRemoteDescription(offer))
+            await candidate_buffer.flush(client_id, pc) # Anything trickled before the offer was applied
+
+            answer = await media_shards.run(client_id, pc.createAnswer())
+            await media_shards.run(client_id, pc.setLocalDescription(answer))
+
+    answer_sdp = codec_profiles.munge(pc.localDescription.sdp, codec_profiles.for_sdp(client_id))
+    if udp_mux.running and udp_mux.ice_lite:
+        answer_sdp = advertise_ice_lite(answer_sdp)
+    answer_message = {
+        "type": "answer",
+        "sdp": answer_sdp,
+    }
+    logger.info(f"Sending answer to {client_id}")
+    await notify_client(client_id, answer_message)
+    return warm
+
+
+@dispatcher.register("answer", AnswerMessage, lane=SIGNALING_LANE, rate=2.0, burst=10)
+async def handle_answer(ctx: ConnectionContext, message: AnswerMessage):
+    client_id = ctx.client_id
+    answer = RTCSessionDescription(sdp=message.sdp, type="answer")
+    logger.info(f"Received answer from {client_id}")
+
+    client_obj = ctx.client
+    if not client_obj or not client_obj.pc:
+        logger.warning(f"Received answer from {client_id} but no client or PC found.")
+        # Notify client about the issue
+        await notify_client(client_id, {
+            "type": "error",
+            "message": "Server cannot process your answer: no active connection found."
+        })
+        return
+
+    pc = client_obj.pc
+    try:
+        async with media_scheduler.slot(PRIORITY_SIGNALING), get_negotiation_lock(client_id):
+            with codec_profiles.negotiating(client_id):
+                await media_shards.run(client_id, pc.setRemoteDescription(answer))
+        logger.info(f"Successfully set remote description (answer) for {client_id}")
+
+        # Notify client about successful connection
+        await notify_client(client_id, {
+            "type": "connection_status",
+            "status": "connected",
+            "message": "WebRTC connection established successfully."
+        })
+    except Exception as e:
+        logger.exception(f"Error setting remote description for {client_id} from answer: {e}", exc_info=e)
+        # Notify client about the error
+        await notify_client(client_id, {
+            "type": "error",
+            "message": f"Failed to process your answer: {str(e)}"
+        })
+
+
+async def receive_candidates(ctx: ConnectionContext, payloads: List[IceCandidatePayload]):
+    """ Parses trickled candidates and applies them, or buffers them until the client's offer is in. """
+    client_obj = ctx.client
+    if not client_obj:
+        return
+    candidates = []
+    for payload in payloads:
+        if not payload.candidate:
+            continue # End-of-candidates marker
+        if payload.sdpMid is None and payload.sdpMLineIndex is None:
+            candidate_buffer.malformed += 1
+            continue
+        try:
+            candidates.append(parse_candidate(payload.candidate, payload.sdpMid, payload.sdpMLineIndex))
+        except ValueError as e:
+            candidate_buffer.malformed += 1
+            logger.debug(f"Ignoring ICE candidate from {ctx.client_id}: {e}", extra={"subsystem": "ice"})
+    if candidates:
+        await candidate_buffer.add(ctx.client_id, client_obj.pc, candidates)
+
+
+@dispatcher.register("candidate", CandidateMessage, lane=SIGNALING_LANE, rate=20.0, burst=50)
+async def handle_candidate(ctx: ConnectionContext, message: CandidateMessage):
+    if message.candidate:
+        await receive_candidates(ctx, [message.candidate])
+
+
+@dispatcher.register("candidates", CandidatesMessage, lane=SIGNALING_LANE, rate=5.0, burst=20)
+async def handle_candidates(ctx: ConnectionContext, message: CandidatesMessage):
+    candidate_buffer.batches += 1
+    await receive_candidates(ctx, message.candidates)
+
+
+@dispatcher.register("join_channel", JoinChannelMessage, lane=ROUTING_LANE, rate=1.0, burst=5)
+async def handle_join_channel(ctx: ConnectionContext, message: JoinChannelMessage):
+    client_id = ctx.client_id
+    channel_id = message.channel_id
+
+    joining_client = ctx.client
+    if not joining_client:
+        logger.error(f"Critical: Client {client_id} not found in active_clients during join_channel.")
+        return
+
+    logger.info(f"Client {client_id} attempting to join channel {channel_id}")
+    if not permission_engine.may_talk(client_id, channel_id):
+        logger.warning(f"Client {client_id} is not permitted to talk in channel {channel_id}. Join refused.")
+        await notify_client(client_id, {"type": "error", "message": f"You are not permitted to talk in channel '{channel_id}'."})
+        return
+
+    # --- Update Client State --- #
+    old_talk_channels = joining_client.talk_channels()
+    joining_client.current_channel_id = channel_id
+
+    # Add the channel to listening channels if not already there (and allowed)
+    if channel_id not in joining_client.listening_channels and permission_engine.may_listen(client_id, channel_id):
+        joining_client.listening_channels.add(channel_id)
+        logger.info(f"Added {channel_id} to client {client_id}'s listening channels")
+
+    # --- WebRTC Track Handling --- #
+    # 1. Move the joining client's track from the old channel's listeners to the new one's.
+    # Listeners of both keep their sender; during an all-call nothing moves at all.
+    listeners_needing_update = route_talker(joining_client, old_talk_channels, joining_client.talk_channels())
+
+    # 2. Add existing clients' tracks from the new channel to the joining client
+    if joining_client.pc and channel_id in joining_client.listening_channels:
+        logger.debug(f"Adding existing tracks from channel {channel_id} to joining client {client_id}")
+        for existing_id, existing_client in active_clients.items():
+            if (existing_id != client_id and
+                existing_client.status == ClientStatus.AUTHORIZED and
+                existing_client.audio_track and
+                channel_id in existing_client.talk_channels()):
+
+                if _sender_for(joining_client.pc, _carrying(existing_client, joining_client)) is None:
+                    logger.info(f"Adding existing track from {existing_id} to joining client {client_id}")
+                    try:
+                        joining_client.pc.addTrack(_carrying(existing_client, joining_client))
+                        # Add joining client to renegotiation list
+                        listeners_needing_update.add(client_id)
+                    except Exception as e:
+                        logger.error(f"Error adding existing track from {existing_id} to joining client {client_id}: {e}")
+
+    # Notify the client they successfully joined
+    await notify_client(client_id, {"type": "channel_joined", "channel_id": channel_id})
+
+    # The new channel may use another codec profile; the client's uplink only follows after a renegotiation
+    if codec_profiles.refresh(client_id) and joining_client.pc:
+        listeners_needing_update.add(client_id)
+
+    # Trigger renegotiation for all affected listeners including the joining client
+    if listeners_needing_update:
+        logger.info(f"Listeners needing renegotiation after {client_id} joined {channel_id}: {listeners_needing_update}")
+        for listener_id in listeners_needing_update:
+            await trigger_renegotiation(listener_id)
+
+
+@dispatcher.register("replay", ReplayMessage, lane=ROUTING_LANE, rate=0.2, burst=2)
+async def handle_replay(ctx: ConnectionContext, message: ReplayMessage):
+    """ Plays the last seconds of a channel back to the requester on extra tracks; live routes are untouched. """
+    client_id = ctx.client_id
+    channel_id = message.channel_id
+    client = ctx.client
+    if not client or not client.pc:
+        await notify_client(client_id, {"type": "error", "message": "Replay needs an established audio connection."})
+        return
+    if channel_id not in known_channel_ids():
+        await notify_client(client_id, {"type": "error", "message": f"Channel {channel_id} not found."})
+        return
+    if not permission_engine.may_listen(client_id, channel_id):
+        await notify_client(client_id, {"type": "error", "message": f"You are not permitted to listen to: {channel_id}"})
+        return
+    if client_id in replay_buffer.sessions:
+        await notify_client(client_id, {"type": "error", "message": "A replay is already playing."})
+        return
+
+    session = replay_buffer.open(client_id, channel_id, message.seconds, finish_replay)
+    if session is None:
+        await notify_client(client_id, {"type": "error", "message": "Nothing to replay on this channel."})
+        return
+    for track in session.tracks:
+        resources.own(client_id, track)
+        session.senders.append(client.pc.addTrack(track))
+    logger.info(f"Replaying {session.seconds:.1f}s of channel {channel_id} to {client_id} on {len(session.tracks)} tracks")
+    await notify_client(client_id, {
+        "type": "replay_started",
+        "channel_id": channel_id,
+        "seconds": round(session.seconds, 1),
+        "tracks": [{"track_id": track.id, "talker_id": track.talker_id} for track in session.tracks],
+    })
+    await trigger_renegotiation(client_id)
+
+
+async def finish_replay(session: ReplaySession):
+    """ Called once a replay has played out: frees its transceivers for reuse and renegotiates. """
+    client = active_clients.get(session.client_id)
+    live = client is not None and client.pc is not None and client.pc.connectionState != "closed"
+    if live:
+        for sender in session.senders:
+            release_sender(client.pc, sender)
+    replay_buffer.close(session)
+    if live:
+        await notify_client(session.client_id, {"type": "replay_ended", "channel_id": session.channel_id})
+        await trigger_renegotiation(session.client_id)
+
+
+def open_direct_leg(talker: Client, listener: Client) -> DirectLeg:
+    """
+    Starts carrying `talker` to `listener` for a direct route. Reuses a sender
+    already carrying the talker (a shared channel) or a parked one, so only a
+    leg that had to add a new sender needs renegotiating.
+    """
+    carried = _carrying(talker, listener)
+    for sender in listener.pc.getSenders():
+        if sender.track is carried:
+            return DirectLeg(listener.id, sender, None, fast=True)
+    track = DirectTrack(relay, carried)
+    resources.own(listener.id, track)
+    sender = direct_routes.take_parked(listener.id, listener.pc)
+    if sender is not None:
+        sender.replaceTrack(track) # Negotiated for sending already: live on the next frame
+        return DirectLeg(listener.id, sender, track, fast=True)
+    return DirectLeg(listener.id, listener.pc.addTrack(track), track, fast=False)
+
+
+async def end_direct_route(route_id: str, reason: str) -> Optional[DirectRoute]:
+    route = direct_routes.routes.get(route_id)
+    if route is None:
+        return None
+    listeners = list(route.legs)
+    direct_routes.end(route_id)
+    await notify_ducking(listeners)
+    await notify_client(route.talker_id, {"type": "direct_route_ended", "route_id": route.id, "reason": reason})
+    return route
+
+
+@dispatcher.register("direct_route_start", DirectRouteStartMessage, lane=ROUTING_LANE, rate=2.0, burst=5)
+async def handle_direct_route_start(ctx: ConnectionContext, message: DirectRouteStartMessage):
+    """ Opens a private (IFB) route from the sender to specific clients and ducks their other audio. """
+    started = time.perf_counter()
+    talker = ctx.client
+    if not talker or not talker.audio_track:
+        await notify_client(ctx.client_id, {"type": "error", "message": "Private routes need your audio to be connected."})
+        return
+
+    listeners: List[Client] = []
+    denied: List[str] = []
+    for target_id in dict.fromkeys(message.target_ids):
+        target = active_clients.get(target_id)
+        if (target_id == talker.id or not target or target.status != ClientStatus.AUTHORIZED or not target.pc
+                or not permission_engine.may_direct(talker.id, target_id)):
+            denied.append(target_id)
+        elif any(route.talker_id == talker.id for route in direct_routes.routes_to(target_id)):
+            denied.append(target_id) # Already talking to them
+        else:
+            listeners.append(target)
+    if not listeners:
+        await notify_client(talker.id, {"type": "error", "message": f"Cannot open a private route to: {', '.join(denied)}"})
+        return
+
+    duck_gain = message.duck_gain if message.duck_gain is not None else config.DIRECT_DUCK_GAIN
+    route = DirectRoute(id=uuid.uuid4().hex[:12], talker_id=talker.id, duck_gain=duck_gain)
+    for listener in listeners:
+        route.legs[listener.id] = open_direct_leg(talker, listener)
+    direct_routes.add(route)
+    direct_routes.record_setup(time.perf_counter() - started)
+    logger.info(f"Direct route {route.id} from {talker.id} to {sorted(route.legs)}")
+
+    await notify_client(talker.id, {
+        "type": "direct_route_started",
+        "route_id": route.id,
+        "target_ids": list(route.legs),
+        "denied": denied,
+    })
+    await notify_ducking(route.legs)
+    renegotiate = [leg.listener_id for leg in route.legs.values() if not leg.fast]
+    if renegotiate:
+        await asyncio.gather(*(trigger_renegotiation(listener_id) for listener_id in renegotiate))
+
+
+@dispatcher.register("direct_route_stop", DirectRouteStopMessage, lane=ROUTING_LANE, rate=2.0, burst=5)
+async def handle_direct_route_stop(ctx: ConnectionContext, message: DirectRouteStopMessage):
+    routes = direct_routes.routes_from(ctx.client_id)
+    if message.route_id is not None:
+        routes = [route for route in routes if route.id == message.route_id]
+    for route in routes:
+        await end_direct_route(route.id, "stopped")
+
+
+@dispatcher.register("all_call_start", AllCallStartMessage, lane=ROUTING_LANE, rate=1.0, burst=5)
+async def handle_all_call_start(ctx: ConnectionContext, message: AllCallStartMessage):
+    """
+    Talks to a set of channels at once (a channel group, explicit channels,
+    or both) until all_call_stop. Listeners monitoring several of them get
+    the talker once, and only PCs whose set of talkers changed renegotiate.
+    """
+    client = ctx.client
+    if not client:
+        return
+    requested: List[str] = []
+    if message.group_id is not None:
+        group = store.groups.get(message.group_id)
+        if group is None:
+            await notify_client(client.id, {"type": "error", "message": f"Channel group {message.group_id} not found."})
+            return
+        requested.extend(group.channel_ids)
+    requested.extend(message.channel_ids or [])
+    if not requested:
+        await notify_client(client.id, {"type": "error", "message": "An all-call needs a channel group or channels to talk to."})
+        return
+
+    known = known_channel_ids()
+    targets = {channel_id for channel_id in requested if channel_id in known and permission_engine.may_talk(client.id, channel_id)}
+    denied = sorted(set(requested) - targets)
+    if not targets:
+        await notify_client(client.id, {"type": "error", "message": f"You are not permitted to talk in any of: {', '.join(denied)}"})
+        return
+
+    old_talk_channels = client.talk_channels()
+    client.all_call_channels = targets
+    listeners_needing_update = route_talker(client, old_talk_channels, targets)
+    reached = len(hearers(client, targets))
+    logger.info(f"All-call from {client.id} to {len(targets)} channels reaches {reached} listeners; "
+                f"{len(listeners_needing_update)} PCs changed")
+    await notify_client(client.id, {
+        "type": "all_call_started",
+        "group_id": message.group_id,
+        "channel_ids": sorted(targets),
+        "denied": denied,
+        "listeners": reached,
+    })
+    if listeners_needing_update:
+        await asyncio.gather(*(trigger_renegotiation(listener_id) for listener_id in listeners_needing_update))
+
+
+@dispatcher.register("all_call_stop", AllCallStopMessage, lane=ROUTING_LANE, rate=1.0, burst=5)
+async def handle_all_call_stop(ctx: ConnectionContext, message: AllCallStopMessage):
+    """ Ends the sender's all-call; its audio goes back to its current channel only. """
+    client = ctx.client
+    if not client or not client.all_call_channels:
+        return
+    old_talk_channels = client.all_call_channels
+    client.all_call_channels = set()
+    listeners_needing_update = route_talker(client, old_talk_channels, client.talk_channels())
+    await notify_client(client.id, {"type": "all_call_ended", "current_channel_id": client.current_channel_id})
+    if listeners_needing_update:
+        await asyncio.gather(*(trigger_renegotiation(listener_id) for listener_id in listeners_needing_update))
+
+
+async def forget_channel(channel_id: str):
+    """
+    Drops a removed channel from channel groups and from active all-calls.
+    A group left without channels is deleted, since a group needs at least one.
+    """
+    removed_groups: List[str] = []
+    for group in list(store.groups.values()):
+        if channel_id in group.channel_ids:
+            remaining = [cid for cid in group.channel_ids if cid != channel_id]
+            if remaining:
+                # model_copy skips validation, so the rules ChannelGroup is loaded with must hold here
+                store.save_group(group.model_copy(update={"channel_ids": remaining}))
+            else:
+                store.delete_group(group.id)
+                removed_groups.append(group.id)
+                logger.info(f"Deleted channel group {group.id} ({group.name}): its last channel {channel_id} was removed")
+    listeners_needing_update: Set[str] = set()
+    for client in list(active_clients.values()):
+        if channel_id in client.all_call_channels:
+            old_talk_channels = client.all_call_channels
+            client.all_call_channels = old_talk_channels - {channel_id}
+            listeners_needing_update |= route_talker(client, old_talk_channels, client.talk_channels())
+            if not client.all_call_channels:
+                await notify_client(client.id, {
+                    "type": "all_call_ended",
+                    "current_channel_id": client.current_channel_id,
+                    "removed_group_ids": removed_groups, # Groups that went with the channel; the talker may have called one
+                })
+    if listeners_needing_update:
+        await asyncio.gather(*(trigger_renegotiation(listener_id) for listener_id in listeners_needing_update))
+
+
+@dispatcher.register("echo", EchoMessage, rate=1.0, burst=5)
+async def handle_echo(ctx: ConnectionContext, message: EchoMessage):
+    await notify_client(ctx.client_id, {"type": "echo", "message": f"Authorized message received: {message.model_dump()}"})
+
+
+@dispatcher.register("update_listen_channels", UpdateListenChannelsMessage, lane=ROUTING_LANE, rate=2.0, burst=10)
+async def handle_update_listen_channels(ctx: ConnectionContext, message: UpdateListenChannelsMessage):
+    client_id = ctx.client_id
+    channel_ids = message.channel_ids
+
+    # Validate channel IDs (optional but recommended)
+    known_ids = known_channel_ids()
+    valid_channel_ids = {cid for cid in channel_ids if cid in known_ids}
+    if len(valid_channel_ids) != len(channel_ids):
+        logger.warning(f"Client {client_id} provided some invalid channel IDs in update_listen_channels.")
+        # Decide whether to proceed with valid ones or reject
+    permitted_channel_ids = permission_engine.listenable(client_id, valid_channel_ids)
+    if permitted_channel_ids != valid_channel_ids:
+        denied = sorted(valid_channel_ids - permitted_channel_ids)
+        logger.warning(f"Client {client_id} is not permitted to listen to {denied}; ignoring them.")
+        await notify_client(client_id, {"type": "error", "message": f"You are not permitted to listen to: {', '.join(denied)}"})
+
+    listener_client = ctx.client
+    if not listener_client or not listener_client.pc:
+        logger.warning(f"Cannot update tracks for {client_id}, client or PC not found.")
+        return
+
+    old_listening_channels = set(listener_client.listening_channels) # Copy old set
+    new_listening_channels = permitted_channel_ids
+
+    # Update the client state *after* getting the old set
+    listener_client.listening_channels = new_listening_channels
+    logger.info(f"Client {client_id} updated listening channels from {old_listening_channels} to {new_listening_channels}")
+
+    channels_to_add = new_listening_channels - old_listening_channels
+    channels_to_remove = old_listening_channels - new_listening_channels
+
+    tracks_changed = False
+
+    # Add tracks for newly listened channels
+    if channels_to_add:
+        logger.debug(f"Client {client_id} started listening to: {channels_to_add}")
+        for talker_id, talker_client in active_clients.items():
+            # Check if talker is different, authorized, has a track, and talks to a channel we just started listening to
+            if (talker_id != client_id and
+                talker_client.status == ClientStatus.AUTHORIZED and
+                talker_client.audio_track and
+                not talker_client.talk_channels().isdisjoint(channels_to_add) and
+                _sender_for(listener_client.pc, _carrying(talker_client, listener_client)) is None): # Already heard through another channel
+
+                logger.info(f"Adding track {talker_client.audio_track.id} from {talker_id} (channels {talker_client.talk_channels()}) to {client_id}")
+                try:
+                    listener_client.pc.addTrack(_carrying(talker_client, listener_client))
+                    tracks_changed = True
+                except Exception as e:
+                    logger.error(f"Error adding track {talker_client.audio_track.id} to {client_id}'s PC: {e}")
+
+    # Remove tracks for stopped listening channels
+    if channels_to_remove:
+        logger.debug(f"Client {client_id} stopped listening to: {channels_to_remove}")
+        for talker_id, talker_client in active_clients.items():
+            talk_channels = talker_client.talk_channels()
+            # Only if none of the channels we still listen to carries the talker
+            if (talker_id != client_id and talker_client.audio_track and
+                    not talk_channels.isdisjoint(channels_to_remove) and talk_channels.isdisjoint(new_listening_channels)):
+                logger.info(f"Removing track {talker_client.audio_track.id} (from {talker_id}, channels {talk_channels}) from {client_id}")
+                try:
+                    if _remove_track(listener_client.pc, _carrying(talker_client, listener_client)):
+                        tracks_changed = True
+                except Exception as e:
+                    logger.error(f"Error removing track {talker_client.audio_track.id} from {client_id}'s PC: {e}")
+
+    if tracks_changed:
+        logger.info(f"Tracks changed for {client_id}. Renegotiation required.")
+        await trigger_renegotiation(client_id)
+
+
+@dispatcher.register("pong", PongMessage, lane=HEARTBEAT_LANE, rate=2.0, burst=5)
+async def handle_pong(ctx: ConnectionContext, message: PongMessage):
+    heartbeat.pong(ctx.client_id, message.seq)
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+from . import config
+from ..models.client import ClientStatus
+from .state import active_clients, notify_client, handle_disconnect
+from .sessions import session_manager
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel. Time is divided into `tick`-second slots arranged in
+    a ring of `slots`; a timer lands in slot (cursor + ticks) % slots with a
+    round count for delays longer than one revolution. Scheduling, rescheduling
+    and cancelling are O(1) dict operations, and each tick only touches the
+    timers in one slot, no matter how many clients are tracked.
+    """
+
+    def __init__(self, tick: float, slots: int):
+        self.tick = tick
+        self.slots: List[Dict[Hashable, int]] = [dict() for _ in range(slots)] # key -> remaining rounds
+        self.cursor = 0
+        self._index: Dict[Hashable, int] = {} # key -> slot it currently lives in
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._index
+
+    def schedule(self, key: Hashable, delay: float):
+        """ (Re)schedules `key` to expire after `delay` seconds, replacing any existing timer. """
+        self.cancel(key)
+        ticks = max(1, int(round(delay / self.tick)))
+        rounds, offset = divmod(ticks, len(self.slots))
+        if offset == 0:
+            rounds, offset = rounds - 1, len(self.slots)
+        slot = (self.cursor + offset) % len(self.slots)
+        self.slots[slot][key] = rounds
+        self._index[key] = slot
+
+    def cancel(self, key: Hashable):
+        slot = self._index.pop(key, None)
+        if slot is not None:
+            self.slots[slot].pop(key, None)
+
+    def advance(self) -> List[Hashable]:
+        """ Moves the cursor one tick and returns the keys that expired. """
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        bucket = self.slots[self.cursor]
+        expired = []
+        for key, rounds in list(bucket.items()):
+            if rounds > 0:
+                bucket[key] = rounds - 1
+            else:
+                del bucket[key]
+                del self._index[key]
+                expired.append(key)
+        return expired
+
+
+class HeartbeatMonitor:
+    """
+    Application-level ping/pong for client WebSockets.
+
+    Two timing wheels are driven by a single task: one schedules each client's
+    next ping (spreading pings evenly instead of bursting them), the other
+    holds each client's liveness deadline, pushed back by every pong or
+    inbound message. Clients whose deadline passes are evicted in batches so
+    half-dead sockets stop stalling broadcast fan-out.
+
+    Pings go out as tasks of their own with a send timeout: a socket whose
+    send buffer is full blocks only its own ping, never the other pings of
+    the tick or the eviction that will eventually remove it.
+    """
+
+    def __init__(self, interval: float, timeout: float, tick: float, slots: int, evict_batch: int, send_timeout: float):
+        self.interval = interval
+        self.timeout = timeout
+        self.evict_batch = evict_batch
+        self.send_timeout = send_timeout
+        self._pings = TimingWheel(tick, slots)
+        self._deadlines = TimingWheel(tick, slots)
+        self._outstanding: Dict[str, Tuple[int, float]] = {} # client_id -> (seq, monotonic send time)
+        self._evict_backlog: List[str] = []
+        self._seq = 0
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set() # Pings still being written to their sockets
+        self.rtt_ms: Dict[str, float] = {}
+        self.pings_sent = 0
+        self.pongs_received = 0
+        self.evicted_total = 0
+        self.ping_timeouts = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in list(self._sending):
+            task.cancel()
+
+    def track(self, client_id: str):
+        """ Starts pinging a client and arms its liveness deadline. """
+        # Stagger the first ping across the interval so simultaneous joins don't ping in lockstep
+        self._pings.schedule(client_id, self.interval * (0.5 + (hash(client_id) % 1000) / 2000))
+        self._deadlines.schedule(client_id, self.timeout)
+
+    def untrack(self, client_id: str):
+        self._pings.cancel(client_id)
+        self._deadlines.cancel(client_id)
+        self._outstanding.pop(client_id, None)
+        self.rtt_ms.pop(client_id, None)
+
+    def touch(self, client_id: str):
+        """ Any sign of life from the client pushes its deadline back. O(1). """
+        if client_id in self._deadlines:
+            self._deadlines.schedule(client_id, self.timeout)
+
+    def pong(self, client_id: str, seq: Optional[int]):
+        self.pongs_received += 1
+        sent = self._outstanding.get(client_id)
+        if sent and sent[0] == seq:
+            del self._outstanding[client_id]
+            rtt = (time.monotonic() - sent[1]) * 1000
+            # Smooth like TCP's SRTT so one delayed pong doesn't dominate
+            previous = self.rtt_ms.get(client_id)
+            self.rtt_ms[client_id] = rtt if previous is None else previous * 0.875 + rtt * 0.125
+            client = active_clients.get(client_id)
+            if client:
+                client.rtt_ms = round(self.rtt_ms[client_id], 1)
+        self.touch(client_id)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        tick = self._pings.tick
+        next_tick = loop.time() + tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            # Catch up on every tick that elapsed, even if the loop was stalled
+            due_pings: List[str] = []
+            while next_tick <= loop.time():
+                due_pings.extend(self._pings.advance())
+                self._evict_backlog.extend(self._deadlines.advance())
+                next_tick += tick
+            for client_id in due_pings:
+                task = loop.create_task(self._send_ping(client_id))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+            if self._evict_backlog:
+                batch = self._evict_backlog[:self.evict_batch]
+                del self._evict_backlog[:self.evict_batch]
+                await self._evict(batch)
+
+    async def _send_ping(self, client_id: str):
+        client = active_clients.get(client_id)
+        if not client or not client.websocket or client.status != ClientStatus.AUTHORIZED:
+            return # Gone or suspended; untracked or re-tracked on resume
+        self._seq += 1
+        self._outstanding[client_id] = (self._seq, time.monotonic())
+        self.pings_sent += 1
+        try:
+            message = {"type": "ping", "seq": self._seq, "ts": int(time.time() * 1000)}
+            await asyncio.wait_for(notify_client(client_id, message), timeout=self.send_timeout)
+        except asyncio.TimeoutError:
+            self.ping_timeouts += 1 # Its deadline will run out unless something else gets through
+            logger.warning(f"Ping to {client_id} not sent within {self.send_timeout:.1f}s")
+        if client_id in self._deadlines: # Not evicted or untracked while the ping was in flight
+            self._pings.schedule(client_id, self.interval)
+
+    async def _evict(self, client_ids: List[str]):
+        to_disconnect = []
+        for client_id in client_ids:
+            self._outstanding.pop(client_id, None)
+            self.rtt_ms.pop(client_id, None)
+            self._pings.cancel(client_id)
+            client = active_clients.get(client_id)
+            if not client or not client.websocket:
+                continue
+            logger.warning(f"Client {client_id} missed heartbeats for {self.timeout:.0f}s. Evicting stale connection.")
+            self.evicted_total += 1
+            websocket = client.websocket
+            # Keep the session resumable if its media path may still be alive
+            if not session_manager.suspend(client):
+                to_disconnect.append(client_id)
+            # Closing a half-dead socket can block; don't let it hold up the batch
+            asyncio.get_running_loop().create_task(self._close_quietly(websocket))
+        if to_disconnect:
+            await asyncio.gather(*(handle_disconnect(client_id) for client_id in to_disconnect), return_exceptions=True)
+
+    @staticmethod
+    async def _close_quietly(websocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=1001, reason="Heartbeat timeout"), timeout=5.0)
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, object]:
+        rtts = list(self.rtt_ms.values())
+        return {
+            "interval": self.interval,
+            "timeout": self.timeout,
+            "tracked": len(self._deadlines),
+            "pings_sent": self.pings_sent,
+            "pongs_received": self.pongs_received,
+            "evicted_total": self.evicted_total,
+            "evict_backlog": len(self._evict_backlog),
+            "pings_in_flight": len(self._sending),
+            "ping_timeouts": self.ping_timeouts,
+            "avg_rtt_ms": round(sum(rtts) / len(rtts), 1) if rtts else None,
+            "max_rtt_ms": round(max(rtts), 1) if rtts else None,
+        }
+
+
+heartbeat = HeartbeatMonitor(
+    interval=config.HEARTBEAT_INTERVAL,
+    timeout=config.HEARTBEAT_TIMEOUT,
+    tick=config.HEARTBEAT_TICK,
+    slots=config.HEARTBEAT_WHEEL_SLOTS,
+    evict_batch=config.HEARTBEAT_EVICT_BATCH,
+    send_timeout=config.HEARTBEAT_SEND_TIMEOUT,
+)
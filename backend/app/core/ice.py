@@ -0,0 +1,116 @@
+import logging
+import re
+from typing import Dict, List, Optional
+
+from aiortc import RTCPeerConnection, RTCIceCandidate
+
+from .shards import media_shards
+
+logger = logging.getLogger(__name__)
+
+MAX_BUFFERED_CANDIDATES = 64 # Per client; a browser rarely gathers more than a couple of dozen
+
+# candidate:<foundation> <component> <transport> <priority> <address> <port> typ <type> [<name> <value>]...
+_CANDIDATE_RE = re.compile(
+    r"^(?:a=)?candidate:(?P<foundation>\S+) (?P<component>\d+) (?P<protocol>\S+) (?P<priority>\d+) "
+    r"(?P<ip>\S+) (?P<port>\d+) typ (?P<type>\S+)(?P<extensions>(?: \S+ \S+)*)\s*$"
+)
+
+
+def parse_candidate(sdp: str, sdp_mid: Optional[str], sdp_mline_index: Optional[int]) -> RTCIceCandidate:
+    """
+    Parses an a=candidate line as sent by browsers (RFC 8839), including the
+    raddr/rport of reflexive and relay candidates and the tcptype of TCP
+    ones. Unknown extensions (generation, ufrag, network-id...) are ignored.
+    Raises ValueError if the line is malformed.
+    """
+    match = _CANDIDATE_RE.match(sdp)
+    if match is None:
+        raise ValueError(f"Malformed ICE candidate: {sdp[:120]!r}")
+    extensions = match.group("extensions").split()
+    options = dict(zip(extensions[0::2], extensions[1::2]))
+    rport = options.get("rport")
+    return RTCIceCandidate(
+        component=int(match.group("component")),
+        foundation=match.group("foundation"),
+        ip=match.group("ip"),
+        port=int(match.group("port")),
+        priority=int(match.group("priority")),
+        protocol=match.group("protocol").lower(),
+        type=match.group("type"),
+        relatedAddress=options.get("raddr"),
+        relatedPort=int(rport) if rport and rport.isdigit() else None,
+        tcpType=options.get("tcptype"),
+        sdpMid=sdp_mid,
+        sdpMLineIndex=sdp_mline_index,
+    )
+
+
+class CandidateBuffer:
+    """
+    Holds remote ICE candidates that arrive before they can be applied.
+
+    aiortc silently drops candidates for a PC that has no remote description
+    yet, so anything trickled before (or while) the client's offer is being
+    processed is kept here and applied in one go once it has been set.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._pending: Dict[str, List[RTCIceCandidate]] = {}
+        self.received = 0
+        self.applied = 0
+        self.buffered = 0
+        self.malformed = 0
+        self.dropped = 0
+        self.batches = 0
+
+    @staticmethod
+    def ready(pc: Optional[RTCPeerConnection]) -> bool:
+        return pc is not None and pc.remoteDescription is not None
+
+    async def add(self, client_id: str, pc: Optional[RTCPeerConnection], candidates: List[RTCIceCandidate]):
+        """ Applies candidates now if the PC can take them, otherwise buffers them. """
+        self.received += len(candidates)
+        if not self.ready(pc):
+            pending = self._pending.setdefault(client_id, [])
+            room = self.limit - len(pending)
+            if room < len(candidates):
+                self.dropped += len(candidates) - max(room, 0)
+            pending.extend(candidates[:max(room, 0)])
+            self.buffered += min(len(candidates), max(room, 0))
+            return
+        await self._apply(client_id, pc, candidates)
+
+    async def flush(self, client_id: str, pc: RTCPeerConnection):
+        """ Applies everything buffered for a client; called once its remote description is set. """
+        pending = self._pending.pop(client_id, None)
+        if pending:
+            logger.debug(f"Applying {len(pending)} buffered ICE candidates for {client_id}", extra={"subsystem": "ice"})
+            await self._apply(client_id, pc, pending)
+
+    async def _apply(self, client_id: str, pc: RTCPeerConnection, candidates: List[RTCIceCandidate]):
+        for candidate in candidates:
+            try:
+                await media_shards.run(client_id, pc.addIceCandidate(candidate))
+                self.applied += 1
+            except Exception as e:
+                self.malformed += 1
+                logger.debug(f"Could not add ICE candidate for {client_id}: {e}", extra={"subsystem": "ice"})
+
+    def forget(self, client_id: str):
+        self._pending.pop(client_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "received": self.received,
+            "applied": self.applied,
+            "buffered": self.buffered,
+            "waiting": sum(len(pending) for pending in self._pending.values()),
+            "malformed": self.malformed,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
+
+
+candidate_buffer = CandidateBuffer(limit=MAX_BUFFERED_CANDIDATES)
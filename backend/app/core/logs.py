@@ -0,0 +1,275 @@
+"""
+Logging pipeline for the SoundMesh backend.
+
+The event loop that runs signaling also carries RTP, so it should not pay for
+formatting log records or for writing them out. Records are handed to a
+bounded in-memory queue by a QueueHandler and formatted and written by a
+QueueListener thread. On the loop, a record costs a sampling check, a context
+lookup and a queue put. When the queue is full the record is dropped and
+counted rather than blocking the loop.
+
+On the writer thread, records come out as one JSON object per line (or as
+plain text), tagged with the client and channel they concern. SDP bodies and
+secrets (passwords, resume tokens) are redacted, and long messages are
+truncated. Chatty subsystems (ICE, presence) are rate-sampled per subsystem,
+and the next record that gets through says how many were skipped.
+"""
+import contextvars
+import json
+import logging
+import queue
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Iterator, Optional, Tuple
+
+from . import config
+
+# Context the emitting code runs in; tasks inherit it from whoever created them
+log_client_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("log_client_id", default=None)
+log_channel_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("log_channel_id", default=None)
+
+# SDP in a log message is usually inside a repr'd or JSON-encoded dict, so its line breaks are escaped
+_SDP_RE = re.compile(r"v=0(?:\\r\\n|\\n|\r\n|\n)o=.*?(?=['\"]|\Z)", re.S)
+# Quoted values are matched whole (spaces, commas and escaped quotes included); unquoted ones up to a delimiter
+_SECRET_RE = re.compile(
+    r"""(['"]?(?:password|resume_token|token)['"]?\s*[:=]\s*)("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[^'",}\s]+)""",
+    re.I,
+)
+
+
+def bind(client_id: Optional[str] = None, channel_id: Optional[str] = None):
+    """ Tags every record logged from the current task (and tasks it creates from now on). """
+    if client_id is not None:
+        log_client_id.set(client_id)
+    if channel_id is not None:
+        log_channel_id.set(channel_id)
+
+
+@contextmanager
+def log_context(client_id: Optional[str] = None, channel_id: Optional[str] = None) -> Iterator[None]:
+    """ Like bind(), but only for the duration of the block. """
+    tokens = []
+    if client_id is not None:
+        tokens.append((log_client_id, log_client_id.set(client_id)))
+    if channel_id is not None:
+        tokens.append((log_channel_id, log_channel_id.set(channel_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def _mask_secret(match: re.Match) -> str:
+    value = match.group(2)
+    quote = value[0] if value[0] in "'\"" else ""
+    return f"{match.group(1)}{quote}***{quote}"
+
+
+def redact(message: str, limit: int) -> str:
+    """ Replaces SDP bodies and secrets, then truncates to `limit` characters. """
+    if "v=0" in message:
+        message = _SDP_RE.sub(lambda match: f"<sdp {len(match.group(0))} chars>", message)
+    message = _SECRET_RE.sub(_mask_secret, message)
+    if len(message) > limit:
+        message = f"{message[:limit]}... [{len(message) - limit} chars truncated]"
+    return message
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record, with client/channel context and sampling counts when present. """
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage(), self.limit),
+        }
+        for key in ("client_id", "channel_id", "subsystem", "sampled_out"):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = redact(self.formatException(record.exc_info), self.limit * 4)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """ The classic "LEVEL:logger:message" line, redacted, with the client in brackets when known. """
+
+    def __init__(self, limit: int):
+        super().__init__("%(levelname)s:%(name)s:%(message)s")
+        self.limit = limit
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = redact(record.message, self.limit)
+        line = super().formatMessage(record)
+        client_id = getattr(record, "client_id", None)
+        sampled_out = getattr(record, "sampled_out", None)
+        if client_id:
+            line = f"{line} [{client_id}]"
+        if sampled_out:
+            line = f"{line} (+{sampled_out} similar sampled out)"
+        return line
+
+
+class SubsystemSampler:
+    """
+    Token bucket per subsystem for records below WARNING. A record's
+    subsystem is its `subsystem` extra if it has one, otherwise its logger
+    name. Subsystems without a configured rate are never sampled. Records
+    come from the media shard threads too, so the buckets are locked.
+    """
+
+    def __init__(self, rates: Dict[str, Tuple[float, float]]):
+        self.rates = rates
+        self._buckets: Dict[str, Tuple[float, float]] = {} # subsystem -> (tokens, last refill)
+        self._skipped: Dict[str, int] = {}
+        self.sampled_out: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = getattr(record, "subsystem", None) or record.name
+        spec = self.rates.get(key)
+        if spec is None:
+            return True
+        rate, burst = spec
+        with self._lock:
+            now = time.monotonic()
+            tokens, last = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self._skipped[key] = self._skipped.get(key, 0) + 1
+                self.sampled_out[key] = self.sampled_out.get(key, 0) + 1
+                return False
+            self._buckets[key] = (tokens - 1, now)
+            skipped = self._skipped.pop(key, 0)
+        if skipped:
+            record.sampled_out = skipped
+        return True
+
+
+class _EmitHandler(QueueHandler):
+    """ Emit side of the pipeline: sample, capture context, enqueue. Never formats and never blocks. """
+
+    def __init__(self, log_queue: queue.Queue, sampler: SubsystemSampler):
+        super().__init__(log_queue)
+        self.sampler = sampler
+        self.emitted = 0
+        self.dropped = 0
+        self.emit_ns = 0
+        self.max_emit_ns = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the writer thread, so the record goes as is, plus its context
+        if getattr(record, "client_id", None) is None:
+            record.client_id = log_client_id.get()
+        if getattr(record, "channel_id", None) is None:
+            record.channel_id = log_channel_id.get()
+        return record
+
+    def emit(self, record: logging.LogRecord):
+        started = time.perf_counter_ns()
+        if self.sampler.allow(record):
+            try:
+                self.enqueue(self.prepare(record))
+            except queue.Full:
+                self.dropped += 1
+            except Exception:
+                self.handleError(record)
+        elapsed = time.perf_counter_ns() - started
+        self.emitted += 1
+        self.emit_ns += elapsed
+        if elapsed > self.max_emit_ns:
+            self.max_emit_ns = elapsed
+
+
+class _WriteHandler(logging.StreamHandler):
+    """ Writer side: formats and writes on the listener thread, timing both. """
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.written = 0
+        self.write_ns = 0
+
+    def emit(self, record: logging.LogRecord):
+        started = time.perf_counter_ns()
+        super().emit(record)
+        self.written += 1
+        self.write_ns += time.perf_counter_ns() - started
+
+
+class LogPipeline:
+    """ Installs the queue handler on the root logger and runs the writer thread. """
+
+    def __init__(self, level: str, fmt: str, queue_size: int, max_message: int, sample_rates: Dict[str, Tuple[float, float]]):
+        self.level = level.upper()
+        self.format = fmt
+        self.queue_size = queue_size
+        self.max_message = max_message
+        self.sampler = SubsystemSampler(sample_rates)
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._emit: Optional[_EmitHandler] = None
+        self._write: Optional[_WriteHandler] = None
+        self._listener: Optional[QueueListener] = None
+
+    def configure(self):
+        """ Replaces the root logger's handlers with the queue handler and starts the writer thread. """
+        if self._listener is not None:
+            return
+        self._write = _WriteHandler(sys.stderr)
+        self._write.setFormatter(JsonFormatter(self.max_message) if self.format == "json" else TextFormatter(self.max_message))
+        self._emit = _EmitHandler(self._queue, self.sampler)
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self._emit)
+        root.setLevel(self.level)
+        self._listener = QueueListener(self._queue, self._write)
+        self._listener.start()
+
+    def stop(self):
+        """ Writes out whatever is still queued and stops the writer thread. """
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def stats(self) -> Dict[str, object]:
+        emit, write = self._emit, self._write
+        return {
+            "running": self._listener is not None,
+            "level": self.level,
+            "format": self.format,
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self.queue_size,
+            "emitted": emit.emitted if emit else 0,
+            "dropped_queue_full": emit.dropped if emit else 0,
+            "emit_avg_us": round(emit.emit_ns / emit.emitted / 1000, 2) if emit and emit.emitted else None,
+            "emit_max_us": round(emit.max_emit_ns / 1000, 2) if emit else None,
+            "written": write.written if write else 0,
+            "write_avg_us": round(write.write_ns / write.written / 1000, 2) if write and write.written else None,
+            "sample_rates": {key: {"rate": rate, "burst": burst} for key, (rate, burst) in self.sampler.rates.items()},
+            "sampled_out": dict(self.sampler.sampled_out),
+        }
+
+
+log_pipeline = LogPipeline(
+    level=config.LOG_LEVEL,
+    fmt=config.LOG_FORMAT,
+    queue_size=config.LOG_QUEUE_SIZE,
+    max_message=config.LOG_MAX_MESSAGE,
+    sample_rates=config.LOG_SAMPLE_RATES,
+)
@@ -0,0 +1,429 @@
+import contextlib
+import fractions
+import logging
+import re
+import time
+import weakref
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+import aiortc.rtcrtpsender
+from aiortc.codecs import get_encoder
+from aiortc.codecs.opus import OpusEncoder
+from aiortc.rtcrtpsender import RTCEncodedFrame, RTCRtpSender
+from av.audio.resampler import AudioResampler
+from av.codec import CodecContext
+
+from . import config
+from .resources import resources
+from .state import active_clients, active_channels
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 48000
+OPUS_LOOKAHEAD_MS = 2.5 # libopus encoder delay on top of the frame duration
+PACKET_OVERHEAD_BYTES = 20 + 8 + 12 + 10 # IPv4 + UDP + RTP + SRTP auth tag
+
+_OPUS_RTPMAP = re.compile(r"^a=rtpmap:(\d+) opus/48000", re.IGNORECASE | re.MULTILINE)
+_FMTP = re.compile(r"^a=fmtp:(\d+) (.*)$")
+_FMTP_CACHE_SIZE = 256
+
+
+@dataclass(frozen=True)
+class OpusProfile:
+    """ How Opus is negotiated with a client and encoded towards it. """
+    name: str
+    ptime: int # Frame duration in ms (10, 20, 40 or 60)
+    bitrate: int # Target bits per second
+    fec: bool # In-band forward error correction
+    dtx: bool # Discontinuous transmission while silent
+    stereo: bool = False
+    expected_loss: int = 10 # Percent; tells the encoder how much FEC redundancy to spend
+
+    @property
+    def samples_per_frame(self) -> int:
+        return SAMPLE_RATE * self.ptime // 1000
+
+    @property
+    def fmtp(self) -> Dict[str, str]:
+        """ What we ask the client to send us, as Opus fmtp parameters (RFC 7587). """
+        return {
+            "minptime": "10",
+            "useinbandfec": "1" if self.fec else "0",
+            "usedtx": "1" if self.dtx else "0",
+            "maxaveragebitrate": str(self.bitrate),
+            "stereo": "1" if self.stereo else "0",
+            "sprop-stereo": "1" if self.stereo else "0",
+        }
+
+    def nominal(self) -> Dict[str, float]:
+        """ Expected on-the-wire cost and added latency of one stream using this profile. """
+        packets_per_second = 1000 / self.ptime
+        overhead = PACKET_OVERHEAD_BYTES * 8 * packets_per_second
+        return {
+            "packets_per_second": packets_per_second,
+            "payload_kbps": self.bitrate / 1000,
+            "overhead_kbps": round(overhead / 1000, 1),
+            "wire_kbps": round((self.bitrate + overhead) / 1000, 1),
+            "algorithmic_latency_ms": self.ptime + OPUS_LOOKAHEAD_MS,
+        }
+
+
+BUILTIN_PROFILES: Dict[str, OpusProfile] = {profile.name: profile for profile in (
+    # Talent feeds: shortest frames for the lowest mouth-to-ear delay
+    OpusProfile("talent", ptime=10, bitrate=48000, fec=True, dtx=False),
+    # General crew intercom over Wi-Fi
+    OpusProfile("crew", ptime=20, bitrate=32000, fec=True, dtx=True),
+    # Clients that only listen: mono, low bitrate, silent uplink
+    OpusProfile("listen_only", ptime=20, bitrate=20000, fec=True, dtx=True),
+    # Program/music feeds, matching aiortc's stock encoder
+    OpusProfile("program", ptime=20, bitrate=96000, fec=False, dtx=False, stereo=True),
+)}
+
+
+class ProfileOpusEncoder(OpusEncoder):
+    """
+    aiortc's Opus encoder, configured from a profile instead of its fixed
+    96 kbit/s stereo 20 ms settings. Can be reconfigured while running: the
+    change is picked up on the next frame and RTP timestamps stay continuous.
+
+    Congestion control may cap the bitrate below the profile's and tune FEC
+    to the measured loss with `adapt`; those limits survive profile changes.
+
+    A profile with a shorter ptime than the frames it is fed (10 ms talent
+    against the usual 20 ms source frames) yields several packets per call.
+    Their RTP timestamps are kept in `timestamps`, so the sender can send
+    each as a frame of its own (see CodecProfiles._next_encoded_frame).
+    """
+
+    def __init__(self, client_id: str, profile: OpusProfile):
+        self.client_id = client_id
+        self.base = profile
+        self.bitrate_cap: Optional[int] = None
+        self.loss_hint: Optional[int] = None
+        self.remb_bps: Optional[int] = None # Last REMB estimate from the receiver, if it sends any
+        self.first_packet_pts = None
+        self.timestamps: List[int] = [] # RTP timestamp of each payload the last encode() returned
+        self._pending: Optional[OpusProfile] = None
+        self._open(profile)
+
+    def _open(self, profile: OpusProfile):
+        codec = CodecContext.create("libopus", "w")
+        codec.bit_rate = profile.bitrate
+        codec.format = "s16"
+        codec.layout = "stereo" if profile.stereo else "mono"
+        codec.sample_rate = SAMPLE_RATE
+        codec.time_base = fractions.Fraction(1, SAMPLE_RATE)
+        codec.options = {
+            "application": "voip",
+            "frame_duration": str(profile.ptime),
+            "fec": "1" if profile.fec else "0",
+            "packet_loss": str(profile.expected_loss if profile.fec else 0),
+            "dtx": "1" if profile.dtx else "0",
+        }
+        self.codec = codec
+        self.resampler = AudioResampler(
+            format="s16", layout=codec.layout.name, rate=SAMPLE_RATE, frame_size=profile.samples_per_frame
+        )
+        self.profile = profile
+
+    # aiortc assigns this when the receiver sends REMB; congestion control reads it
+    @property
+    def target_bitrate(self) -> Optional[int]:
+        return self.remb_bps
+
+    @target_bitrate.setter
+    def target_bitrate(self, value: int):
+        self.remb_bps = value
+
+    def reconfigure(self, profile: OpusProfile):
+        self.base = profile
+        self._schedule()
+
+    def adapt(self, bitrate_cap: Optional[int], loss_hint: Optional[int]):
+        self.bitrate_cap = bitrate_cap
+        self.loss_hint = loss_hint
+        self._schedule()
+
+    def _schedule(self):
+        effective = self.base
+        if self.bitrate_cap is not None and self.bitrate_cap < effective.bitrate:
+            effective = replace(effective, bitrate=self.bitrate_cap)
+        if self.loss_hint is not None and effective.fec:
+            effective = replace(effective, expected_loss=self.loss_hint)
+        self._pending = effective if effective != self.profile else None
+
+    def encode(self, frame, force_keyframe: bool = False):
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            self._open(pending) # Runs on the encoder thread, between two frames
+        packets = []
+        for resampled in self.resampler.resample(frame):
+            packets += self.codec.encode(resampled)
+        if not packets:
+            self.timestamps = []
+            return [], None # Still buffering in the resampler
+        if self.first_packet_pts is None:
+            self.first_packet_pts = packets[0].pts # libopus starts at a negative pts
+        self.timestamps = [packet.pts - self.first_packet_pts for packet in packets]
+        return [bytes(packet) for packet in packets], self.timestamps[0]
+
+
+_negotiating: ContextVar[Optional[str]] = ContextVar("soundmesh_negotiating_client", default=None)
+_sending: ContextVar[Optional[RTCRtpSender]] = ContextVar("soundmesh_sending_sender", default=None)
+_next_encoded_frame = RTCRtpSender._next_encoded_frame
+
+
+class CodecProfiles:
+    """
+    Per-client Opus settings, in both directions.
+
+    A client's profile is its own override if one was set, otherwise that of
+    the channel it talks in (the default if the channel has none), otherwise
+    the listen-only profile since it talks nowhere. The profile is applied to the answers
+    and offers we send it (fmtp and a=ptime, which shape what the browser
+    sends us) and to the encoders of the streams we send it.
+
+    Munging reuses per-profile templates: the fmtp line produced for a given
+    profile and incoming parameter string is cached, so repeated
+    negotiations only split the SDP and look the line up.
+    """
+
+    def __init__(self, profiles: Dict[str, OpusProfile], default: str, listen_only: str):
+        for name in (default, listen_only):
+            if name not in profiles:
+                raise ValueError(f"Unknown codec profile '{name}', expected one of {sorted(profiles)}")
+        self.profiles = dict(profiles)
+        self.default = default
+        self.listen_only = listen_only
+        self._client_overrides: Dict[str, str] = {}
+        self._fmtp_cache: Dict[Tuple[str, str], str] = {}
+        self._encoders: Dict[str, "weakref.WeakSet[ProfileOpusEncoder]"] = {}
+        self._sender_encoders: "weakref.WeakKeyDictionary[RTCRtpSender, ProfileOpusEncoder]" = weakref.WeakKeyDictionary()
+        self._held: "weakref.WeakKeyDictionary[RTCRtpSender, Deque[RTCEncodedFrame]]" = weakref.WeakKeyDictionary()
+        self.frames_split = 0
+        self._installed = False
+        self._stats: Dict[str, Dict[str, float]] = {
+            name: {"munged": 0, "template_hits": 0, "munge_us_total": 0.0, "encoders": 0} for name in self.profiles
+        }
+
+    # --- Resolution ---
+
+    def get(self, name: Optional[str]) -> Optional[OpusProfile]:
+        return self.profiles.get(name) if name else None
+
+    def resolve(self, client_id: str) -> OpusProfile:
+        override = self.get(self._client_overrides.get(client_id))
+        if override:
+            return override
+        client = active_clients.get(client_id)
+        channel_id = client.current_channel_id if client else None
+        if channel_id:
+            channel = active_channels.get(channel_id)
+            return self.get(channel.codec_profile if channel else None) or self.profiles[self.default]
+        return self.profiles[self.listen_only]
+
+    def client_override(self, client_id: str) -> Optional[str]:
+        return self._client_overrides.get(client_id)
+
+    def set_client_override(self, client_id: str, name: Optional[str]):
+        if name:
+            self._client_overrides[client_id] = name
+        else:
+            self._client_overrides.pop(client_id, None)
+
+    def for_sdp(self, client_id: str) -> OpusProfile:
+        """ The profile to put in an SDP for this client, remembered so later changes can be detected. """
+        profile = self.resolve(client_id)
+        client = active_clients.get(client_id)
+        if client:
+            client.codec_profile = profile.name
+        return profile
+
+    def refresh(self, client_id: str) -> bool:
+        """
+        Re-resolves a client's profile and reconfigures the encoders sending
+        to it. Returns True if its last SDP used a different profile, i.e. it
+        needs a renegotiation for its own uplink to follow.
+        """
+        profile = self.resolve(client_id)
+        encoders = self._encoders.get(client_id)
+        if encoders is not None:
+            if not encoders:
+                del self._encoders[client_id] # All senders to this client are gone
+            for encoder in list(encoders):
+                encoder.reconfigure(profile)
+        client = active_clients.get(client_id)
+        return bool(client and client.codec_profile and client.codec_profile != profile.name)
+
+    def forget(self, client_id: str):
+        """ Drops a departed client's encoder set; its override stays, for when it comes back. """
+        self._encoders.pop(client_id, None)
+
+    # --- SDP ---
+
+    def munge(self, sdp: str, profile: OpusProfile) -> str:
+        """ Applies a profile's fmtp parameters and ptime to every Opus payload type in an SDP. """
+        started = time.perf_counter()
+        stats = self._stats[profile.name]
+        opus_pts = set(_OPUS_RTPMAP.findall(sdp))
+        if not opus_pts:
+            return sdp
+        lines = sdp.split("\r\n")
+        has_fmtp = {match.group(1) for match in map(_FMTP.match, lines) if match}
+        out: List[str] = []
+        in_audio = False
+        for line in lines:
+            if line.startswith("m="):
+                in_audio = line.startswith("m=audio")
+            elif in_audio and (line.startswith("a=ptime:") or line.startswith("a=maxptime:")):
+                continue # Replaced below, next to the Opus rtpmap
+            elif line.startswith("a=fmtp:"):
+                match = _FMTP.match(line)
+                if match and match.group(1) in opus_pts:
+                    line = self._fmtp_line(profile, match.group(1), match.group(2))
+            out.append(line)
+            if line.startswith("a=rtpmap:"):
+                pt = line[9:].split(" ", 1)[0]
+                if pt in opus_pts:
+                    if pt not in has_fmtp:
+                        out.append(self._fmtp_line(profile, pt, ""))
+                    out.append(f"a=ptime:{profile.ptime}")
+        stats["munged"] += 1
+        stats["munge_us_total"] += (time.perf_counter() - started) * 1e6
+        return "\r\n".join(out)
+
+    def _fmtp_line(self, profile: OpusProfile, pt: str, params: str) -> str:
+        key = (profile.name, f"{pt} {params}")
+        line = self._fmtp_cache.get(key)
+        if line is not None:
+            self._stats[profile.name]["template_hits"] += 1
+            return line
+        merged: Dict[str, str] = {}
+        for item in params.split(";"):
+            name, _, value = item.strip().partition("=")
+            if name:
+                merged[name] = value
+        merged.update(profile.fmtp)
+        line = f"a=fmtp:{pt} " + ";".join(f"{name}={value}" for name, value in merged.items())
+        if len(self._fmtp_cache) >= _FMTP_CACHE_SIZE:
+            self._fmtp_cache.clear()
+        self._fmtp_cache[key] = line
+        return line
+
+    # --- Encoders ---
+
+    def install(self):
+        """ Routes aiortc's encoder creation, and the frames its senders send, through the profiles. """
+        if not self._installed:
+            aiortc.rtcrtpsender.get_encoder = self._get_encoder
+            RTCRtpSender._next_encoded_frame = self._sender_hook()
+            self._installed = True
+
+    def uninstall(self):
+        if self._installed:
+            aiortc.rtcrtpsender.get_encoder = get_encoder
+            RTCRtpSender._next_encoded_frame = _next_encoded_frame
+            self._installed = False
+
+    def _sender_hook(self):
+        profiles = self
+
+        async def next_encoded_frame(sender: RTCRtpSender, codec) -> Optional[RTCEncodedFrame]:
+            return await profiles._next_encoded_frame(sender, codec)
+        return next_encoded_frame
+
+    async def _next_encoded_frame(self, sender: RTCRtpSender, codec) -> Optional[RTCEncodedFrame]:
+        """
+        aiortc sends every payload of one encoded frame with the same RTP
+        timestamp, so a frame holding several Opus packets is split: the
+        first goes out now and the rest on the following calls, each with its
+        own timestamp, before the sender reads its track again.
+        """
+        held = self._held.get(sender)
+        if held:
+            return held.popleft()
+        token = _sending.set(sender) # Lets _get_encoder tell which sender it builds for
+        try:
+            encoded = await _next_encoded_frame(sender, codec)
+        finally:
+            _sending.reset(token)
+        encoder = self._sender_encoders.get(sender)
+        if encoded is None or encoder is None or len(encoded.payloads) < 2:
+            return encoded
+        frames = [
+            RTCEncodedFrame([payload], timestamp, encoded.audio_level)
+            for payload, timestamp in zip(encoded.payloads, encoder.timestamps)
+        ]
+        self._held[sender] = deque(frames[1:])
+        self.frames_split += 1
+        return frames[0]
+
+    @contextlib.contextmanager
+    def negotiating(self, client_id: str) -> Iterator[None]:
+        """
+        Marks SDP work done for `client_id`'s PC. aiortc starts RTP senders in
+        tasks spawned from setLocalDescription/setRemoteDescription, which
+        inherit this context, so encoders created there know who they serve.
+        """
+        token = _negotiating.set(client_id)
+        try:
+            yield
+        finally:
+            _negotiating.reset(token)
+
+    def _get_encoder(self, codec):
+        client_id = _negotiating.get()
+        if client_id is None or codec.mimeType.lower() != "audio/opus":
+            return get_encoder(codec)
+        profile = self.resolve(client_id)
+        encoder = ProfileOpusEncoder(client_id, profile)
+        self._encoders.setdefault(client_id, weakref.WeakSet()).add(encoder)
+        sender = _sending.get()
+        if sender is not None:
+            self._sender_encoders[sender] = encoder
+        self._stats[profile.name]["encoders"] += 1
+        return encoder
+
+    def encoders(self, client_id: str) -> List[ProfileOpusEncoder]:
+        return list(self._encoders.get(client_id, ()))
+
+    def stats(self) -> Dict[str, object]:
+        clients: Dict[str, int] = {}
+        for client_id in active_clients:
+            name = self.resolve(client_id).name
+            clients[name] = clients.get(name, 0) + 1
+        profiles = {}
+        for name, profile in self.profiles.items():
+            stats = self._stats[name]
+            profiles[name] = {
+                "ptime_ms": profile.ptime,
+                "bitrate": profile.bitrate,
+                "fec": profile.fec,
+                "dtx": profile.dtx,
+                "stereo": profile.stereo,
+                **profile.nominal(),
+                "clients": clients.get(name, 0),
+                "encoders_created": stats["encoders"],
+                "sdp_munged": stats["munged"],
+                "template_hits": stats["template_hits"],
+                "avg_munge_us": round(stats["munge_us_total"] / stats["munged"], 1) if stats["munged"] else None,
+            }
+        return {
+            "default": self.default,
+            "listen_only": self.listen_only,
+            "client_overrides": len(self._client_overrides),
+            "templates_cached": len(self._fmtp_cache),
+            "frames_split": self.frames_split,
+            "profiles": profiles,
+        }
+
+
+codec_profiles = CodecProfiles(
+    BUILTIN_PROFILES,
+    default=config.CODEC_DEFAULT_PROFILE,
+    listen_only=config.CODEC_LISTEN_ONLY_PROFILE,
+)
+resources.add_finalizer(codec_profiles.forget)
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import aiortc.rtcpeerconnection
+from aiortc import RTCPeerConnection, RTCConfiguration, RTCIceServer
+from aiortc.rtcdtlstransport import RTCCertificate
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+_ANSWER_SAMPLES = 256 # Recent time-to-answer samples kept for percentiles
+
+
+def _percentile(samples: List[float], fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class _SharedCertificate(RTCCertificate):
+    """ Stands in for RTCCertificate inside aiortc so new PCs pick up the factory's certificate. """
+
+    @classmethod
+    def generateCertificate(cls) -> RTCCertificate:
+        return pc_factory.certificate()
+
+
+class PeerConnectionFactory:
+    """
+    Hands out server-side PeerConnections.
+
+    Every PC is built from the ICE servers in settings and uses one DTLS
+    certificate shared by the whole server, regenerated every
+    `cert_rotation` seconds (aiortc certificates are valid for 30 days), so
+    no keypair is generated per join. A few PCs are kept pre-warmed: their
+    audio transceiver exists and ICE gathering (including any STUN/TURN
+    round trips) has already finished, so an incoming offer only costs the
+    SDP exchange. Warm PCs are replaced after `pool_max_age` seconds so
+    their server-reflexive candidates never outlive NAT bindings.
+    """
+
+    def __init__(self, ice_servers: List[str], ice_username: str, ice_credential: str,
+                 pool_size: int, pool_max_age: float, cert_rotation: float):
+        servers = []
+        if ice_servers:
+            servers.append(RTCIceServer(urls=ice_servers, username=ice_username or None,
+                                        credential=ice_credential or None))
+        self.configuration = RTCConfiguration(iceServers=servers)
+        self.pool_size = pool_size
+        self.pool_max_age = pool_max_age
+        self.cert_rotation = cert_rotation
+        self._certificate: Optional[RTCCertificate] = None
+        self._certificate_created = 0.0
+        self._pool: Deque[Tuple[RTCPeerConnection, float]] = deque() # (pc, monotonic time it became warm)
+        self._warming = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._answer_ms: Deque[float] = deque(maxlen=_ANSWER_SAMPLES)
+        self.certificates_generated = 0
+        self.created = 0
+        self.served_warm = 0
+        self.served_cold = 0
+        self.expired = 0
+        self.warm_failures = 0
+        self.answers_warm = 0
+        self.answers_cold = 0
+
+    def start(self):
+        if self._task is None:
+            # aiortc builds each PC's certificate through this module attribute
+            aiortc.rtcpeerconnection.RTCCertificate = _SharedCertificate
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            aiortc.rtcpeerconnection.RTCCertificate = RTCCertificate
+        pool, self._pool = self._pool, deque()
+        await asyncio.gather(*(pc.close() for pc, _ in pool), return_exceptions=True)
+
+    def certificate(self) -> RTCCertificate:
+        """ The shared DTLS certificate, regenerated once it is `cert_rotation` seconds old. """
+        now = time.monotonic()
+        if self._certificate is None or now - self._certificate_created >= self.cert_rotation:
+            self._certificate = RTCCertificate.generateCertificate()
+            self._certificate_created = now
+            self.certificates_generated += 1
+            logger.info("Generated a new shared DTLS certificate")
+        return self._certificate
+
+    def create(self) -> RTCPeerConnection:
+        self.created += 1
+        return RTCPeerConnection(configuration=self.configuration)
+
+    def acquire(self) -> Tuple[RTCPeerConnection, bool]:
+        """ A PC for a new client and whether it came pre-warmed. Never waits. """
+        now = time.monotonic()
+        while self._pool:
+            pc, warmed_at = self._pool.popleft()
+            if now - warmed_at < self.pool_max_age and pc.connectionState == "new":
+                self.served_warm += 1
+                self._refill()
+                return pc, True
+            self.expired += 1
+            asyncio.get_running_loop().create_task(pc.close())
+        self.served_cold += 1
+        self._refill()
+        return self.create(), False
+
+    def record_answer(self, seconds: float, warm: bool):
+        """ Time from an offer arriving to its answer being sent. """
+        self._answer_ms.append(seconds * 1000)
+        if warm:
+            self.answers_warm += 1
+        else:
+            self.answers_cold += 1
+
+    def _refill(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _warm_one(self):
+        pc = self.create()
+        try:
+            # The same transceiver setRemoteDescription would create for the client's audio m-line
+            transceiver = pc.addTransceiver("audio", direction="recvonly")
+            await transceiver.receiver.transport.transport.iceGatherer.gather()
+        except Exception as e:
+            self.warm_failures += 1
+            logger.warning(f"Failed to pre-warm a PeerConnection: {e}")
+            await pc.close()
+            return
+        self._pool.append((pc, time.monotonic()))
+
+    async def _run(self):
+        while True:
+            # Drop warm PCs that are about to go stale, oldest first
+            now = time.monotonic()
+            while self._pool and now - self._pool[0][1] >= self.pool_max_age * 0.9:
+                pc, _ = self._pool.popleft()
+                self.expired += 1
+                await pc.close()
+            missing = self.pool_size - len(self._pool)
+            if missing > 0:
+                self._warming = missing
+                await asyncio.gather(*(self._warm_one() for _ in range(missing)))
+                self._warming = 0
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(self.pool_max_age / 4, 1.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, object]:
+        samples = list(self._answer_ms)
+        return {
+            "ice_servers": [url for server in self.configuration.iceServers for url in server.urls],
+            "pool_size": self.pool_size,
+            "pool_ready": len(self._pool),
+            "pool_warming": self._warming,
+            "created": self.created,
+            "served_warm": self.served_warm,
+            "served_cold": self.served_cold,
+            "expired": self.expired,
+            "warm_failures": self.warm_failures,
+            "certificates_generated": self.certificates_generated,
+            "certificate_age_s": round(time.monotonic() - self._certificate_created, 1) if self._certificate else None,
+            "time_to_answer": {
+                "answers_warm": self.answers_warm,
+                "answers_cold": self.answers_cold,
+                "avg_ms": round(sum(samples) / len(samples), 2) if samples else None,
+                "p50_ms": round(_percentile(samples, 0.5), 2) if samples else None,
+                "p95_ms": round(_percentile(samples, 0.95), 2) if samples else None,
+                "max_ms": round(max(samples), 2) if samples else None,
+            },
+        }
+
+
+pc_factory = PeerConnectionFactory(
+    ice_servers=config.ICE_SERVERS,
+    ice_username=config.ICE_USERNAME,
+    ice_credential=config.ICE_CREDENTIAL,
+    pool_size=config.PC_POOL_SIZE,
+    pool_max_age=config.PC_POOL_MAX_AGE,
+    cert_rotation=config.DTLS_CERT_ROTATION,
+)
@@ -0,0 +1,154 @@
+import logging
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from . import config
+from ..models.permissions import ClientPermissions
+
+logger = logging.getLogger(__name__)
+
+
+class _CompiledPermissions:
+    """ One client's permission matrix as bitsets, one bit per interned channel. """
+    __slots__ = ("explicit", "talk", "listen", "direct")
+
+    def __init__(self, explicit: int = 0, talk: int = 0, listen: int = 0, direct: FrozenSet[str] = frozenset()):
+        self.explicit = explicit # Channels that have an entry in the matrix
+        self.talk = talk         # Of those, the ones the client may talk in
+        self.listen = listen     # Of those, the ones the client may listen to
+        self.direct = direct     # Client IDs it may open direct routes to ("*": anyone)
+
+
+class PermissionEngine:
+    """
+    Compiled form of every client's ClientPermissions.
+
+    Channel IDs are interned to bit positions, and each client's matrix is
+    compiled into talk/listen bitsets, so "may X talk/listen on channel C" is
+    a dict lookup plus a bit test. Channels missing from a client's matrix
+    fall back to the configured defaults. For each channel the engine also
+    keeps the set of clients whose listen permission differs from the
+    default, so "who may hear channel C" never has to walk every matrix.
+
+    Recompiling a client only touches the channels whose bits changed and
+    reports which permissions were revoked, so callers can tear down exactly
+    the affected routes.
+    """
+
+    def __init__(self, default_talk: bool, default_listen: bool):
+        self.default_talk = default_talk
+        self.default_listen = default_listen
+        self._index: Dict[str, int] = {} # channel_id -> bit position
+        self._channels: List[str] = []   # bit position -> channel_id
+        self._clients: Dict[str, _CompiledPermissions] = {}
+        self._listen_exceptions: Dict[int, Set[str]] = {} # bit -> clients whose listen differs from the default
+        self.compiles = 0
+
+    def intern(self, channel_id: str) -> int:
+        index = self._index.get(channel_id)
+        if index is None:
+            index = len(self._channels)
+            self._index[channel_id] = index
+            self._channels.append(channel_id)
+        return index
+
+    def _allowed(self, compiled: Optional[_CompiledPermissions], field: str, channel_id: str, default: bool) -> bool:
+        if compiled is None:
+            return default
+        index = self._index.get(channel_id)
+        if index is None:
+            return default
+        mask = 1 << index
+        if compiled.explicit & mask:
+            return bool(getattr(compiled, field) & mask)
+        return default
+
+    def may_talk(self, client_id: str, channel_id: str) -> bool:
+        return self._allowed(self._clients.get(client_id), "talk", channel_id, self.default_talk)
+
+    def may_listen(self, client_id: str, channel_id: str) -> bool:
+        return self._allowed(self._clients.get(client_id), "listen", channel_id, self.default_listen)
+
+    def may_direct(self, talker_id: str, target_id: str) -> bool:
+        """ Whether `talker_id` may open a private route to `target_id`. Never allowed by default. """
+        compiled = self._clients.get(talker_id)
+        return compiled is not None and ("*" in compiled.direct or target_id in compiled.direct)
+
+    def listenable(self, client_id: str, channel_ids: Iterable[str]) -> Set[str]:
+        """ The subset of `channel_ids` the client may listen to. """
+        return {cid for cid in channel_ids if self.may_listen(client_id, cid)}
+
+    def may_hear(self, channel_id: str, client_ids: Iterable[str]) -> List[str]:
+        """ Filters `client_ids` down to the clients allowed to listen to `channel_id`. """
+        index = self._index.get(channel_id)
+        exceptions = self._listen_exceptions.get(index, ()) if index is not None else ()
+        if self.default_listen:
+            return [cid for cid in client_ids if cid not in exceptions]
+        return [cid for cid in client_ids if cid in exceptions]
+
+    def compile(self, client_id: str, permissions: ClientPermissions) -> Tuple[Set[str], Set[str]]:
+        """
+        (Re)compiles a client's matrix. Returns the channel IDs whose talk and
+        listen permissions were revoked by this change, as (talk, listen).
+        """
+        new = _CompiledPermissions(direct=frozenset(permissions.direct_targets))
+        for channel_id, perms in permissions.channel_permissions.items():
+            mask = 1 << self.intern(channel_id)
+            new.explicit |= mask
+            if perms.talk:
+                new.talk |= mask
+            if perms.listen:
+                new.listen |= mask
+        old = self._clients.get(client_id) or _CompiledPermissions()
+        self._clients[client_id] = new
+        self.compiles += 1
+
+        # Only channels whose entry appeared, disappeared or flipped can change anything
+        changed = (old.explicit ^ new.explicit) | (old.talk ^ new.talk) | (old.listen ^ new.listen)
+        revoked_talk: Set[str] = set()
+        revoked_listen: Set[str] = set()
+        while changed:
+            low = changed & -changed
+            changed ^= low
+            index = low.bit_length() - 1
+            channel_id = self._channels[index]
+            old_talk = bool(old.talk & low) if old.explicit & low else self.default_talk
+            new_talk = bool(new.talk & low) if new.explicit & low else self.default_talk
+            old_listen = bool(old.listen & low) if old.explicit & low else self.default_listen
+            new_listen = bool(new.listen & low) if new.explicit & low else self.default_listen
+            if old_talk and not new_talk:
+                revoked_talk.add(channel_id)
+            if old_listen and not new_listen:
+                revoked_listen.add(channel_id)
+            exceptions = self._listen_exceptions.setdefault(index, set())
+            if new_listen != self.default_listen:
+                exceptions.add(client_id)
+            else:
+                exceptions.discard(client_id)
+        return revoked_talk, revoked_listen
+
+    def forget(self, client_id: str):
+        compiled = self._clients.pop(client_id, None)
+        if compiled is None:
+            return
+        explicit = compiled.explicit
+        while explicit:
+            low = explicit & -explicit
+            explicit ^= low
+            exceptions = self._listen_exceptions.get(low.bit_length() - 1)
+            if exceptions:
+                exceptions.discard(client_id)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "default_talk": self.default_talk,
+            "default_listen": self.default_listen,
+            "channels_interned": len(self._channels),
+            "clients_compiled": len(self._clients),
+            "compiles": self.compiles,
+        }
+
+
+permission_engine = PermissionEngine(
+    default_talk=config.PERMISSIONS_DEFAULT_TALK,
+    default_listen=config.PERMISSIONS_DEFAULT_LISTEN,
+)
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilerBusyError(RuntimeError):
+    """ Raised when a profile is requested while another one is still running. """
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampling profiler for the running server.
+
+    Samples the stack of a target thread (normally the event loop thread) from a
+    background thread and aggregates the samples as folded stacks
+    ("root;caller;callee count" per line), the input format of flamegraph.pl,
+    speedscope and inferno.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fold(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+            frame = frame.f_back
+        names.reverse()
+        return ";".join(names)
+
+    def _sample(self, seconds: float, interval: float, thread_id: Optional[int]) -> Counter:
+        samples: Counter = Counter()
+        sampler_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if thread_id is not None:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[self._fold(frame)] += 1
+            else:
+                for ident, frame in frames.items():
+                    if ident != sampler_id:
+                        samples[self._fold(frame)] += 1
+            time.sleep(interval)
+        return samples
+
+    async def profile(self, seconds: float, interval: float, thread_id: Optional[int] = None) -> str:
+        """
+        Samples for `seconds` and returns the folded-stack profile as text.
+        If `thread_id` is None, every thread except the sampler is profiled.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("A profile is already being captured")
+        try:
+            logger.info(f"Capturing {seconds}s sampling profile (interval={interval * 1000:.1f}ms)")
+            loop = asyncio.get_running_loop()
+            samples = await loop.run_in_executor(None, self._sample, seconds, interval, thread_id)
+        finally:
+            self._lock.release()
+        return "\n".join(f"{stack} {count}" for stack, count in samples.most_common()) + "\n"
+
+
+profiler = SamplingProfiler()
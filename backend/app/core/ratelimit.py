@@ -0,0 +1,124 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+from fastapi import HTTPException, Request, status
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Classic token bucket: holds up to `burst` tokens and refills at `rate` tokens
+    per second. Each allowed event consumes one token.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_acquire(self, cost: float = 1.0, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def retry_after(self, cost: float = 1.0) -> float:
+        """ Seconds until `cost` tokens will be available. """
+        if self.tokens >= cost or self.rate <= 0:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class KeyedRateLimiter:
+    """
+    One token bucket per key (client ID, IP address, route...), shared across
+    connections. Buckets are kept in LRU order and the least recently used are
+    evicted beyond `max_keys`, so a flood of distinct keys can't exhaust memory;
+    an evicted key simply starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = config.RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+
+    def _bucket(self, key: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def allow(self, key: Hashable, cost: float = 1.0) -> bool:
+        if self._bucket(key).try_acquire(cost):
+            self.allowed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def check(self, key: Hashable, cost: float = 1.0) -> Tuple[bool, float]:
+        """ Like allow(), but also returns the retry-after delay when rejected. """
+        bucket = self._bucket(key)
+        if bucket.try_acquire(cost):
+            self.allowed += 1
+            return True, 0.0
+        self.rejected += 1
+        return False, bucket.retry_after(cost)
+
+    def forget(self, key: Hashable):
+        self._buckets.pop(key, None)
+
+    def stats(self) -> Dict[str, float]:
+        return {"rate": self.rate, "burst": self.burst, "keys": len(self._buckets),
+                "allowed": self.allowed, "rejected": self.rejected}
+
+
+# --- REST rate limiting ---
+
+_READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+rest_read_limiter = KeyedRateLimiter(config.REST_READ_RATE, config.REST_READ_BURST)
+rest_write_limiter = KeyedRateLimiter(config.REST_WRITE_RATE, config.REST_WRITE_BURST)
+
+# Limits new WebSocket connection attempts per source IP
+ws_connect_limiter = KeyedRateLimiter(config.WS_CONNECT_RATE, config.WS_CONNECT_BURST)
+
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+async def rest_rate_limit(request: Request):
+    """
+    FastAPI dependency enforcing a token bucket per (route, source IP).
+    Mutating routes use a stricter bucket than reads.
+    """
+    route = request.scope.get("route")
+    route_path = getattr(route, "path", request.url.path)
+    limiter = rest_read_limiter if request.method in _READ_METHODS else rest_write_limiter
+    allowed, retry_after = limiter.check((request.method, route_path, client_ip(request)))
+    if not allowed:
+        logger.warning(f"REST rate limit exceeded: {request.method} {route_path} from {client_ip(request)}")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded. Slow down.",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
@@ -0,0 +1,418 @@
+import asyncio
+import fractions
+import logging
+import time
+from array import array
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from av import Packet
+from aiortc import RTCPeerConnection, RTCRtpSender
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+from aiortc.rtp import RtpPacket
+
+from . import config
+from .resources import resources
+from .shards import call_in, media_shards
+from .state import active_clients, active_channels
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 48000
+_TIME_BASE = fractions.Fraction(1, SAMPLE_RATE)
+_RTP_WRAP = 1 << 32
+SILENCE_LEVEL = 127 # ssrc-audio-level value browsers put on frames that carry nothing (muted mic, DTX)
+MAX_SOURCES = 0xFFFF # Talker indexes are stored as unsigned shorts
+_SLOT_BYTES = 8 + 4 + 4 + 2 + 2 # arrival, RTP timestamp, offset, length, source
+OPUS_SILENCE = b"\xf8\xff\xfe" # 20 ms CELT frame decoding to silence
+
+
+class ReplayRing:
+    """
+    The last few seconds of one channel's audio, as the Opus frames talkers sent.
+
+    Payloads live back to back in one bytearray allocated up front; per frame
+    metadata lives in parallel fixed-size arrays. No buffer grows or is
+    allocated per frame: once either runs out, the oldest frames are overwritten. A frame
+    that would run past the end of the byte buffer starts again at offset 0.
+    """
+
+    def __init__(self, seconds: int, bytes_per_second: int, frames_per_second: int):
+        self.seconds = seconds
+        self.slots = seconds * frames_per_second
+        self.data = bytearray(seconds * bytes_per_second)
+        self.arrival = array("d", [0.0]) * self.slots
+        self.rtp_timestamp = array("I", [0]) * self.slots
+        self.offset = array("I", [0]) * self.slots
+        self.length = array("H", [0]) * self.slots
+        self.source = array("H", [0]) * self.slots
+        self.sources: List[str] = [] # Source index -> talker client ID
+        self._source_index: Dict[str, int] = {}
+        self.head = 0 # Slot of the oldest frame
+        self.count = 0
+        self.write_pos = 0
+        self.used_bytes = 0
+        self.appends = 0
+        self.evictions = 0
+        self.oversized = 0
+        self.append_time = 0.0
+
+    @property
+    def allocated_bytes(self) -> int:
+        return len(self.data) + self.slots * _SLOT_BYTES
+
+    def clear(self):
+        self.head = self.count = self.write_pos = self.used_bytes = 0
+        self.sources.clear()
+        self._source_index.clear()
+
+    def append(self, talker_id: str, arrival: float, rtp_timestamp: int, payload: bytes):
+        started = time.perf_counter()
+        size = len(payload)
+        if size > len(self.data) or size > 0xFFFF:
+            self.oversized += 1
+            return
+        source = self._source_index.get(talker_id)
+        if source is None:
+            if len(self.sources) >= MAX_SOURCES:
+                self.clear()
+            source = self._source_index[talker_id] = len(self.sources)
+            self.sources.append(talker_id)
+        position = self.write_pos
+        if position + size > len(self.data):
+            # The rest of the buffer is skipped, so whatever still sits there goes too
+            while self.count and self._overlaps(self.head, position, len(self.data) - position):
+                self._evict_oldest()
+            position = 0
+        # Free the slots and bytes the new frame needs; the oldest frames always sit just ahead of the write position
+        while self.count and (self.count == self.slots or self._overlaps(self.head, position, size)):
+            self._evict_oldest()
+        slot = (self.head + self.count) % self.slots
+        self.data[position:position + size] = payload
+        self.arrival[slot] = arrival
+        self.rtp_timestamp[slot] = rtp_timestamp
+        self.offset[slot] = position
+        self.length[slot] = size
+        self.source[slot] = source
+        self.count += 1
+        self.used_bytes += size
+        self.write_pos = position + size
+        self.appends += 1
+        self.append_time += time.perf_counter() - started
+
+    def _evict_oldest(self):
+        self.used_bytes -= self.length[self.head]
+        self.head = (self.head + 1) % self.slots
+        self.count -= 1
+        self.evictions += 1
+
+    def _overlaps(self, slot: int, position: int, size: int) -> bool:
+        start = self.offset[slot]
+        return start < position + size and position < start + self.length[slot]
+
+    def window(self, seconds: float, now: float) -> Dict[str, List[Tuple[float, int, bytes]]]:
+        """ Copies out the frames that arrived in the last `seconds`, per talker: (arrival, RTP timestamp, payload). """
+        since = now - seconds
+        frames: Dict[str, List[Tuple[float, int, bytes]]] = {}
+        for i in range(self.count):
+            slot = (self.head + i) % self.slots
+            if self.arrival[slot] < since:
+                continue
+            start = self.offset[slot]
+            frames.setdefault(self.sources[self.source[slot]], []).append(
+                (self.arrival[slot], self.rtp_timestamp[slot], bytes(self.data[start:start + self.length[slot]]))
+            )
+        return frames
+
+    def stats(self, now: float) -> Dict[str, object]:
+        return {
+            "seconds": self.seconds,
+            "allocated_bytes": self.allocated_bytes,
+            "used_bytes": self.used_bytes,
+            "frames": self.count,
+            "frame_slots": self.slots,
+            "oldest_age_s": round(now - self.arrival[self.head], 1) if self.count else None,
+            "talkers": len(self.sources),
+            "appends": self.appends,
+            "evictions": self.evictions,
+            "oversized": self.oversized,
+            "avg_append_us": round(self.append_time / self.appends * 1e6, 2) if self.appends else None,
+            "append_cpu_ms": round(self.append_time * 1000, 1),
+        }
+
+
+class ReplaySession:
+    """ One client's replay in progress: one track per talker heard in the window, sharing one clock. """
+
+    def __init__(self, client_id: str, channel_id: str, seconds: float,
+                 on_finished: Callable[["ReplaySession"], Awaitable[None]]):
+        self.client_id = client_id
+        self.channel_id = channel_id
+        self.seconds = seconds
+        self.tracks: List["ReplayTrack"] = []
+        self.senders: List[RTCRtpSender] = [] # Filled in by whoever adds the tracks to the client's PC
+        self.started: Optional[float] = None # Set when the first track is pulled by its sender
+        self.finished = False
+        self._playing = 0
+        self._on_finished = on_finished
+
+    def add(self, track: "ReplayTrack"):
+        self.tracks.append(track)
+        self._playing += 1
+
+    def played_out(self):
+        self._playing -= 1
+        if self._playing <= 0:
+            self.finish()
+
+    def finish(self):
+        """ Hands the session to its owner to detach the tracks; runs once. """
+        if not self.finished:
+            self.finished = True
+            asyncio.ensure_future(self._on_finished(self))
+
+    def stop(self):
+        for track in self.tracks:
+            track.stop()
+
+
+class ReplayTrack(MediaStreamTrack):
+    """
+    Plays back recorded Opus frames in real time as av.Packets, which aiortc's
+    sender packetizes as they are, so replay costs no decoding or encoding.
+
+    A sender whose track raises MediaStreamError exits for good, which would
+    leave a dead transceiver behind for addTrack to reuse. So after the last
+    frame the track tells its session and waits to be detached from the
+    sender (replaceTrack(None) and then stop()), answering that last pending
+    recv() with a silence frame.
+    """
+
+    kind = "audio"
+
+    def __init__(self, session: ReplaySession, talker_id: str, frames: List[Tuple[int, bytes]]):
+        super().__init__()
+        self.session = session
+        self.talker_id = talker_id
+        self._frames = frames # (pts in samples from the start of the window, payload)
+        self._next = 0
+        self._released = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None # The loop of the sender pulling it (a media shard, maybe)
+
+    async def recv(self) -> Packet:
+        if self.readyState != "live":
+            raise MediaStreamError
+        self._loop = asyncio.get_running_loop()
+        if self._next >= len(self._frames):
+            if self._next == len(self._frames):
+                self._next += 1
+                media_shards.to_main(self.session.played_out)
+            await self._released.wait()
+            pts = self._frames[-1][0] + SAMPLE_RATE // 50 if self._frames else 0
+            return self._packet(pts, OPUS_SILENCE)
+        pts, payload = self._frames[self._next]
+        self._next += 1
+        if self.session.started is None:
+            self.session.started = time.monotonic()
+        wait = self.session.started + pts / SAMPLE_RATE - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        replay_buffer.frames_sent += 1
+        return self._packet(pts, payload)
+
+    @staticmethod
+    def _packet(pts: int, payload: bytes) -> Packet:
+        packet = Packet(payload)
+        packet.pts = pts
+        packet.time_base = _TIME_BASE
+        return packet
+
+    def stop(self):
+        call_in(self._loop, self._released.set)
+        super().stop()
+        if not self.session.finished:
+            self.session.finish() # Stopped from outside, e.g. the client's PC closed
+
+
+def _timeline(frames: List[Tuple[float, int, bytes]], window_start: float) -> List[Tuple[int, bytes]]:
+    """
+    Playback positions for one talker's frames. RTP timestamps keep the
+    talker's own frame spacing; arrival times place talk spurts relative to
+    the other talkers, and take over when the RTP clock jumps (new SSRC).
+    """
+    timeline = []
+    anchor_pts = anchor_ts = None
+    previous = -1
+    for arrival, rtp_timestamp, payload in frames:
+        by_arrival = int((arrival - window_start) * SAMPLE_RATE)
+        pts = None
+        if anchor_pts is not None:
+            pts = anchor_pts + (rtp_timestamp - anchor_ts) % _RTP_WRAP
+            if pts <= previous or abs(pts - by_arrival) > SAMPLE_RATE:
+                pts = None
+        if pts is None:
+            pts = max(by_arrival, previous + 1)
+            anchor_pts, anchor_ts = pts, rtp_timestamp
+        timeline.append((pts, payload))
+        previous = pts
+    return timeline
+
+
+class ReplayBuffer:
+    """
+    Instant replay: keeps the last few seconds of every channel and plays
+    them back to a client on request.
+
+    Incoming RTP from talkers is copied into their current channel's ring
+    (see ReplayRing) before aiortc decodes it, skipping frames marked as
+    silence; the tap also notes each talker's latest audio level for the
+    admin stream. A replay snapshots the requested window and sends it to the
+    requesting client as extra tracks, one per talker, leaving the live
+    routes alone. Rings are sized from the channel's `replay_seconds`
+    (server default if unset, 0 disables) and allocated on the channel's
+    first frame.
+    """
+
+    def __init__(self, default_seconds: int, bytes_per_second: int, frames_per_second: int,
+                 max_streams: int, start_timeout: float):
+        self.default_seconds = default_seconds
+        self.bytes_per_second = bytes_per_second
+        self.frames_per_second = frames_per_second
+        self.max_streams = max_streams
+        self.start_timeout = start_timeout
+        self._rings: Dict[str, Optional[ReplayRing]] = {} # None: replay disabled for the channel
+        self.sessions: Dict[str, ReplaySession] = {}
+        self.levels: Dict[str, Tuple[int, float]] = {} # talker_id -> (latest ssrc-audio-level, monotonic time), for the admin stream
+        self.captured_receivers = 0
+        self.replays = 0
+        self.empty_replays = 0
+        self.frames_sent = 0
+        self.snapshots = 0
+        self.snapshot_time = 0.0
+
+    def seconds_for(self, channel_id: str) -> int:
+        channel = active_channels.get(channel_id)
+        if channel is None:
+            return 0
+        return channel.replay_seconds if channel.replay_seconds is not None else self.default_seconds
+
+    def _ring(self, channel_id: str) -> Optional[ReplayRing]:
+        try:
+            return self._rings[channel_id]
+        except KeyError:
+            seconds = self.seconds_for(channel_id)
+            ring = ReplayRing(seconds, self.bytes_per_second, self.frames_per_second) if seconds > 0 else None
+            self._rings[channel_id] = ring
+            return ring
+
+    def configure(self, channel_id: str):
+        """ Drops a channel's ring after its replay settings changed or it was removed; the next frame reallocates it. """
+        self._rings.pop(channel_id, None)
+
+    def capture(self, client_id: str, pc: RTCPeerConnection, track: MediaStreamTrack):
+        """ Taps the RTP receiver behind `track` so its Opus frames are recorded. """
+        for transceiver in pc.getTransceivers():
+            receiver = transceiver.receiver
+            if receiver.track is not track or "_handle_rtp_packet" in vars(receiver):
+                continue # Not this track's receiver, or already tapped
+            opus_types = set()
+            handle_rtp_packet = receiver._handle_rtp_packet
+
+            async def record_rtp_packet(packet: RtpPacket, arrival_time_ms: int):
+                if not opus_types:
+                    opus_types.update(c.payloadType for c in transceiver._codecs if c.mimeType.lower() == "audio/opus")
+                if packet.payload_type in opus_types:
+                    media_shards.to_main(self.record, client_id, packet) # The rings are only written from the main loop
+                await handle_rtp_packet(packet, arrival_time_ms)
+
+            receiver._handle_rtp_packet = record_rtp_packet
+            self.captured_receivers += 1
+            return
+
+    def record(self, client_id: str, packet: RtpPacket):
+        level = packet.extensions.audio_level
+        now = time.monotonic()
+        if level is not None:
+            self.levels[client_id] = (level[1], now)
+        if not packet.payload or (level is not None and level[1] >= SILENCE_LEVEL):
+            return
+        client = active_clients.get(client_id)
+        if client is None:
+            return
+        for channel_id in client.talk_channels(): # An all-call is kept in every channel it reached
+            ring = self._ring(channel_id)
+            if ring is not None:
+                ring.append(client_id, now, packet.timestamp, packet.payload)
+
+    def forget(self, client_id: str):
+        self.levels.pop(client_id, None)
+
+    def open(self, client_id: str, channel_id: str, seconds: Optional[float],
+             on_finished: Callable[[ReplaySession], Awaitable[None]]) -> Optional[ReplaySession]:
+        """
+        Snapshots the last `seconds` (the whole ring if None) of a channel into
+        a session of ReplayTracks for `client_id`. Returns None if nothing was
+        recorded. `on_finished` is called once every track has played out, or
+        if the tracks are never pulled within `start_timeout` seconds; it must
+        detach the tracks from their senders and then call `close`.
+        """
+        ring = self._ring(channel_id)
+        if ring is None:
+            return None
+        started = time.perf_counter()
+        now = time.monotonic()
+        window = min(seconds, ring.seconds) if seconds else ring.seconds
+        frames = ring.window(window, now)
+        self.snapshot_time += time.perf_counter() - started
+        self.snapshots += 1
+        if not frames:
+            self.empty_replays += 1
+            return None
+        window_start = min(talker_frames[0][0] for talker_frames in frames.values())
+        # Most talkative first; quiet ones are left out rather than opening a stream each
+        talkers = sorted(frames, key=lambda talker_id: len(frames[talker_id]), reverse=True)[:self.max_streams]
+        session = ReplaySession(client_id, channel_id, now - window_start, on_finished)
+        for talker_id in talkers:
+            session.add(ReplayTrack(session, talker_id, _timeline(frames[talker_id], window_start)))
+        self.sessions[client_id] = session
+        self.replays += 1
+
+        def expire():
+            if session.started is None and not session.finished:
+                logger.info(f"Replay for {client_id} was never started, dropping it")
+                session.finish()
+
+        asyncio.get_running_loop().call_later(self.start_timeout, expire)
+        return session
+
+    def close(self, session: ReplaySession):
+        session.stop()
+        if self.sessions.get(session.client_id) is session:
+            del self.sessions[session.client_id]
+
+    def stats(self) -> Dict[str, object]:
+        now = time.monotonic()
+        rings = {channel_id: ring.stats(now) for channel_id, ring in self._rings.items() if ring is not None}
+        return {
+            "default_seconds": self.default_seconds,
+            "bytes_per_second": self.bytes_per_second,
+            "frames_per_second": self.frames_per_second,
+            "allocated_bytes": sum(ring["allocated_bytes"] for ring in rings.values()),
+            "captured_receivers": self.captured_receivers,
+            "replays": self.replays,
+            "empty_replays": self.empty_replays,
+            "active": {client_id: {"channel_id": s.channel_id, "seconds": round(s.seconds, 1), "tracks": len(s.tracks)}
+                       for client_id, s in self.sessions.items()},
+            "frames_sent": self.frames_sent,
+            "avg_snapshot_ms": round(self.snapshot_time / self.snapshots * 1000, 2) if self.snapshots else None,
+            "channels": rings,
+        }
+
+
+replay_buffer = ReplayBuffer(
+    default_seconds=config.REPLAY_SECONDS,
+    bytes_per_second=config.REPLAY_BYTES_PER_SECOND,
+    frames_per_second=config.REPLAY_FRAMES_PER_SECOND,
+    max_streams=config.REPLAY_MAX_STREAMS,
+    start_timeout=config.REPLAY_START_TIMEOUT,
+)
+resources.add_finalizer(replay_buffer.forget)
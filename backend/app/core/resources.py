@@ -0,0 +1,255 @@
+import asyncio
+import gc
+import logging
+import sys
+import threading
+import types
+import weakref
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from fastapi import WebSocket
+from av import AudioFrame
+from aiortc import RTCPeerConnection, RTCRtpSender
+from aiortc.mediastreams import MediaStreamTrack
+from aiortc.rtcpeerconnection import and_direction
+
+from .shards import media_shards
+
+logger = logging.getLogger(__name__)
+
+MEMORY_WALK_LIMIT = 20000 # Objects visited per client when estimating its memory
+# Never walked into: they lead to state shared by the whole server
+_SHARED_TYPES = (type, types.ModuleType, types.CodeType, logging.Logger, asyncio.AbstractEventLoop, threading.Thread, WebSocket)
+
+
+def release_sender(pc: RTCPeerConnection, sender: RTCRtpSender):
+    """ Detaches `sender`'s track and stops offering to send on its transceiver, so addTrack can reuse it. """
+    for transceiver in pc.getTransceivers():
+        if transceiver.sender is sender:
+            sender.replaceTrack(None)
+            sender._enabled = True # Congestion control may have muted the talker it carried; the next one starts audible
+            transceiver.direction = and_direction(transceiver.direction, "recvonly")
+            return
+
+
+class ClientResources:
+    """ What one client owns: its PC, the handlers registered on its PC and tracks, and tracks made for it. """
+
+    __slots__ = ("pc", "handlers", "tracks")
+
+    def __init__(self):
+        self.pc: Optional[RTCPeerConnection] = None
+        self.handlers: Dict[Tuple[int, str, str], Tuple[object, str, Callable]] = {} # (id(emitter), event, name) -> (emitter, event, registered fn)
+        self.tracks: "weakref.WeakSet[MediaStreamTrack]" = weakref.WeakSet() # Stopped at teardown if still alive
+
+
+class ResourceRegistry:
+    """
+    Owns the media resources of every client so they are released exactly once.
+
+    Event handlers go through on(): one handler per emitter, event and
+    handler name, so an offer applied to a reused PC replaces its
+    connectionstatechange and track handlers instead of stacking another
+    closure on top. Tracks created for a client (direct route legs,
+    replays) are registered with own(). teardown() runs in a fixed order:
+    handlers off first, so closing the PC doesn't call back into a client
+    that is going away, then owned tracks stopped, then the PC closed on
+    its shard. Modules keeping per-client state that the registry doesn't
+    own add a finalizer, which teardown() calls with the client ID.
+
+    Everything torn down is remembered weakly, so stats() can tell whether
+    anything is still holding on to closed PCs or ended tracks. Relay
+    subscriptions are counted on the tracks that make them (those with a
+    `subscribed` property, i.e. direct route legs), live and retired.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, ClientResources] = {}
+        self._finalizers: List[Callable[[str], None]] = []
+        self._retired: "weakref.WeakSet[object]" = weakref.WeakSet()
+        self.registered = 0
+        self.replaced = 0
+        self.removed = 0
+        self.torn_down = 0
+        self.pcs_closed = 0
+
+    def _get(self, client_id: str) -> ClientResources:
+        resources = self._clients.get(client_id)
+        if resources is None:
+            resources = self._clients[client_id] = ClientResources()
+        return resources
+
+    def add_finalizer(self, finalizer: Callable[[str], None]):
+        self._finalizers.append(finalizer)
+
+    def attach_pc(self, client_id: str, pc: RTCPeerConnection):
+        resources = self._get(client_id)
+        if resources.pc is not None and resources.pc is not pc:
+            self.off(client_id, resources.pc)
+            self._retired.add(resources.pc)
+        resources.pc = pc
+
+    def on(self, client_id: str, emitter, event: str, handler: Callable):
+        """
+        Registers `handler` for `event` on `emitter` (a PC or a track) on
+        behalf of a client, replacing the one registered earlier under the
+        same name. The handler runs on the main loop whichever shard emits.
+        """
+        resources = self._get(client_id)
+        key = (id(emitter), event, handler.__name__)
+        previous = resources.handlers.pop(key, None)
+        if previous is not None:
+            emitter.remove_listener(event, previous[2])
+            self.replaced += 1
+        registered = media_shards.on_main(handler)
+        emitter.on(event, registered)
+        resources.handlers[key] = (emitter, event, registered)
+        self.registered += 1
+
+    def off(self, client_id: str, emitter):
+        """ Removes every handler a client registered on `emitter`, e.g. once a track has ended. """
+        resources = self._clients.get(client_id)
+        if resources is None:
+            return
+        for key in [key for key in resources.handlers if key[0] == id(emitter)]:
+            _, event, registered = resources.handlers.pop(key)
+            try:
+                emitter.remove_listener(event, registered)
+            except KeyError:
+                pass
+            self.removed += 1
+
+    def own(self, client_id: str, track: MediaStreamTrack):
+        self._get(client_id).tracks.add(track)
+
+    async def close_pc(self, client_id: str, pc: RTCPeerConnection):
+        """ Closes one PC of a client that stays connected, e.g. a failed one about to be replaced. """
+        self.off(client_id, pc)
+        resources = self._clients.get(client_id)
+        if resources is not None and resources.pc is pc:
+            resources.pc = None
+        await self._close(client_id, pc)
+
+    async def _close(self, client_id: str, pc: RTCPeerConnection):
+        for transceiver in pc.getTransceivers():
+            if transceiver.receiver.track is not None:
+                self._retired.add(transceiver.receiver.track)
+        try:
+            await media_shards.run(client_id, pc.close())
+        except Exception as e:
+            logger.error(f"Error closing PeerConnection for {client_id}: {e}")
+        self._retired.add(pc)
+        self.pcs_closed += 1
+
+    async def teardown(self, client_id: str, pc: Optional[RTCPeerConnection] = None):
+        """ Releases everything a departing client owns. Safe to call more than once. """
+        resources = self._clients.pop(client_id, None)
+        if resources is not None:
+            for emitter, event, registered in resources.handlers.values():
+                try:
+                    emitter.remove_listener(event, registered)
+                except KeyError:
+                    pass
+                self.removed += 1
+            for track in list(resources.tracks):
+                track.stop()
+                self._retired.add(track)
+            pc = pc or resources.pc
+            self.torn_down += 1
+        if pc is not None:
+            await self._close(client_id, pc)
+        media_shards.release(client_id)
+        for finalizer in self._finalizers:
+            try:
+                finalizer(client_id)
+            except Exception as e:
+                logger.error(f"Resource finalizer {finalizer!r} failed for {client_id}: {e}")
+
+    def _estimate(self, root: object, boundary: Set[int]) -> Tuple[int, bool]:
+        """ Rough bytes reachable from `root` without crossing into shared objects. Returns (bytes, whether the walk was cut short). """
+        seen = set(boundary)
+        stack = [root]
+        total = visited = 0
+        while stack and visited < MEMORY_WALK_LIMIT:
+            obj = stack.pop()
+            if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+                continue
+            seen.add(id(obj))
+            visited += 1
+            total += sys.getsizeof(obj, 0)
+            if isinstance(obj, AudioFrame):
+                total += sum(plane.buffer_size for plane in obj.planes)
+            stack.extend(gc.get_referents(obj))
+        return total, bool(stack)
+
+    def memory(self) -> Dict[str, Dict[str, object]]:
+        """ Per-client memory estimates. Walks object graphs, so only for the debug endpoint. """
+        # Module globals and everyone else's PCs and received tracks are not the client's own
+        boundary = {id(vars(module)) for module in list(sys.modules.values()) if module is not None}
+        for resources in self._clients.values():
+            if resources.pc is not None:
+                boundary.add(id(resources.pc))
+                boundary.update(id(t.receiver.track) for t in resources.pc.getTransceivers() if t.receiver.track is not None)
+        estimates = {}
+        for client_id, resources in list(self._clients.items()):
+            roots = [resources.handlers, list(resources.tracks)]
+            if resources.pc is not None:
+                own = {id(resources.pc)} | {id(t.receiver.track) for t in resources.pc.getTransceivers() if t.receiver.track is not None}
+                roots.append(resources.pc)
+                size, truncated = self._estimate(roots, boundary - own)
+            else:
+                size, truncated = self._estimate(roots, boundary)
+            estimates[client_id] = {"bytes": size, "truncated": truncated}
+        return estimates
+
+    def stats(self, memory: bool = False, collect: bool = False) -> Dict[str, object]:
+        if collect:
+            gc.collect() # So "retired_alive" only counts objects something still references
+        pcs = [resources.pc for resources in self._clients.values() if resources.pc is not None]
+        states: Dict[str, int] = {}
+        transceivers = senders_live = senders_idle = receiving = 0
+        for pc in pcs:
+            states[pc.connectionState] = states.get(pc.connectionState, 0) + 1
+            for transceiver in pc.getTransceivers():
+                transceivers += 1
+                if transceiver.sender.track is not None:
+                    senders_live += 1
+                else:
+                    senders_idle += 1
+                if transceiver.receiver.track is not None and transceiver.receiver.track.readyState == "live":
+                    receiving += 1
+        subscriptions = sum(
+            1 for resources in self._clients.values() for track in list(resources.tracks) if getattr(track, "subscribed", False)
+        )
+        retired: Dict[str, int] = {}
+        retired_subscriptions = 0
+        for obj in list(self._retired):
+            name = type(obj).__name__
+            retired[name] = retired.get(name, 0) + 1
+            retired_subscriptions += getattr(obj, "subscribed", False)
+        stats: Dict[str, object] = {
+            "clients": len(self._clients),
+            "pcs": len(pcs),
+            "pc_states": states,
+            "transceivers": transceivers,
+            "senders_live": senders_live,
+            "senders_idle": senders_idle,
+            "tracks_receiving": receiving,
+            "handlers": sum(len(resources.handlers) for resources in self._clients.values()),
+            "owned_tracks": sum(len(resources.tracks) for resources in self._clients.values()),
+            "bridges": media_shards.stats()["bridges_active"],
+            "registered": self.registered,
+            "replaced": self.replaced,
+            "removed": self.removed,
+            "torn_down": self.torn_down,
+            "pcs_closed": self.pcs_closed,
+            "retired_alive": retired,
+            "relay_subscriptions": subscriptions,
+            "relay_subscriptions_retired": retired_subscriptions, # Should stay 0: stopped legs unsubscribe
+        }
+        if memory:
+            stats["memory"] = self.memory()
+        return stats
+
+
+resources = ResourceRegistry()
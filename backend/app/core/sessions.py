@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import secrets
+from typing import Dict, List, Optional, Set
+
+from fastapi import WebSocket
+
+from . import config
+from ..models.client import Client, ClientStatus
+from .state import active_clients, handle_disconnect
+
+logger = logging.getLogger(__name__)
+
+
+class SessionManager:
+    """
+    Keeps an authorized client's state (PC, tracks, subscriptions) alive for a
+    grace period after its WebSocket drops, so a reconnect presenting the
+    session's resume token can reattach without any media teardown or
+    renegotiation of other listeners.
+    """
+
+    def __init__(self, grace_period: float):
+        self.grace_period = grace_period
+        self._expiry: Dict[str, asyncio.TimerHandle] = {} # Suspended client_id -> grace timer
+        # Clients whose PC changed while suspended and need an offer on resume
+        self.pending_renegotiation: Set[str] = set()
+        self.resumed_total = 0
+        self.expired_total = 0
+
+    def issue_token(self, client: Client) -> str:
+        client.resume_token = secrets.token_urlsafe(24)
+        return client.resume_token
+
+    def is_suspended(self, client_id: str) -> bool:
+        return client_id in self._expiry
+
+    def suspended_count(self) -> int:
+        return len(self._expiry)
+
+    def suspended_ids(self) -> List[str]:
+        return list(self._expiry)
+
+    def suspend(self, client: Client) -> bool:
+        """
+        Detaches a dropped WebSocket from the client and starts the grace timer.
+        Returns False if the session isn't worth keeping (not authorized, no
+        live PC, or resumption disabled); the caller should disconnect it.
+        """
+        pc = client.pc
+        if (self.grace_period <= 0 or client.status != ClientStatus.AUTHORIZED or not client.resume_token
+                or pc is None or pc.connectionState in ("failed", "closed")):
+            return False
+        client.websocket = None
+        loop = asyncio.get_running_loop()
+        self._expiry[client.id] = loop.call_later(self.grace_period, lambda: loop.create_task(self._expire(client.id)))
+        logger.info(f"Suspended session for {client.id}; resumable for {self.grace_period:.0f}s")
+        return True
+
+    def resume(self, client: Client, token: Optional[str], websocket: WebSocket) -> bool:
+        """ Reattaches `websocket` to a suspended client if `token` matches. """
+        timer = self._expiry.get(client.id)
+        if timer is None or not token or not client.resume_token:
+            return False
+        if not secrets.compare_digest(token, client.resume_token):
+            logger.warning(f"Invalid resume token presented for {client.id}")
+            return False
+        timer.cancel()
+        del self._expiry[client.id]
+        client.websocket = websocket
+        self.resumed_total += 1
+        logger.info(f"Resumed session for {client.id} without media teardown")
+        return True
+
+    async def end(self, client_id: str):
+        """ Ends a suspended session now, e.g. because its PC failed. """
+        timer = self._expiry.pop(client_id, None)
+        if timer:
+            timer.cancel()
+        self.pending_renegotiation.discard(client_id)
+        await handle_disconnect(client_id)
+
+    async def _expire(self, client_id: str):
+        if self._expiry.pop(client_id, None) is None:
+            return
+        self.pending_renegotiation.discard(client_id)
+        client = active_clients.get(client_id)
+        if client and client.websocket is None:
+            self.expired_total += 1
+            logger.info(f"Resume grace period expired for {client_id}")
+            await handle_disconnect(client_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "grace_period": self.grace_period,
+            "suspended": len(self._expiry),
+            "resumed_total": self.resumed_total,
+            "expired_total": self.expired_total,
+        }
+
+
+session_manager = SessionManager(grace_period=config.SESSION_RESUME_GRACE)
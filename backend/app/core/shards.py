@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple, TypeVar
+
+from av import AudioFrame
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+
+from . import config
+
+try:
+    import uvloop
+except ImportError: # Windows, or uvicorn installed without [standard]
+    uvloop = None
+
+logger = logging.getLogger(__name__)
+
+BRIDGE_QUEUE_FRAMES = 10 # Frames a bridge holds for a sender that isn't pulling; bounds added latency to ~200 ms
+LAG_PROBE_INTERVAL = 0.5 # Seconds between a shard's lag/CPU samples
+
+T = TypeVar("T")
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def call_in(loop: Optional[asyncio.AbstractEventLoop], callback: Callable, *args):
+    """ Runs `callback` on `loop`: right away if that is this thread's loop (or None), otherwise thread-safely. """
+    if loop is None or loop is _running_loop():
+        callback(*args)
+    else:
+        loop.call_soon_threadsafe(callback, *args)
+
+
+def origin(track: Optional[MediaStreamTrack]) -> Optional[MediaStreamTrack]:
+    """ The talker's own track behind a bridge, or the track itself. """
+    return getattr(track, "origin", track)
+
+
+class MediaShard:
+    """ One media event loop on its own thread, with lag and CPU samples taken from inside it. """
+
+    def __init__(self, index: int):
+        self.index = index
+        self.loop = uvloop.new_event_loop() if uvloop else asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=f"media-shard-{index}", daemon=True)
+        self.clients: Set[str] = set()
+        self.lag_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.cpu = 0.0 # Fraction of one core this thread used over the last probe interval
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self._probe())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        """ Cancels whatever still runs on the shard, then stops its loop; called from the main thread. """
+        def shutdown():
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+            self.loop.call_soon(self.loop.stop) # After the cancellations have been delivered
+        self.loop.call_soon_threadsafe(shutdown)
+
+    async def _probe(self):
+        while True:
+            started, cpu_started = self.loop.time(), time.thread_time()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            elapsed = self.loop.time() - started
+            self.lag_ms = max(0.0, elapsed - LAG_PROBE_INTERVAL) * 1000
+            self.max_lag_ms = max(self.max_lag_ms, self.lag_ms)
+            self.cpu = (time.thread_time() - cpu_started) / elapsed if elapsed > 0 else 0.0
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "clients": len(self.clients),
+            "lag_ms": round(self.lag_ms, 2),
+            "max_lag_ms": round(self.max_lag_ms, 2),
+            "cpu_pct": round(self.cpu * 100, 1),
+        }
+
+
+class _Fanout:
+    """ Reads one talker's track on its own shard and hands every frame to the bridges carrying it elsewhere. """
+
+    def __init__(self, track: MediaStreamTrack, loop: asyncio.AbstractEventLoop):
+        self.track = track
+        self.loop = loop
+        self.bridges: Set["BridgeTrack"] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def attach(self, bridge: "BridgeTrack"):
+        self.bridges.add(bridge)
+        if self._task is None:
+            self._task = self.loop.create_task(self._run())
+
+    def detach(self, bridge: "BridgeTrack"):
+        self.bridges.discard(bridge)
+        if not self.bridges and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        try:
+            while True:
+                frame = await self.track.recv()
+                for bridge in list(self.bridges):
+                    bridge.push(frame)
+        except MediaStreamError:
+            for bridge in list(self.bridges):
+                bridge.push(None)
+        except asyncio.CancelledError:
+            pass
+
+
+class BridgeTrack(MediaStreamTrack):
+    """
+    A talker's track as seen from another shard. Frames are handed over by
+    the talker's shard with call_soon_threadsafe into a short queue owned by
+    the listener's shard; when the queue is full the oldest frame goes, so a
+    stalled sender can't build up latency. Frames are only pumped while
+    something pulls the bridge.
+    """
+
+    kind = "audio"
+
+    def __init__(self, track: MediaStreamTrack, fanout: _Fanout, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self.origin = track
+        self._fanout = fanout
+        self._loop = loop
+        self._frames: Deque[Optional[AudioFrame]] = deque(maxlen=BRIDGE_QUEUE_FRAMES)
+        self._waiter: Optional[asyncio.Future] = None
+        self._attached = False
+        self.frames = 0
+        self.dropped = 0
+
+    def push(self, frame: Optional[AudioFrame]):
+        """ Called on the talker's shard. """
+        self._loop.call_soon_threadsafe(self._deliver, frame)
+
+    def _deliver(self, frame: Optional[AudioFrame]):
+        if len(self._frames) == BRIDGE_QUEUE_FRAMES:
+            self.dropped += 1
+        self._frames.append(frame)
+        self.frames += 1
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def recv(self) -> AudioFrame:
+        if not self._attached:
+            self._attached = True
+            call_in(self._fanout.loop, self._fanout.attach, self)
+        while not self._frames:
+            if self.readyState != "live":
+                raise MediaStreamError
+            self._waiter = self._loop.create_future()
+            await self._waiter
+        frame = self._frames.popleft()
+        if frame is None:
+            self.stop()
+            raise MediaStreamError
+        return frame
+
+    def stop(self):
+        if self.readyState == "live":
+            if self._attached:
+                call_in(self._fanout.loop, self._fanout.detach, self)
+            call_in(self._loop, self._wake)
+        super().stop()
+
+
+class MediaShards:
+    """
+    Spreads PeerConnections over `count` media event loops, each on its own
+    thread (running uvloop when it is installed), instead of running every
+    PC's ICE, DTLS, SRTP and codec work on the loop that also does signaling.
+
+    A client is placed on the least loaded shard when its first PC is built,
+    and that PC is created, negotiated and closed there, so all of its
+    sockets and tasks live on the shard. Everything else stays on the main
+    loop: events a PC or track emits are handed back to it (on_main), and
+    handlers reach into a shard only through run(). A listener on another
+    shard than the talker gets a BridgeTrack instead of the talker's track;
+    the talker's shard reads the track once and hands frames to every shard
+    that needs them.
+
+    The heavy parts of the media path (Opus, SRTP, DTLS) run in native code
+    that releases the GIL, which is what lets threads help at all; the
+    Python glue around them does not, so shards scale short of linearly.
+    With count 0 sharding is off and everything runs on the main loop.
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self.shards: List[MediaShard] = []
+        self._main: Optional[asyncio.AbstractEventLoop] = None
+        self._placement: Dict[str, MediaShard] = {} # client_id -> shard its PC lives on
+        self._fanouts: Dict[int, _Fanout] = {} # id(talker track) -> its fan-out
+        self._bridges: Dict[Tuple[int, int], BridgeTrack] = {} # (id(talker track), shard index) -> bridge
+        self.placed = 0
+        self.calls = 0
+        self.bridges_created = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.shards)
+
+    def start(self) -> bool:
+        """ Starts the shard threads. Returns whether sharding is on. """
+        if self.shards or self.count <= 0:
+            return self.enabled
+        self._main = asyncio.get_running_loop()
+        self.shards = [MediaShard(index) for index in range(self.count)]
+        for shard in self.shards:
+            shard.thread.start()
+        logger.info(f"Started {self.count} media shards ({'uvloop' if uvloop else 'asyncio'})")
+        return True
+
+    async def stop(self):
+        shards, self.shards = self.shards, []
+        for shard in shards:
+            shard.stop()
+        for shard in shards:
+            await asyncio.to_thread(shard.thread.join, 5.0)
+        self._main = None
+        self._placement.clear()
+        self._fanouts.clear()
+        self._bridges.clear()
+
+    def assign(self, client_id: str) -> Optional[MediaShard]:
+        """ The shard for a client's PC: where it already is, else the one with the fewest clients. None if sharding is off. """
+        if not self.shards:
+            return None
+        shard = self._placement.get(client_id)
+        if shard is None:
+            shard = min(self.shards, key=lambda candidate: len(candidate.clients))
+            shard.clients.add(client_id)
+            self._placement[client_id] = shard
+            self.placed += 1
+        return shard
+
+    def release(self, client_id: str):
+        shard = self._placement.pop(client_id, None)
+        if shard is not None:
+            shard.clients.discard(client_id)
+
+    async def run(self, client_id: str, coro: Awaitable[T]) -> T:
+        """ Awaits `coro` on the client's shard, or right here when the client has none. """
+        shard = self._placement.get(client_id)
+        if shard is None:
+            return await coro
+        self.calls += 1
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, shard.loop))
+
+    async def call(self, client_id: str, fn: Callable[..., T], *args) -> T:
+        """ Like run(), for a plain function (e.g. one that builds a PC). """
+        async def invoke():
+            return fn(*args)
+        return await self.run(client_id, invoke())
+
+    def on_main(self, handler: Callable[..., Awaitable[None]]) -> Callable:
+        """ Wraps a PC or track event handler so it runs on the main loop, whichever shard emits the event. """
+        main = self._main
+        if main is None:
+            return handler
+
+        def forward(*args):
+            call_in(main, lambda: main.create_task(handler(*args)))
+        return forward
+
+    def to_main(self, callback: Callable, *args):
+        """ Runs a plain callback on the main loop; directly when sharding is off. """
+        call_in(self._main, callback, *args)
+
+    def bridge(self, track: MediaStreamTrack, talker_id: str, listener_id: str) -> MediaStreamTrack:
+        """
+        What `listener_id`'s PC sends to carry `talker_id`'s `track`: the track
+        itself on the same shard, otherwise that shard's bridge for it. The
+        same object comes back every time, so senders can be matched against it.
+        """
+        source = self._placement.get(talker_id)
+        target = self._placement.get(listener_id)
+        if source is None or target is None or source is target:
+            return track
+        key = (id(track), target.index)
+        bridge = self._bridges.get(key)
+        if bridge is None or bridge.readyState != "live":
+            fanout = self._fanouts.get(id(track))
+            if fanout is None:
+                fanout = self._fanouts[id(track)] = _Fanout(track, source.loop)
+            bridge = self._bridges[key] = BridgeTrack(track, fanout, target.loop)
+            self.bridges_created += 1
+        return bridge
+
+    def drop_track(self, track: MediaStreamTrack):
+        """ Stops every bridge carrying `track`; called once the talker's track has ended. """
+        for key in [key for key, bridge in self._bridges.items() if bridge.origin is track]:
+            self._bridges.pop(key).stop()
+        self._fanouts.pop(id(track), None)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.enabled,
+            "count": self.count,
+            "loop": "uvloop" if uvloop else "asyncio",
+            "placed": self.placed,
+            "calls": self.calls,
+            "bridges_active": len(self._bridges),
+            "bridges_created": self.bridges_created,
+            "frames_bridged": sum(bridge.frames for bridge in self._bridges.values()),
+            "frames_dropped": sum(bridge.dropped for bridge in self._bridges.values()),
+            "shards": [shard.stats() for shard in self.shards],
+        }
+
+
+media_shards = MediaShards(count=config.MEDIA_SHARDS)
@@ -1,13 +1,19 @@
+import asyncio
 import logging
-from typing import Dict, Optional, List
+from typing import Dict, Iterable, Optional, List, Set
 import json
 from fastapi import WebSocket # WebSocket needed for type hinting in Client and handle_disconnect
 from aiortc import RTCPeerConnection # For pcs dictionary type hint
 from aiortc.contrib.media import MediaRelay
 
 # Import models needed by functions/state here
-from ..models.client import Client, ClientStatus, ClientPublic # Import ClientPublic model
+from ..models.client import Client, ClientStatus
 from ..models.channel import Channel # Import Channel model
+from .permissions import permission_engine
+from .ice import candidate_buffer
+from .direct import direct_routes
+from .shards import media_shards
+from .resources import resources, release_sender
 
 logger = logging.getLogger(__name__)
 
@@ -20,16 +26,34 @@ active_clients: Dict[str, Client] = {}
 pcs: Dict[str, RTCPeerConnection] = {}
 
 # Store active channels (channel_id -> Channel object)
+# Loaded from and persisted by core.store; this dict is its in-memory cache
 active_channels: Dict[str, Channel] = {}
 
 # Used to forward media tracks between peers
 relay = MediaRelay()
 
+# Serializes SDP negotiation per client PC (client_id -> Lock), since signaling
+# and routing messages may be handled concurrently
+negotiation_locks: Dict[str, asyncio.Lock] = {}
+
+def known_channel_ids() -> Set[str]:
+    """ IDs of every channel clients can be routed to or granted permissions on. """
+    return set(active_channels)
+
+
+def get_negotiation_lock(client_id: str) -> asyncio.Lock:
+    """ Returns the lock guarding offer/answer exchanges on a client's PC. """
+    lock = negotiation_locks.get(client_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        negotiation_locks[client_id] = lock
+    return lock
+
 
 # --- Helper Functions (Now operate on the centralized state) ---
 
-async def notify_client_status(client_id: str, status: ClientStatus, message: Optional[str] = None, other_clients: List[ClientPublic] = []):
-    """ Sends a status update message to a specific client. """
+async def notify_client_status(client_id: str, status: ClientStatus, message: Optional[str] = None, other_clients: List[dict] = [], extra: Optional[dict] = None):
+    """ Sends a status update message to a specific client. `other_clients` are Client.public() views; `extra` fields are merged into the message. """
     client = active_clients.get(client_id)
     # Ensure client has an active websocket before trying to send
     if client and client.websocket and client.status != ClientStatus.DISCONNECTED:
@@ -37,7 +61,9 @@ async def notify_client_status(client_id: str, status: ClientStatus, message: Op
         if message:
             update_message["message"] = message
         update_message["client_id"] = client_id
-        update_message["current_clients"] = [c.model_dump() for c in other_clients] # Include list of other clients
+        update_message["current_clients"] = other_clients # Include list of other clients
+        if extra:
+            update_message.update(extra)
         try:
             await client.websocket.send_text(json.dumps(update_message))
             logger.debug(f"Sending status_update to {client_id} (including {len(other_clients)} other clients): {update_message}")
@@ -66,7 +92,7 @@ async def notify_client(client_id: str, message: dict):
 
 async def notify_client_update(updated_client_id: str, target_clients: List[Client]):
     """ Notifies a list of target clients about an update to a specific client's data. """
-    logger.info(f"Notifying {len(target_clients)} clients about update for {updated_client_id}")
+    logger.info(f"Notifying {len(target_clients)} clients about update for {updated_client_id}", extra={"subsystem": "presence"})
     
     # Fetch the updated client object from the central state
     updated_client = active_clients.get(updated_client_id)
@@ -74,30 +100,8 @@ async def notify_client_update(updated_client_id: str, target_clients: List[Clie
         logger.warning(f"Cannot notify update, client {updated_client_id} not found in active_clients.")
         return
 
-    # Prepare the public data representation of the updated client
-    try:
-        # Manually create the dictionary for ClientPublic data
-        client_public_data = {
-            "id": updated_client.id,
-            "name": updated_client.name,
-            "status": updated_client.status,
-            "current_channel_id": updated_client.current_channel_id,
-            "permissions": updated_client.permissions.model_dump() # Ensure permissions are serializable dict
-        }
-        # Validate the manually created dict
-        validated_public_data = ClientPublic.model_validate(client_public_data).model_dump()
-        logger.debug(f"Successfully serialized ClientPublic for {updated_client_id}")
-    except Exception as e:
-        logger.exception(f"CRITICAL: Error preparing/validating ClientPublic data for {updated_client_id}", exc_info=e)
-        return # Don't attempt to send if serialization failed
-
-    message = {
-        "type": "client_update",
-        "payload": {
-            "client": validated_public_data # Send the validated dictionary
-        }
-    }
-    message_json = json.dumps(message, default=str) # Use default=str for enums etc.
+    # The public view is cached on the client, so this is a string splice, not a re-serialization
+    message_json = '{"type": "client_update", "payload": {"client": ' + updated_client.public_json() + '}}'
 
     # Send the update to each target client
     disconnected_targets = []
@@ -106,7 +110,7 @@ async def notify_client_update(updated_client_id: str, target_clients: List[Clie
         if target_client.websocket and target_client.status != ClientStatus.DISCONNECTED:
             try:
                 await target_client.websocket.send_text(message_json)
-                logger.debug(f"Sent client_update about {updated_client_id} to {target_client.id}. Data: {message_json}")
+                logger.debug(f"Sent client_update about {updated_client_id} to {target_client.id}. Data: {message_json}", extra={"subsystem": "presence"})
             except Exception as e:
                 logger.warning(f"Failed to send client_update about {updated_client_id} to {target_client.id}: {e}")
                 disconnected_targets.append(target_client.id)
@@ -116,9 +120,39 @@ async def notify_client_update(updated_client_id: str, target_clients: List[Clie
         logger.info(f"Target client {target_id} disconnected during notify_client_update, potential cleanup needed.")
 
 
+async def notify_clients_update(updated_client_ids: Iterable[str], target_clients: List[Client]):
+    """ Like notify_client_update, but sends several clients' public views in one message. """
+    views = [active_clients[cid].public_json() for cid in updated_client_ids if cid in active_clients]
+    if not views:
+        return
+    message_json = '{"type": "clients_update", "payload": {"clients": [' + ", ".join(views) + ']}}'
+    for target_client in target_clients:
+        if target_client.websocket and target_client.status != ClientStatus.DISCONNECTED:
+            try:
+                await target_client.websocket.send_text(message_json)
+            except Exception as e:
+                logger.warning(f"Failed to send clients_update to {target_client.id}: {e}")
+
+
+async def notify_authorized(message_json: str):
+    """ Sends an already-encoded message to every authorized client with a live socket. """
+    for client in list(active_clients.values()):
+        if client.websocket and client.status == ClientStatus.AUTHORIZED:
+            try:
+                await client.websocket.send_text(message_json)
+            except Exception as e:
+                logger.warning(f"Failed to broadcast to {client.id}: {e}")
+
+
+async def notify_ducking(listener_ids: Iterable[str]):
+    """ Tells each listener's client how to duck its mix for the direct routes currently talking to it. """
+    for listener_id in listener_ids:
+        await notify_client(listener_id, {"type": "ducking", **direct_routes.ducking(listener_id)})
+
+
 async def notify_client_disconnect(disconnected_client_id: str, target_clients: List[Client]):
     """Notifies target clients that a specific client has disconnected."""
-    logger.info(f"Notifying {len(target_clients)} clients about disconnect of {disconnected_client_id}")
+    logger.info(f"Notifying {len(target_clients)} clients about disconnect of {disconnected_client_id}", extra={"subsystem": "presence"})
     message = {
         "type": "client_disconnect",
         "payload": {"client_id": disconnected_client_id}
@@ -130,7 +164,7 @@ async def notify_client_disconnect(disconnected_client_id: str, target_clients:
         if target_client.websocket and target_client.status != ClientStatus.DISCONNECTED:
             try:
                 await target_client.websocket.send_text(message_json)
-                logger.debug(f"Sent client_disconnect about {disconnected_client_id} to {target_client.id}")
+                logger.debug(f"Sent client_disconnect about {disconnected_client_id} to {target_client.id}", extra={"subsystem": "presence"})
             except Exception as e:
                 logger.warning(f"Failed to send client_disconnect about {disconnected_client_id} to {target_client.id}: {e}")
                 disconnected_targets.append(target_client.id)
@@ -154,6 +188,9 @@ async def handle_disconnect(client_id: str, websocket: Optional[WebSocket] = Non
     if not client_obj:
         logger.warning(f"handle_disconnect called for unknown or already cleaned client_id: {client_id}")
     else:
+        # Routes first, so the senders they shared with channel routing are free to be released below
+        ducked_listeners, orphaned_routes = direct_routes.forget(client_id)
+
         # --- Remove disconnecting client's track from listeners --- #
         disconnecting_track = client_obj.audio_track
         if disconnecting_track:
@@ -165,14 +202,15 @@ async def handle_disconnect(client_id: str, websocket: Optional[WebSocket] = Non
                     listener_client.pc):
 
                     sender_to_remove = None
+                    carried = media_shards.bridge(disconnecting_track, client_id, listener_id)
                     for sender in listener_client.pc.getSenders():
-                        if sender.track == disconnecting_track:
+                        if sender.track == carried:
                             sender_to_remove = sender
                             break
-                    if sender_to_remove:
+                    if sender_to_remove and not direct_routes.holds(sender_to_remove):
                         logger.info(f"Removing track {disconnecting_track.id} (from {client_id}) from listener {listener_id}'s PC due to disconnect.")
                         try:
-                            listener_client.pc.removeTrack(sender_to_remove)
+                            release_sender(listener_client.pc, sender_to_remove)
                             listeners_needing_update.add(listener_id)
                         except Exception as e:
                             logger.error(f"Error removing track {disconnecting_track.id} from {listener_id}'s PC during {client_id} disconnect: {e}")
@@ -180,15 +218,16 @@ async def handle_disconnect(client_id: str, websocket: Optional[WebSocket] = Non
                 logger.info(f"Listeners potentially needing update after {client_id} disconnected: {listeners_needing_update}")
                 # Note: Renegotiation might not be strictly necessary here,
                 # as the client-side should handle the track ending gracefully.
+            media_shards.drop_track(disconnecting_track)
 
         # Clean up associated PeerConnection first
+        negotiation_locks.pop(client_id, None)
+        candidate_buffer.forget(client_id)
+        permission_engine.forget(client_id)
         pc = pcs.pop(client_id, None)
         if pc:
             logger.info(f"Closing PeerConnection for client {client_id}")
-            try:
-                await pc.close()
-            except Exception as e:
-                logger.error(f"Error closing PeerConnection for {client_id}: {e}")
+        await resources.teardown(client_id, pc) # Handlers, owned tracks, then the PC itself
 
         # Clean up client state
         if client_obj.websocket:
@@ -211,5 +250,9 @@ async def handle_disconnect(client_id: str, websocket: Optional[WebSocket] = Non
         logger.info(f"Removed client {client_id} from active_clients.")
 
     # --- Notify other clients AFTER successful cleanup ---
+    if client_obj:
+        await notify_ducking(ducked_listeners)
+        for route in orphaned_routes:
+            await notify_client(route.talker_id, {"type": "direct_route_ended", "route_id": route.id, "reason": "listeners_left"})
     if other_authorized_clients:
         await notify_client_disconnect(client_id, other_authorized_clients)
@@ -0,0 +1,245 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from . import config
+from ..models.channel import Channel, ChannelGroup
+from ..models.permissions import ClientPermissions, PermissionTemplate, ClientPreset
+from .state import active_channels
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+# Every table has the same shape: a key, the record as JSON, and an insertion
+# sequence so lists come back in the order they were created
+_TABLES = ("channels", "permission_templates", "client_presets", "channel_groups")
+_SCHEMA = "".join(
+    f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, data TEXT NOT NULL, seq INTEGER NOT NULL);"
+    for table in _TABLES
+)
+_LOAD_ALL = " UNION ALL ".join(f"SELECT '{table}', key, data, seq FROM {table}" for table in _TABLES) + " ORDER BY 4"
+
+# Seeded into a brand-new database only
+DEFAULT_CHANNELS: List[Channel] = [
+    Channel(id="general", name="General Chat", description="Main discussion channel"),
+    Channel(id="production", name="Production Crew", description="Coordination for live production staff"),
+    Channel(id="stage", name="Stage Monitors", description="Audio feed for performers on stage"),
+]
+
+WriteKey = Tuple[str, str] # (table, key)
+
+
+class Store:
+    """
+    SQLite persistence for channels, channel groups, permission templates and
+    client presets.
+
+    The whole working set is loaded into memory at startup with a single
+    query, and every read is served from those dicts. Writes update the
+    in-memory copy immediately and are queued; a background task flushes the
+    queue every `flush_interval` seconds in one transaction, keeping only the
+    latest write per record. SQLite runs on its own thread, so neither
+    request handlers nor the WebSocket path ever wait on disk.
+    """
+
+    def __init__(self, path: str, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.channels: Dict[str, Channel] = active_channels # Shared with state, the routing code reads it directly
+        self.templates: Dict[str, PermissionTemplate] = {}
+        self.presets: Dict[str, ClientPreset] = {}
+        self.groups: Dict[str, ChannelGroup] = {}
+        self._pending: Dict[WriteKey, Optional[str]] = {} # None means delete
+        self._seq = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.load_ms = 0.0
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_errors = 0
+        self.last_flush_ms = 0.0
+
+    # --- Lifecycle ---
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="soundmesh-store")
+        started = time.perf_counter()
+        rows, fresh = await loop.run_in_executor(self._executor, self._connect_and_load)
+        for table, key, data, seq in rows:
+            record = json.loads(data)
+            if table == "channels":
+                self.channels[key] = Channel.model_validate(record)
+            elif table == "permission_templates":
+                self.templates[key] = PermissionTemplate.model_validate(record)
+            elif table == "channel_groups":
+                self.groups[key] = ChannelGroup.model_validate(record)
+            else:
+                self.presets[key] = ClientPreset.model_validate(record)
+            self._seq = max(self._seq, seq)
+        self.load_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"Loaded {len(self.channels)} channels, {len(self.groups)} groups, {len(self.templates)} templates and "
+                    f"{len(self.presets)} client presets from {self.path} in {self.load_ms:.1f}ms")
+
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._flusher())
+        if fresh:
+            for channel in DEFAULT_CHANNELS:
+                self.save_channel(channel.model_copy())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._executor:
+            await self.flush()
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._disconnect)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _connect_and_load(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        fresh = conn.execute("PRAGMA user_version").fetchone()[0] == 0
+        conn.executescript(_SCHEMA)
+        if fresh:
+            conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        self._conn = conn
+        return conn.execute(_LOAD_ALL).fetchall(), fresh
+
+    def _disconnect(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    # --- Write-behind ---
+
+    def _queue(self, table: str, key: str, data: Optional[str]):
+        self._pending[(table, key)] = data
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _flusher(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.flush_interval) # Let a burst of edits collapse into one transaction
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """ Writes everything queued so far in a single transaction. """
+        if not self._pending or not self._executor:
+            return
+        batch, self._pending = self._pending, {}
+        started = time.perf_counter()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write_batch, batch)
+        except Exception as e:
+            self.flush_errors += 1
+            logger.error(f"Failed to persist {len(batch)} store writes, will retry: {e}")
+            for key, data in batch.items():
+                self._pending.setdefault(key, data) # Newer writes queued meanwhile take precedence
+            return
+        self.flushes += 1
+        self.rows_written += len(batch)
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+    def _write_batch(self, batch: Dict[WriteKey, Optional[str]]):
+        upserts: Dict[str, List[Tuple[str, str, int]]] = {}
+        deletes: Dict[str, List[Tuple[str]]] = {}
+        for (table, key), data in batch.items():
+            if data is None:
+                deletes.setdefault(table, []).append((key,))
+            else:
+                self._seq += 1
+                upserts.setdefault(table, []).append((key, data, self._seq))
+        with self._conn:
+            for table, rows in deletes.items():
+                self._conn.executemany(f"DELETE FROM {table} WHERE key = ?", rows)
+            for table, rows in upserts.items():
+                # Keep the original seq on update so list order is creation order
+                self._conn.executemany(
+                    f"INSERT INTO {table} (key, data, seq) VALUES (?, ?, ?) "
+                    f"ON CONFLICT(key) DO UPDATE SET data = excluded.data", rows)
+
+    # --- Records (served from memory) ---
+
+    def save_channel(self, channel: Channel):
+        self.channels[channel.id] = channel
+        self._queue("channels", channel.id, channel.model_dump_json())
+
+    def delete_channel(self, channel_id: str) -> Optional[Channel]:
+        channel = self.channels.pop(channel_id, None)
+        if channel is not None:
+            self._queue("channels", channel_id, None)
+        return channel
+
+    def save_group(self, group: ChannelGroup):
+        self.groups[group.id] = group
+        self._queue("channel_groups", group.id, group.model_dump_json())
+
+    def delete_group(self, group_id: str) -> Optional[ChannelGroup]:
+        group = self.groups.pop(group_id, None)
+        if group is not None:
+            self._queue("channel_groups", group_id, None)
+        return group
+
+    def save_template(self, template: PermissionTemplate):
+        self.templates[template.id] = template
+        self._queue("permission_templates", template.id, template.model_dump_json())
+
+    def delete_template(self, template_id: str) -> Optional[PermissionTemplate]:
+        template = self.templates.pop(template_id, None)
+        if template is not None:
+            self._queue("permission_templates", template_id, None)
+        return template
+
+    def save_preset(self, client_id: str, preset: ClientPreset):
+        self.presets[client_id] = preset
+        self._queue("client_presets", client_id, preset.model_dump_json())
+
+    def delete_preset(self, client_id: str) -> Optional[ClientPreset]:
+        preset = self.presets.pop(client_id, None)
+        if preset is not None:
+            self._queue("client_presets", client_id, None)
+        return preset
+
+    def resolve_preset(self, client_id: str) -> Optional[ClientPermissions]:
+        """ The permissions a client's preset grants, if it has one. """
+        preset = self.presets.get(client_id)
+        if preset is None:
+            return None
+        if preset.permissions is not None:
+            return preset.permissions
+        template = self.templates.get(preset.template_id) if preset.template_id else None
+        return template.permissions if template else None
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "path": self.path,
+            "channels": len(self.channels),
+            "groups": len(self.groups),
+            "templates": len(self.templates),
+            "presets": len(self.presets),
+            "pending_writes": len(self._pending),
+            "load_ms": round(self.load_ms, 2),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "flush_errors": self.flush_errors,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+        }
+
+
+store = Store(path=config.DB_PATH, flush_interval=config.STORE_FLUSH_INTERVAL)
@@ -0,0 +1,256 @@
+import asyncio
+import ipaddress
+import logging
+import socket
+import struct
+from typing import Dict, List, Optional, Set, Tuple
+
+import aiortc.rtcicetransport
+from aioice import Connection, stun
+from aioice.candidate import Candidate, candidate_foundation, candidate_priority
+from aioice.ice import StunProtocol, get_host_addresses
+from aioice.utils import random_string
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+Addr = Tuple[str, int]
+
+_STUN_HEADER = struct.Struct("!HHI12s")
+_STUN_ATTR = struct.Struct("!HH")
+_BINDING_REQUEST = 0x0001
+_ATTR_USERNAME = 0x0006
+_SOCKET_BUFFER = 4 * 1024 * 1024 # Every PC's traffic lands on this one socket
+
+
+def stun_request_username(data: bytes) -> Optional[str]:
+    """ USERNAME of a STUN binding request, found without fully parsing the message. """
+    if len(data) < 20 or data[0] > 1: # STUN messages start with two zero bits
+        return None
+    msg_type, length, cookie, _ = _STUN_HEADER.unpack_from(data)
+    if msg_type != _BINDING_REQUEST or cookie != stun.COOKIE:
+        return None
+    pos, end = 20, min(len(data), 20 + length)
+    while pos + 4 <= end:
+        attr_type, attr_len = _STUN_ATTR.unpack_from(data, pos)
+        if attr_type == _ATTR_USERNAME:
+            return data[pos + 4:pos + 4 + attr_len].decode("utf8", "replace")
+        pos += 4 + attr_len + (-attr_len % 4)
+    return None
+
+
+def advertise_ice_lite(sdp: str) -> str:
+    """ Adds the session-level a=ice-lite attribute to an SDP (right after its t= line). """
+    if "\na=ice-lite" in sdp:
+        return sdp
+    lines = sdp.split("\r\n")
+    for i, line in enumerate(lines):
+        if line.startswith("t="):
+            lines.insert(i + 1, "a=ice-lite")
+            break
+    return "\r\n".join(lines)
+
+
+class _MuxedTransport(asyncio.DatagramTransport):
+    """ What an aioice StunProtocol sees as its socket: a slice of the shared mux socket. """
+
+    def __init__(self, mux: "UdpMux", protocol: StunProtocol, sockname: Addr):
+        super().__init__()
+        self._mux = mux
+        self._protocol = protocol
+        self._sockname = sockname
+        self._closing = False
+
+    def sendto(self, data, addr=None):
+        if not self._closing:
+            self._mux.send(self._protocol, data, (addr[0], addr[1]))
+
+    def get_extra_info(self, name, default=None):
+        return self._sockname if name == "sockname" else default
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            self._mux.detach(self._protocol)
+            asyncio.get_running_loop().call_soon(self._protocol.connection_lost, None)
+
+
+class UdpMux(asyncio.DatagramProtocol):
+    """
+    A single UDP socket shared by the ICE agents of every PeerConnection.
+
+    Instead of binding sockets and querying STUN for each PC, every agent gets
+    host candidates on this socket, at the addresses configured to be
+    advertised. Incoming datagrams are demultiplexed to the right agent:
+    STUN binding requests by the local ICE ufrag in their USERNAME, which
+    also teaches the mux the sender's address; everything else (STUN
+    responses, DTLS, SRTP) by the remote address. Gathering completes
+    instantly and the whole server needs one UDP port.
+    """
+
+    def __init__(self, bind_host: str, port: int, advertised_hosts: List[str], ice_lite: bool):
+        self.bind_host = bind_host
+        self.port = port
+        self.advertised_hosts = advertised_hosts
+        self.ice_lite = ice_lite
+        self.hosts: List[str] = []
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self._by_ufrag: Dict[str, List[StunProtocol]] = {}
+        self._by_addr: Dict[Addr, StunProtocol] = {}
+        self._addrs_of: Dict[StunProtocol, Set[Addr]] = {}
+        self.datagrams_in = 0
+        self.datagrams_out = 0
+        self.dropped = 0
+
+    @property
+    def running(self) -> bool:
+        return self.transport is not None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(self.bind_host, self.port))
+        sock = self.transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_BUFFER)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_BUFFER)
+        self.port = self.transport.get_extra_info("sockname")[1]
+        if self.advertised_hosts:
+            self.hosts = list(self.advertised_hosts)
+        elif self.bind_host in ("0.0.0.0", ""):
+            self.hosts = get_host_addresses(use_ipv4=True, use_ipv6=False)
+        else:
+            self.hosts = [self.bind_host]
+        # From now on every RTCIceGatherer aiortc creates uses the shared socket
+        aiortc.rtcicetransport.Connection = MuxedConnection
+        logger.info(f"Media UDP mux listening on {self.bind_host}:{self.port}, advertising {self.hosts}"
+                    f"{' (ICE-lite)' if self.ice_lite else ''}")
+
+    def stop(self):
+        if self.transport:
+            aiortc.rtcicetransport.Connection = Connection
+            self.transport.close()
+            self.transport = None
+
+    def has_ufrag(self, ufrag: str) -> bool:
+        return ufrag in self._by_ufrag
+
+    def attach(self, connection: Connection, component: int) -> List[Candidate]:
+        """ Gives an ICE agent one host candidate per advertised address, all on the shared socket. """
+        candidates = []
+        protocols = []
+        for host in self.hosts:
+            protocol = StunProtocol(connection)
+            protocol.connection_made(_MuxedTransport(self, protocol, (host, self.port)))
+            protocol.local_candidate = Candidate(
+                foundation=candidate_foundation("host", "udp", host),
+                component=component,
+                transport="udp",
+                priority=candidate_priority(component, "host"),
+                host=host,
+                port=self.port,
+                type="host",
+            )
+            protocols.append(protocol)
+            candidates.append(protocol.local_candidate)
+            self._addrs_of[protocol] = set()
+        connection._protocols += protocols
+        self._by_ufrag.setdefault(connection.local_username, []).extend(protocols)
+        return candidates
+
+    def detach(self, protocol: StunProtocol):
+        ufrag = protocol.receiver.local_username
+        siblings = self._by_ufrag.get(ufrag)
+        if siblings and protocol in siblings:
+            siblings.remove(protocol)
+            if not siblings:
+                del self._by_ufrag[ufrag]
+        for addr in self._addrs_of.pop(protocol, ()):
+            if self._by_addr.get(addr) is protocol:
+                del self._by_addr[addr]
+
+    def _learn(self, addr: Addr, protocol: StunProtocol):
+        previous = self._by_addr.get(addr)
+        if previous is not protocol:
+            if previous is not None:
+                self._addrs_of.get(previous, set()).discard(addr)
+            self._by_addr[addr] = protocol
+            self._addrs_of.setdefault(protocol, set()).add(addr)
+
+    def send(self, protocol: StunProtocol, data: bytes, addr: Addr):
+        if self.transport is None:
+            return
+        self._learn(addr, protocol) # So the peer's responses and media route back to this agent
+        self.transport.sendto(data, addr)
+        self.datagrams_out += 1
+
+    @staticmethod
+    def _pick(protocols: List[StunProtocol], addr: Addr) -> StunProtocol:
+        if len(protocols) == 1:
+            return protocols[0]
+        version = ipaddress.ip_address(addr[0]).version
+        for protocol in protocols:
+            if ipaddress.ip_address(protocol.local_candidate.host).version == version:
+                return protocol
+        return protocols[0]
+
+    # asyncio.DatagramProtocol
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        addr = (addr[0], addr[1])
+        self.datagrams_in += 1
+        protocol = None
+        username = stun_request_username(data)
+        if username:
+            protocols = self._by_ufrag.get(username.split(":", 1)[0])
+            if protocols:
+                protocol = self._pick(protocols, addr)
+                self._learn(addr, protocol)
+        if protocol is None:
+            protocol = self._by_addr.get(addr)
+        if protocol is None:
+            self.dropped += 1
+            return
+        protocol.datagram_received(data, addr)
+
+    def error_received(self, exc: Exception):
+        logger.debug(f"Media UDP mux error: {exc}")
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "enabled": self.running,
+            "port": self.port,
+            "advertised_hosts": self.hosts,
+            "ice_lite": self.ice_lite,
+            "agents": len(self._by_ufrag),
+            "remote_addresses": len(self._by_addr),
+            "datagrams_in": self.datagrams_in,
+            "datagrams_out": self.datagrams_out,
+            "dropped": self.dropped,
+        }
+
+
+class MuxedConnection(Connection):
+    """ aioice Connection whose candidates live on the shared UDP mux instead of per-PC sockets. """
+
+    async def gather_candidates(self) -> None:
+        if not self._local_candidates_start:
+            self._local_candidates_start = True
+            # The ufrag is the demux key, so it must be unique among live agents.
+            # aiortc reads it after gathering, so it can still be changed here.
+            while udp_mux.has_ufrag(self._local_username):
+                self._local_username = random_string(4)
+            for component in self._components:
+                self._local_candidates += udp_mux.attach(self, component)
+            self._local_candidates_end = True
+
+
+udp_mux = UdpMux(
+    bind_host=config.MEDIA_UDP_MUX_BIND,
+    port=config.MEDIA_UDP_MUX_PORT,
+    advertised_hosts=config.MEDIA_ADVERTISED_HOSTS,
+    ice_lite=config.MEDIA_ICE_LITE,
+)
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+class LoopWatchdog:
+    """
+    Measures event loop lag continuously and captures the stack of whatever is
+    blocking the loop when the lag passes a threshold.
+
+    A probe coroutine sleeps for a fixed interval and records how late it woke up.
+    A monitor thread watches the probe's heartbeat; because the loop thread is
+    stuck inside the offending callback while it stalls, the monitor can grab
+    that thread's current frame and the running task while it is still happening.
+    """
+
+    def __init__(self, interval: float, threshold: float, max_reports: int = 20):
+        self.interval = interval
+        self.threshold = threshold
+        self.reports: Deque[dict] = deque(maxlen=max_reports)
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._probe_task: Optional[asyncio.Task] = None
+        self._monitor_thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._last_beat = time.monotonic()
+        self._stall_captured = False
+
+        # Lag statistics (seconds)
+        self.samples = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.avg_lag = 0.0 # Exponentially weighted moving average
+        self.stalls = 0
+
+    @property
+    def loop_thread_id(self) -> Optional[int]:
+        return self._loop_thread_id
+
+    def start(self):
+        """ Starts probing the running loop. Must be called from inside the loop. """
+        if self._probe_task:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop_event.clear()
+        self._probe_task = self._loop.create_task(self._probe())
+        self._monitor_thread = threading.Thread(target=self._monitor, name="soundmesh-loop-watchdog", daemon=True)
+        self._monitor_thread.start()
+        logger.info(f"Loop watchdog started (interval={self.interval * 1000:.0f}ms, threshold={self.threshold * 1000:.0f}ms)")
+
+    async def stop(self):
+        self._stop_event.set()
+        if self._probe_task:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+        if self._monitor_thread:
+            self._monitor_thread.join(timeout=1.0)
+            self._monitor_thread = None
+
+    async def _probe(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self._record(lag)
+            self._last_beat = time.monotonic()
+
+    def _record(self, lag: float):
+        self.samples += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.avg_lag = lag if self.samples == 1 else self.avg_lag * 0.9 + lag * 0.1
+        if lag >= self.threshold:
+            self.stalls += 1
+            if self._stall_captured and self.reports:
+                # The monitor thread captured this stall while it was happening; fill in the final duration
+                self.reports[-1]["lag_ms"] = round(lag * 1000, 1)
+            else:
+                # Stall was shorter than the monitor's resolution, so only the duration is known
+                self.reports.append({"timestamp": time.time(), "lag_ms": round(lag * 1000, 1), "task": None, "stack": []})
+            logger.warning(f"Event loop lagged {lag * 1000:.1f}ms (threshold {self.threshold * 1000:.0f}ms)")
+        self._stall_captured = False
+
+    def _monitor(self):
+        check_every = max(self.interval / 2, 0.005)
+        while not self._stop_event.wait(check_every):
+            overdue = time.monotonic() - self._last_beat - self.interval
+            if overdue >= self.threshold and not self._stall_captured:
+                self._stall_captured = True
+                self.reports.append(self._capture(overdue))
+
+    def _capture(self, overdue: float) -> dict:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = traceback.format_stack(frame) if frame is not None else []
+        task_name = None
+        try:
+            task = asyncio.current_task(self._loop)
+            if task is not None:
+                task_name = f"{task.get_name()} {task.get_coro()!r}"
+        except Exception:
+            pass
+        logger.warning(f"Event loop blocked for {overdue * 1000:.0f}ms+ in task {task_name}:\n{''.join(stack[-8:])}")
+        return {
+            "timestamp": time.time(),
+            "lag_ms": round(overdue * 1000, 1),
+            "task": task_name,
+            "stack": [line.rstrip() for line in stack],
+        }
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "running": self._probe_task is not None,
+            "interval_ms": self.interval * 1000,
+            "threshold_ms": self.threshold * 1000,
+            "samples": self.samples,
+            "last_lag_ms": round(self.last_lag * 1000, 2),
+            "avg_lag_ms": round(self.avg_lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "stalls": self.stalls,
+        }
+
+    def recent_reports(self) -> List[dict]:
+        return list(self.reports)
+
+
+loop_watchdog = LoopWatchdog(
+    interval=config.LOOP_WATCHDOG_INTERVAL,
+    threshold=config.LOOP_LAG_THRESHOLD,
+    max_reports=config.LOOP_STALL_REPORTS,
+)
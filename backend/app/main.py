@@ -1,4 +1,4 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 from typing import Dict, Optional, List
@@ -6,19 +6,35 @@ from app.models.channel import Channel # Import Channel model
 import json
 import os
 
-from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer, RTCIceCandidate
-
-from .api.v1.endpoints import clients, channels
-from .models.client import Client, ClientStatus, ClientPublic, ClientAuthRequest
+from .api.v1.endpoints import clients, channels, groups, templates, server, debug
+from .models.client import Client, ClientStatus, ClientAuthRequest
 from .models.permissions import ClientPermissions, ChannelPermissions
 from .models.channel import Channel
 from .core.state import (
-    active_clients, pcs, relay, # State variables
+    active_clients, relay, # State variables
     # State manipulation/notification functions:
     notify_client_status, notify_client, notify_client_update, notify_client_disconnect, handle_disconnect
 ) # Adjusted imports based on state.py content
-
-logging.basicConfig(level=logging.INFO)
+from .core import config
+from .core.watchdog import loop_watchdog
+from .core.logs import log_pipeline, bind as bind_log_context
+from .core.handlers import dispatcher, ConnectionContext, report_error, trigger_renegotiation
+from .core.sessions import session_manager
+from .core.heartbeat import heartbeat
+from .core.store import store
+from .core.udpmux import udp_mux
+from .core.pcfactory import pc_factory
+from .core.opus import codec_profiles
+from .core.congestion import bandwidth_controller
+from .core.permissions import permission_engine
+from .core.dispatch import FloodDetected
+from .core.ratelimit import rest_rate_limit, ws_connect_limiter
+from .core.admission import admission, AdmissionRejected
+from .core.drain import drain
+from .core.adminstream import admin_stream
+from .core.shards import media_shards
+
+log_pipeline.configure() # Formats and writes on its own thread, off the event loop
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="SoundMesh Backend", version="0.1.0")
@@ -31,57 +47,106 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-RTC_CONFIG = RTCConfiguration(
-    iceServers=[RTCIceServer(urls=["stun:stun.l.google.com:19302"])]
-)
+@app.on_event("startup")
+async def start_background_services():
+    await store.open() # Loads channels, templates and presets before any client can connect
+    if config.MEDIA_UDP_MUX:
+        await udp_mux.start()
+    if config.MEDIA_SHARDS and udp_mux.running:
+        logger.warning("SOUNDMESH_MEDIA_SHARDS is ignored while the UDP mux is on; all media stays on the main loop")
+    elif media_shards.start():
+        pc_factory.pool_size = 0 # Warm PCs gather on this loop, and a sharded PC must be built on its shard
+    pc_factory.start() # After the mux, so warm PCs gather on it
+    codec_profiles.install()
+    if config.CONGESTION_CONTROL:
+        bandwidth_controller.start()
+    if config.LOOP_WATCHDOG_ENABLED:
+        loop_watchdog.start()
+    heartbeat.start()
+    drain.install_signal_handler(config.DRAIN_SIGNAL)
+
+@app.on_event("shutdown")
+async def stop_background_services():
+    await loop_watchdog.stop()
+    await heartbeat.stop()
+    await admin_stream.stop() # Ends open dashboard streams so the server isn't held open by them
+    await store.close() # Flushes any writes still queued
+    await bandwidth_controller.stop()
+    await pc_factory.stop()
+    await media_shards.stop()
+    codec_profiles.uninstall()
+    udp_mux.stop()
+    log_pipeline.stop() # Last, so shutdown messages are written out
 
 @app.get("/")
 async def read_root():
     return {"message": "SoundMesh Backend is running"}
 
-# Note: In a real app, channels would be stored persistently (e.g., database)
-# and managed via CRUD operations.
-# For now, a static list:
-mock_channels_list: List[Channel] = [
-    Channel(id="general", name="General Chat", description="Main discussion channel"),
-    Channel(id="production", name="Production Crew", description="Coordination for live production staff"),
-    Channel(id="stage", name="Stage Monitors", description="Audio feed for performers on stage")
-]
+@app.websocket("/ws/{client_id}")
+async def websocket_endpoint(websocket: WebSocket, client_id: str):
+    await websocket.accept()
+    remote_ip = websocket.client.host if websocket.client else None
+
+    # --- Flood protection and admission --- #
+    if drain.draining:
+        await drain.turn_away(websocket, client_id)
+        return
+    if remote_ip and not ws_connect_limiter.allow(remote_ip):
+        logger.warning(f"Connection rate limit exceeded for {remote_ip} (client {client_id}). Rejecting.")
+        await websocket.close(code=1013, reason="Too many connection attempts")
+        return
 
-# Endpoint to get available channels
-@app.get("/api/v1/channels", response_model=List[Channel], tags=["Channels"])
-async def get_channels():
-    """Returns a list of available communication channels."""
-    return mock_channels_list
+    async def send_queue_position(position: int, queue_length: int):
+        await websocket.send_json({
+            "type": "queue_position", "stage": "admission",
+            "position": position, "queue_length": queue_length
+        })
 
-# --- Helper Function for Renegotiation ---
-async def trigger_renegotiation(client_id: str):
-    """Initiates SDP renegotiation by sending a new offer to the client."""
-    listener_client = active_clients.get(client_id)
-    if not listener_client or not listener_client.pc or not listener_client.websocket:
-        logger.warning(f"Cannot trigger renegotiation for {client_id}: client/PC/websocket not found or not ready.")
+    try:
+        await admission.acquire(on_position=send_queue_position)
+    except AdmissionRejected as e:
+        logger.warning(f"Not admitting client {client_id} from {remote_ip}: {e}")
+        try:
+            await websocket.close(code=1013, reason=str(e))
+        except Exception:
+            pass
         return
 
-    pc = listener_client.pc
     try:
-        logger.info(f"Triggering renegotiation for {client_id}...")
-        offer = await pc.createOffer()
-        if not offer:
-             logger.error(f"Failed to create renegotiation offer for {client_id}")
-             return
-        await pc.setLocalDescription(offer)
-        logger.info(f"Sending renegotiation offer to {client_id}")
-        await notify_client(client_id, {
-            "type": "offer",
-            "sdp": pc.localDescription.sdp
-        })
-    except Exception as e:
-        logger.exception(f"Error during renegotiation trigger for {client_id}: {e}", exc_info=e)
+        await serve_client(websocket, client_id, remote_ip)
+    finally:
+        admission.release()
+
+def public_roster(exclude_client_id: str) -> List[dict]:
+    """ Cached public view of every other authorized client, for a status update. """
+    return [
+        c.public() for c in active_clients.values()
+        if c.id != exclude_client_id and c.status == ClientStatus.AUTHORIZED
+    ]
+
+async def release_connection(client_id: str, websocket: WebSocket):
+    """
+    Called when a client's WebSocket goes away. Suspends the session if it can
+    be resumed, otherwise runs the full disconnect cleanup. Does nothing if the
+    client has meanwhile been taken over by another socket (resumed elsewhere).
+    """
+    client = active_clients.get(client_id)
+    if not client or client.status == ClientStatus.DISCONNECTED:
+        logger.info(f"Client {client_id} already cleaned up or marked disconnected, skipping cleanup.")
+        return
+    if client.websocket is not websocket:
+        logger.info(f"Client {client_id} is now served by another connection, skipping cleanup.")
+        return
+    heartbeat.untrack(client_id)
+    if not drain.draining and session_manager.suspend(client): # A draining server won't be around to resume it
+        return
+    logger.info(f"Running disconnect cleanup for {client_id}")
+    await handle_disconnect(client_id)
 
-@app.websocket("/ws/{client_id}")
-async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await websocket.accept()
+async def serve_client(websocket: WebSocket, client_id: str, remote_ip: Optional[str]):
+    bind_log_context(client_id=client_id) # Also inherited by the lane workers and media tasks started from here
     logger.info(f"Potential client {client_id} connected, awaiting authentication.")
+    resume_target: Optional[Client] = None
 
     # Check if this is a reconnection or a new browser window with the same client ID
     if client_id in active_clients:
@@ -94,6 +159,7 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             import uuid
             original_client_id = client_id
             client_id = f"{client_id}_{str(uuid.uuid4())[:8]}"
+            bind_log_context(client_id=client_id)
             logger.warning(f"Detected multiple connections with same client ID. Original: {original_client_id}, New: {client_id}")
             
             # Inform this client that they've been assigned a new ID
@@ -106,13 +172,22 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                 })
             except Exception as e:
                 logger.error(f"Error sending client_id_changed notification: {e}")
+        elif session_manager.is_suspended(client_id):
+            # The previous socket dropped but its session (PC, tracks, subscriptions) is
+            # being kept alive; whether it is resumed depends on the resume token sent at auth
+            resume_target = existing_client
+            logger.info(f"Client {client_id} reconnected while its session is suspended. Awaiting resume token.")
         else:
             # This is a genuine reconnection of the same client, clean up the previous state
             logger.warning(f"Client {client_id} reconnected. Cleaning up previous state.")
             await handle_disconnect(client_id)
 
-    client = Client(id=client_id, websocket=websocket, status=ClientStatus.PENDING)
-    active_clients[client_id] = client
+    if resume_target is not None:
+        client = resume_target # Left untouched in active_clients until the token is checked
+    else:
+        client = Client(id=client_id, websocket=websocket, status=ClientStatus.PENDING)
+        active_clients[client_id] = client
+    ctx = ConnectionContext(client_id=client_id, websocket=websocket, remote_ip=remote_ip)
 
     try:
         auth_data_raw = await websocket.receive_text()
@@ -123,44 +198,65 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
         expected_password = os.environ.get("SOUNDMESH_SERVER_PASSWORD", "defaultpassword")
         if auth_data.password != expected_password:
             logger.warning(f"Incorrect password from client {client_id}. Rejecting.")
+            if resume_target is not None:
+                # Don't touch the suspended session; its grace timer still applies
+                await websocket.send_json({"type": "status_update", "status": ClientStatus.REJECTED.value,
+                                           "message": "Incorrect server password.", "client_id": client_id})
+                await websocket.close(code=1008, reason="Incorrect server password")
+                return
             client.status = ClientStatus.REJECTED
             await notify_client_status(client_id, ClientStatus.REJECTED, "Incorrect server password.")
             await handle_disconnect(client_id, websocket)
             return
+        elif resume_target is not None and session_manager.resume(client, auth_data.resume_token, websocket):
+            # Session resumed: same Client, PC and subscriptions, nothing to tear down.
+            # Other clients never saw this client leave, so there is nothing to announce.
+            if auth_data.name:
+                client.name = auth_data.name
+            await notify_client_status(
+                client_id=client.id,
+                status=ClientStatus.AUTHORIZED,
+                message="Session resumed.",
+                other_clients=public_roster(exclude_client_id=client.id),
+                extra={"resumed": True, "resume_token": client.resume_token,
+                       "current_channel_id": client.current_channel_id,
+                       "listening_channels": sorted(client.listening_channels)}
+            )
+            heartbeat.track(client_id)
+            if client_id in session_manager.pending_renegotiation:
+                session_manager.pending_renegotiation.discard(client_id)
+                await trigger_renegotiation(client_id)
         else:
+            if resume_target is not None:
+                # No valid token: drop the stale session and start a fresh one
+                logger.info(f"Client {client_id} did not resume its suspended session. Starting a new one.")
+                await session_manager.end(client_id)
+                client = Client(id=client_id, websocket=websocket, status=ClientStatus.PENDING)
+                active_clients[client_id] = client
+
             # 3. Password correct - Authorize client and notify
             client.status = ClientStatus.AUTHORIZED
             client.name = auth_data.name or f"User_{client.id[:8]}" # Store name or generate one
+            preset = store.resolve_preset(client.id)
+            if preset is not None:
+                # Stored preset for this client ID; applied before anyone sees the client
+                client.permissions = preset
+                permission_engine.compile(client.id, preset)
+                logger.info(f"Applied stored permission preset to {client.id}")
             logger.info(f"Client {client.id} authenticated successfully as '{client.name}'. Authorizing.")
 
-            # Validate each existing Client object into a ClientPublic model
-            other_authorized_clients_public: List[ClientPublic] = []
-            for c in active_clients.values():
-                if c.id != client.id and c.status == ClientStatus.AUTHORIZED:
-                    try:
-                        # Manually create dict with only ClientPublic fields
-                        client_data = {
-                            "id": c.id,
-                            "name": c.name,
-                            "status": c.status,
-                            "current_channel_id": c.current_channel_id,
-                            "permissions": c.permissions # Include permissions
-                        }
-                        other_authorized_clients_public.append(ClientPublic.model_validate(client_data))
-                    except Exception as val_err:
-                        logger.error(f"Failed to validate existing client {c.id} for status update: {val_err}")
-                        # Decide: skip this client or raise error?
-                        # For now, skip the invalid one to avoid blocking the current auth.
-
+            other_authorized_clients_public = public_roster(exclude_client_id=client.id)
             logger.debug(f"Found {len(other_authorized_clients_public)} other authorized clients for status update.")
 
+            heartbeat.track(client.id)
             try:
                 logger.info(f"Attempting to send status update to {client.id}")
                 await notify_client_status(
                     client_id=client.id, 
                     status=ClientStatus.AUTHORIZED, 
                     message="Authentication successful. You are connected.",
-                    other_clients=other_authorized_clients_public # Pass the list here
+                    other_clients=other_authorized_clients_public, # Pass the list here
+                    extra={"resume_token": session_manager.issue_token(client)}
                 )
                 logger.info(f"Successfully sent status update to {client.id}")
             except Exception as e:
@@ -175,487 +271,51 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
             # Get all *other* clients (could be pending or authorized)
             other_clients_full = [c for c in active_clients.values() if c.id != client_id and c.status == ClientStatus.AUTHORIZED]
             if other_clients_full:
-                # Manually create dict with only ClientPublic fields for the new client
-                new_client_data = {
-                    "id": client.id, "name": client.name, "status": client.status,
-                    "current_channel_id": client.current_channel_id,
-                    "permissions": client.permissions # Include permissions
-                }
-                # new_client_public = ClientPublic.model_validate(new_client_data)
                 await notify_client_update(client.id, other_clients_full)
                 logger.info(f"Successfully notified other clients about {client.id}")
             else:
                 logger.info(f"No other clients found to notify about new client {client.id}")
 
-        while True:
-            data = await websocket.receive_text()
-            try:
-                message = json.loads(data)
-            except json.JSONDecodeError:
-                logger.error(f"Client {client_id} sent invalid JSON. Closing connection.")
+        session = dispatcher.open_session(ctx, concurrent=config.WS_CONCURRENT_HANDLERS, on_error=report_error)
+        try:
+            while True:
+                data = await websocket.receive_text()
+                heartbeat.touch(client_id)
                 try:
-                    await websocket.close(code=1003, reason="Invalid JSON format")
-                except Exception:
-                    pass
-                break
-
-            logger.info(f"Message from {client.status.value} client {client_id}: {message}")
-
-            if client.status == ClientStatus.AUTHORIZED:
-                msg_type = message.get("type")
-
-                if msg_type == "offer":
-                    sdp = message.get("sdp")
-                    if not sdp:
-                        logger.warning(f"Client {client_id} sent offer without sdp")
-                        continue
-
-                    logger.info(f"Received offer from {client_id}")
-                    offer = RTCSessionDescription(sdp=sdp, type=message["type"])
-                    
-                    # Check if we need to close an existing peer connection
-                    if client.pc and (client.pc.connectionState == "failed" or client.pc.connectionState == "closed"):
-                        logger.info(f"Closing existing failed/closed PeerConnection for {client_id} before creating a new one")
-                        await client.pc.close()
-                        if client_id in pcs:
-                            del pcs[client_id]
-                        client.pc = None
-
-                    # Create new PC if needed
-                    if not client.pc:
-                        logger.info(f"Creating new PeerConnection for {client_id}")
-                        pc = RTCPeerConnection(configuration=RTC_CONFIG)
-                        pcs[client_id] = pc
-                        client.pc = pc
-                    else:
-                        logger.info(f"Reusing existing PeerConnection for {client_id}")
-                        pc = client.pc
-
-                    @pc.on("connectionstatechange")
-                    async def on_connectionstatechange():
-                        logger.info(f"PC state for {client_id}: {pc.connectionState}")
-                        if pc.connectionState == "failed" or pc.connectionState == "closed":
-                            logger.warning(f"PC for {client_id} failed or closed unexpectedly.")
-                            failed_client = active_clients.get(client_id)
-                            if failed_client:
-                                # Notify client about the connection failure
-                                try:
-                                    await websocket.send_json({
-                                        "type": "connection_status",
-                                        "status": "failed",
-                                        "message": "WebRTC connection failed. You may need to reconnect."
-                                    })
-                                except Exception as e:
-                                    logger.error(f"Error sending connection failure notification to {client_id}: {e}")
-                                # Don't disconnect immediately, let the client attempt to reconnect
-                            else:
-                                await handle_disconnect(client_id)
-
-                    @pc.on("track")
-                    async def on_track(track):
-                        if track.kind == "audio":
-                            logger.info(f"Audio track {track.id} received from {client_id}")
-                            sender_client = active_clients.get(client_id)
-                            if not sender_client:
-                                logger.warning(f"Track received for unknown client {client_id}")
-                                track.stop()
-                                return
-
-                            # Store the track on the client object
-                            sender_client.audio_track = track
-                            logger.info(f"Stored audio track {track.id} for client {client_id}")
-
-                            # Add track to listening peers
-                            sender_channel_id = sender_client.current_channel_id
-                            if sender_channel_id:
-                                logger.info(f"Client {client_id} is in channel {sender_channel_id}, adding track to listeners")
-                                listeners_needing_update = set()
-                                
-                                for receiver_id, receiver_client in active_clients.items():
-                                    # Add track to clients who are listening to this channel and not the sender
-                                    if (receiver_id != client_id and 
-                                        receiver_client.status == ClientStatus.AUTHORIZED and 
-                                        receiver_client.pc and 
-                                        sender_channel_id in receiver_client.listening_channels):
-                                        
-                                        # Check if track is already added to avoid duplicates
-                                        already_added = False
-                                        for sender in receiver_client.pc.getSenders():
-                                            if sender.track == track:
-                                                already_added = True
-                                                break
-                                        
-                                        if not already_added:
-                                            logger.info(f"Adding track {track.id} from {client_id} to receiver {receiver_id}")
-                                            try:
-                                                receiver_client.pc.addTrack(track)
-                                                listeners_needing_update.add(receiver_id)
-                                            except Exception as e:
-                                                logger.error(f"Error adding track {track.id} to {receiver_id}'s PC: {e}")
-                                
-                                # Trigger renegotiation for all affected listeners
-                                if listeners_needing_update:
-                                    logger.info(f"Triggering renegotiation for {len(listeners_needing_update)} listeners after receiving track from {client_id}")
-                                    for listener_id in listeners_needing_update:
-                                        await trigger_renegotiation(listener_id)
-                            else:
-                                logger.info(f"Client {client_id} is not in any channel yet, track will be added to listeners when they join a channel")
-                            
-                            @track.on("ended")
-                            async def on_track_ended():
-                                logger.info(f"Track {track.id} from {client_id} ended, removing from listeners")
-                                # Remove track from all listeners when it ends
-                                listeners_needing_update = set()
-                                for listener_id, listener_client in active_clients.items():
-                                    if listener_id != client_id and listener_client.pc:
-                                        sender_to_remove = None
-                                        for sender in listener_client.pc.getSenders():
-                                            if sender.track == track:
-                                                sender_to_remove = sender
-                                                break
-                                        if sender_to_remove:
-                                            try:
-                                                listener_client.pc.removeTrack(sender_to_remove)
-                                                listeners_needing_update.add(listener_id)
-                                            except Exception as e:
-                                                logger.error(f"Error removing ended track {track.id} from {listener_id}'s PC: {e}")
-                                
-                                # Trigger renegotiation for affected listeners
-                                if listeners_needing_update:
-                                    for listener_id in listeners_needing_update:
-                                        await trigger_renegotiation(listener_id)
-
-                        elif track.kind == "video":
-                            logger.info(f"Video track received from {client_id}, stopping as it is not supported.")
-                            track.stop()
-
-                        @track.on("ended")
-                        async def on_ended():
-                            logger.info(f"Track {track.kind} from {client_id} ended.")
-
-                    await pc.setRemoteDescription(offer)
-
-                    answer = await pc.createAnswer()
-                    await pc.setLocalDescription(answer)
-
-                    answer_message = {
-                        "type": "answer",
-                        "sdp": pc.localDescription.sdp,
-                    }
-                    logger.info(f"Sending answer to {client_id}")
-                    await notify_client(client_id, answer_message) # Use imported notify_client
-
-                elif msg_type == "answer":
-                    sdp = message.get("sdp")
-                    if not sdp:
-                        logger.warning(f"Client {client_id} sent answer without sdp")
-                        continue
-
-                    answer = RTCSessionDescription(sdp=sdp, type=message["type"])
-                    logger.info(f"Received answer from {client_id}")
-
-                    client_obj = active_clients.get(client_id)
-                    if not client_obj or not client_obj.pc:
-                        logger.warning(f"Received answer from {client_id} but no client or PC found.")
-                        # Notify client about the issue
-                        await websocket.send_json({
-                            "type": "error",
-                            "message": "Server cannot process your answer: no active connection found."
-                        })
-                        continue
-
-                    pc = client_obj.pc
+                    message = json.loads(data)
+                except json.JSONDecodeError:
+                    logger.error(f"Client {client_id} sent invalid JSON. Closing connection.")
                     try:
-                        await pc.setRemoteDescription(answer)
-                        logger.info(f"Successfully set remote description (answer) for {client_id}")
-                        
-                        # Notify client about successful connection
-                        await websocket.send_json({
-                            "type": "connection_status",
-                            "status": "connected",
-                            "message": "WebRTC connection established successfully."
-                        })
-                    except Exception as e:
-                        logger.exception(f"Error setting remote description for {client_id} from answer: {e}", exc_info=e)
-                        # Notify client about the error
-                        await websocket.send_json({
-                            "type": "error",
-                            "message": f"Failed to process your answer: {str(e)}"
-                        })
-
-                elif msg_type == "candidate":
-                    candidate_data = message.get("candidate")
-                    client_obj = active_clients.get(client_id)
-                    if not client_obj or not client_obj.pc:
-                        logger.warning(f"Received ICE candidate from {client_id} but no client or PC found.")
-                        continue
-                        
-                    pc = client_obj.pc
-                    
-                    if candidate_data and candidate_data.get("candidate"):
-                        sdp = candidate_data['candidate']
-                        sdpMid = candidate_data.get('sdpMid') # Can be None initially
-                        sdpMLineIndex = candidate_data.get('sdpMLineIndex') # Can be None initially
-                        usernameFragment = candidate_data.get('usernameFragment') # Optional
-
-                        if sdp is None or sdpMid is None or sdpMLineIndex is None:
-                            logger.warning(f"Received invalid ICE candidate data from {client_id}: {candidate_data}")
-                            continue # Skip this invalid candidate
-
-                        logger.info(f"Received ICE candidate from {client_id}")
-                        try:
-                            # Parse the candidate string to extract required parameters
-                            # Example: candidate:0 1 UDP 2122187007 192.168.1.107 43977 typ host
-                            if sdp and sdp.startswith('candidate:'):
-                                parts = sdp.split(' ')
-                                if len(parts) >= 8:
-                                    # Extract parameters from the candidate string
-                                    foundation = parts[0].replace('candidate:', '')
-                                    component = int(parts[1])
-                                    protocol = parts[2].lower()
-                                    priority = int(parts[3])
-                                    ip = parts[4]
-                                    port = int(parts[5])
-                                    typ = parts[7]
-                                    
-                                    # Create the RTCIceCandidate with the correct parameters
-                                    candidate = RTCIceCandidate(
-                                        component=component,
-                                        foundation=foundation,
-                                        ip=ip,
-                                        port=port,
-                                        priority=priority,
-                                        protocol=protocol,
-                                        type=typ,
-                                        sdpMid=str(sdpMid),
-                                        sdpMLineIndex=int(sdpMLineIndex)
-                                    )
-                                    await pc.addIceCandidate(candidate)
-                                    logger.info(f"Added ICE candidate for {client_id}")
-                                else:
-                                    logger.warning(f"Invalid ICE candidate format: {sdp}")
-                            elif not sdp:  # Empty candidate signals end of candidates
-                                await pc.addIceCandidate(None)
-                                logger.info(f"Added end-of-candidates for {client_id}")
-                            else:
-                                logger.warning(f"Unrecognized ICE candidate format: {sdp}")
-                        except Exception as e:
-                            logger.error(f"Error adding ICE candidate for {client_id}: {e}", exc_info=True)
-                            # Send an error message back to the client
-                            await websocket.send_json({
-                                "type": "error",
-                                "message": f"Failed to add ICE candidate: {str(e)}"
-                            })
-                            # Logging is already done above
-
-                elif msg_type == "join_channel":
-                    channel_id = message.get("channel_id")
-                    if not channel_id:
-                        logger.warning(f"Client {client_id} sent join_channel without channel_id")
-                        await notify_client(client_id, {"type": "error", "message": "Missing channel_id"})
-                        continue
-
-                    joining_client = active_clients.get(client_id)
-                    if not joining_client:
-                        logger.error(f"Critical: Client {client_id} not found in active_clients during join_channel.")
-                        continue
-
-                    logger.info(f"Client {client_id} attempting to join channel {channel_id}")
-                    # TODO: Check permissions before allowing join
-
-                    # --- Update Client State --- #
-                    old_channel_id = joining_client.current_channel_id
-                    joining_client.current_channel_id = channel_id
-                    
-                    # Add the channel to listening channels if not already there
-                    if channel_id not in joining_client.listening_channels:
-                        joining_client.listening_channels.add(channel_id)
-                        logger.info(f"Added {channel_id} to client {client_id}'s listening channels")
-
-                    # --- WebRTC Track Handling --- #
-                    # 1. Add joining client's track to new listeners
-                    listeners_needing_update = set()
-                    if joining_client.audio_track:
-                        logger.debug(f"Joining client {client_id} has track {joining_client.audio_track.id}. Adding to listeners of {channel_id}.")
-                        for listener_id, listener_client in active_clients.items():
-                            if (listener_id != client_id and
-                                listener_client.status == ClientStatus.AUTHORIZED and
-                                listener_client.pc and
-                                channel_id in listener_client.listening_channels):
-
-                                # Avoid adding track if it's already there (e.g., re-joining)
-                                already_sending = False
-                                for sender in listener_client.pc.getSenders():
-                                    if sender.track == joining_client.audio_track:
-                                        already_sending = True
-                                        break
-                                if not already_sending:
-                                    logger.info(f"Adding track {joining_client.audio_track.id} from {client_id} to listener {listener_id} (joined channel {channel_id})")
-                                    try:
-                                        listener_client.pc.addTrack(joining_client.audio_track)
-                                        listeners_needing_update.add(listener_id)
-                                    except Exception as e:
-                                        logger.error(f"Error adding track {joining_client.audio_track.id} to {listener_id}'s PC: {e}")
-                                else:
-                                    logger.debug(f"Track {joining_client.audio_track.id} already present on listener {listener_id}'s PC.")
-
-                    # 2. Remove joining client's track from listeners of the *old* channel
-                    if old_channel_id and joining_client.audio_track:
-                        logger.debug(f"Joining client {client_id} left old channel {old_channel_id}. Removing track from its listeners.")
-                        for listener_id, listener_client in active_clients.items():
-                            if (listener_id != client_id and
-                                listener_client.status == ClientStatus.AUTHORIZED and
-                                listener_client.pc and
-                                old_channel_id in listener_client.listening_channels): # Check if they were listening to the *old* channel
-
-                                sender_to_remove = None
-                                for sender in listener_client.pc.getSenders():
-                                    if sender.track == joining_client.audio_track:
-                                        sender_to_remove = sender
-                                        break
-                                if sender_to_remove:
-                                    logger.info(f"Removing track {joining_client.audio_track.id} from {client_id} from listener {listener_id} (left channel {old_channel_id})")
-                                    try:
-                                        listener_client.pc.removeTrack(sender_to_remove)
-                                        listeners_needing_update.add(listener_id)
-                                    except Exception as e:
-                                        logger.error(f"Error removing track {joining_client.audio_track.id} from {listener_id}'s PC: {e}")
-                    
-                    # 3. Add existing clients' tracks from the new channel to the joining client
-                    if joining_client.pc:
-                        logger.debug(f"Adding existing tracks from channel {channel_id} to joining client {client_id}")
-                        for existing_id, existing_client in active_clients.items():
-                            if (existing_id != client_id and 
-                                existing_client.status == ClientStatus.AUTHORIZED and 
-                                existing_client.audio_track and 
-                                existing_client.current_channel_id == channel_id):
-                                
-                                # Check if track is already added
-                                already_added = False
-                                for sender in joining_client.pc.getSenders():
-                                    if sender.track == existing_client.audio_track:
-                                        already_added = True
-                                        break
-                                
-                                if not already_added:
-                                    logger.info(f"Adding existing track from {existing_id} to joining client {client_id}")
-                                    try:
-                                        joining_client.pc.addTrack(existing_client.audio_track)
-                                        # Add joining client to renegotiation list
-                                        listeners_needing_update.add(client_id)
-                                    except Exception as e:
-                                        logger.error(f"Error adding existing track from {existing_id} to joining client {client_id}: {e}")
-
-                    # Notify the client they successfully joined
-                    await notify_client(client_id, {"type": "channel_joined", "channel_id": channel_id})
-
-                    # Trigger renegotiation for all affected listeners including the joining client
-                    if listeners_needing_update:
-                        logger.info(f"Listeners needing renegotiation after {client_id} joined {channel_id}: {listeners_needing_update}")
-                        for listener_id in listeners_needing_update:
-                            await trigger_renegotiation(listener_id)
-
-                elif msg_type == "echo":
-                    await notify_client(client_id, {"type": "echo", "message": f"Authorized message received: {message}"})
+                        await websocket.close(code=1003, reason="Invalid JSON format")
+                    except Exception:
+                        pass
+                    break
+                if not isinstance(message, dict):
+                    await notify_client(client_id, {"type": "error", "message": "Messages must be JSON objects"})
+                    continue
 
-                elif msg_type == "update_listen_channels":
-                    if client_id not in active_clients or active_clients[client_id].status != ClientStatus.AUTHORIZED:
-                        logger.warning(f"Client {client_id} tried to update listen channels before authenticating.")
-                        await notify_client(client_id, {"type": "error", "message": "Not authenticated"})
-                        continue
-
-                    channel_ids = message.get("channel_ids")
-                    if not isinstance(channel_ids, list):
-                        logger.warning(f"Client {client_id} sent invalid channel_ids for update_listen_channels: {channel_ids}")
-                        await notify_client(client_id, {"type": "error", "message": "Invalid channel_ids format"})
-                        continue
-
-                    # Validate channel IDs (optional but recommended)
-                    valid_channel_ids = {cid for cid in channel_ids if cid in [ch.id for ch in mock_channels_list]}
-                    if len(valid_channel_ids) != len(channel_ids):
-                        logger.warning(f"Client {client_id} provided some invalid channel IDs in update_listen_channels.")
-                        # Decide whether to proceed with valid ones or reject
-
-                    listener_client = active_clients.get(client_id)
-                    if not listener_client or not listener_client.pc:
-                        logger.warning(f"Cannot update tracks for {client_id}, client or PC not found.")
-                        continue
-
-                    old_listening_channels = set(listener_client.listening_channels) # Copy old set
-                    new_listening_channels = valid_channel_ids
-
-                    # Update the client state *after* getting the old set
-                    listener_client.listening_channels = new_listening_channels
-                    logger.info(f"Client {client_id} updated listening channels from {old_listening_channels} to {new_listening_channels}")
-
-                    channels_to_add = new_listening_channels - old_listening_channels
-                    channels_to_remove = old_listening_channels - new_listening_channels
-
-                    tracks_changed = False
-
-                    # Add tracks for newly listened channels
-                    if channels_to_add:
-                        logger.debug(f"Client {client_id} started listening to: {channels_to_add}")
-                        for talker_id, talker_client in active_clients.items():
-                            # Check if talker is different, authorized, has a track, and is in a channel we just started listening to
-                            if (talker_id != client_id and
-                                talker_client.status == ClientStatus.AUTHORIZED and
-                                talker_client.audio_track and
-                                talker_client.current_channel_id in channels_to_add):
-
-                                logger.info(f"Adding track {talker_client.audio_track.id} from {talker_id} (channel {talker_client.current_channel_id}) to {client_id}")
-                                try:
-                                    listener_client.pc.addTrack(talker_client.audio_track)
-                                    tracks_changed = True
-                                except Exception as e:
-                                    logger.error(f"Error adding track {talker_client.audio_track.id} to {client_id}'s PC: {e}")
-
-                    # Remove tracks for stopped listening channels
-                    if channels_to_remove:
-                        logger.debug(f"Client {client_id} stopped listening to: {channels_to_remove}")
-                        senders_to_remove = []
-                        for sender in listener_client.pc.getSenders():
-                            if sender.track:
-                                # Find the owner (talker) of this track
-                                track_owner_id = None
-                                track_owner_channel_id = None
-                                for talker_id, talker_client in active_clients.items():
-                                    if talker_client.audio_track == sender.track:
-                                        track_owner_id = talker_id
-                                        track_owner_channel_id = talker_client.current_channel_id
-                                        break
-
-                                # If track owner is found and their channel is one we stopped listening to, remove track
-                                if track_owner_id and track_owner_channel_id in channels_to_remove:
-                                    logger.info(f"Removing track {sender.track.id} (from {track_owner_id}, channel {track_owner_channel_id}) from {client_id}")
-                                    senders_to_remove.append(sender)
-
-                        for sender in senders_to_remove:
-                            try:
-                               listener_client.pc.removeTrack(sender)
-                               tracks_changed = True
-                            except Exception as e:
-                               logger.error(f"Error removing track {sender.track.id} from {client_id}'s PC: {e}")
-
-                    # --- TODO: Trigger Renegotiation --- #
-                    if tracks_changed:
-                        logger.info(f"Tracks changed for {client_id}. Renegotiation required.")
-                        await trigger_renegotiation(client_id)
+                logger.debug(f"Message '{message.get('type')}' from {client.status.value} client {client_id}")
 
+                if client.status == ClientStatus.AUTHORIZED:
+                    try:
+                        await session.dispatch(message)
+                    except FloodDetected as e:
+                        logger.warning(f"{e}. Closing connection.")
+                        # Disconnect outright; a flooding client doesn't get a resumable session
+                        await handle_disconnect(client_id)
+                        break
+
+                elif client.status == ClientStatus.PENDING:
+                    await notify_client(client_id, {"type": "info", "message": "Message ignored. Awaiting server authorization."})
+                    logger.warning(f"Ignoring message from PENDING client {client_id}")
                 else:
-                    logger.warning(f"Client {client_id} sent unknown message type: {msg_type}")
-                    await notify_client(client_id, {"type": "error", "message": f"Unknown message type: {msg_type}"})
-
-            elif client.status == ClientStatus.PENDING:
-                await notify_client(client_id, {"type": "info", "message": "Message ignored. Awaiting server authorization."})
-                logger.warning(f"Ignoring message from PENDING client {client_id}")
-            else:
-                logger.error(f"Received message from client {client_id} with unexpected status {client.status}. Closing.")
-                break
+                    logger.error(f"Received message from client {client_id} with unexpected status {client.status}. Closing.")
+                    break
+        finally:
+            await session.close()
 
     except WebSocketDisconnect:
         logger.warning(f"WebSocket disconnected for client {client_id}")
-        await handle_disconnect(client_id)
     except Exception as e:
         logger.error(f"Error with client {client_id}: {e}")
         try:
@@ -663,15 +323,14 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
         except Exception:
             pass
     finally:
-        client_check = active_clients.get(client_id)
-        if client_check and client_check.status != ClientStatus.DISCONNECTED:
-            logger.info(f"Running cleanup in finally block for {client_id}")
-            await handle_disconnect(client_id)
-        else:
-            logger.info(f"Client {client_id} already cleaned up or marked disconnected, skipping finally cleanup.")
-
-app.include_router(channels.router, prefix="/api/v1/channels", tags=["Channels"])
-app.include_router(clients.router, prefix="/api/v1/clients", tags=["Clients"])
+        await release_connection(client_id, websocket)
+
+app.include_router(channels.router, prefix="/api/v1/channels", tags=["Channels"], dependencies=[Depends(rest_rate_limit)])
+app.include_router(groups.router, prefix="/api/v1/channel-groups", tags=["Channel Groups"], dependencies=[Depends(rest_rate_limit)])
+app.include_router(clients.router, prefix="/api/v1/clients", tags=["Clients"], dependencies=[Depends(rest_rate_limit)])
+app.include_router(templates.router, prefix="/api/v1/permission-templates", tags=["Permission Templates"], dependencies=[Depends(rest_rate_limit)])
+app.include_router(server.router, prefix="/api/v1/server", tags=["Server"], dependencies=[Depends(rest_rate_limit)])
+app.include_router(debug.router, prefix="/debug", tags=["Debug"], dependencies=[Depends(rest_rate_limit)])
 
 if __name__ == "__main__":
     import uvicorn
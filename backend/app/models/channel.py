@@ -9,6 +9,9 @@ def generate_uuid():
 class ChannelBase(BaseModel):
     name: str = Field(..., min_length=1, max_length=50, description="Name of the communication channel")
     description: Optional[str] = Field(None, max_length=255, description="Optional description for the channel")
+    codec_profile: Optional[str] = Field(None, description="Opus profile for clients talking in this channel (server default if unset)")
+    priority: bool = Field(False, description="Talkers in this channel are never muted for a congested listener")
+    replay_seconds: Optional[int] = Field(None, ge=0, le=300, description="Seconds of audio kept for instant replay (server default if unset, 0 disables)")
 
 class ChannelCreate(ChannelBase):
     # Data needed to create a channel (comes from API request)
@@ -18,6 +21,9 @@ class ChannelCreate(ChannelBase):
 class ChannelUpdate(BaseModel):
     name: Optional[str] = Field(None, min_length=1, max_length=50, description="New name for the channel")
     description: Optional[str] = Field(None, max_length=255, description="New description for the channel")
+    codec_profile: Optional[str] = Field(None, description="New Opus profile for the channel")
+    priority: Optional[bool] = Field(None, description="Whether talkers in this channel are exempt from congestion muting")
+    replay_seconds: Optional[int] = Field(None, ge=0, le=300, description="New instant replay window in seconds (0 disables)")
 
 class Channel(ChannelBase):
     # Full channel representation (includes generated ID, etc.)
@@ -29,3 +35,20 @@ class Channel(ChannelBase):
         orm_mode = True # Allows mapping from ORM objects (though we use dicts now)
         # Deprecated in Pydantic v2, use `from_attributes=True` instead if using v2
         # from_attributes = True
+
+
+class ChannelGroupBase(BaseModel):
+    name: str = Field(..., min_length=1, max_length=50, description="Name of the channel group")
+    description: Optional[str] = Field(None, max_length=255, description="Optional description for the group")
+    channel_ids: List[str] = Field(..., min_length=1, max_length=64, description="Channels an all-call to this group talks to")
+
+class ChannelGroupCreate(ChannelGroupBase):
+    pass
+
+class ChannelGroupUpdate(BaseModel):
+    name: Optional[str] = Field(None, min_length=1, max_length=50, description="New name for the group")
+    description: Optional[str] = Field(None, max_length=255, description="New description for the group")
+    channel_ids: Optional[List[str]] = Field(None, min_length=1, max_length=64, description="New member channels")
+
+class ChannelGroup(ChannelGroupBase):
+    id: str = Field(default_factory=generate_uuid, description="Unique identifier for the group")
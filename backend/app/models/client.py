@@ -1,6 +1,7 @@
 from pydantic import BaseModel, Field
+import json
 import uuid
-from typing import Optional, Dict, List, Set
+from typing import Any, Optional, Dict, List, Set
 from enum import Enum
 from .permissions import ClientPermissions
 from aiortc import RTCPeerConnection
@@ -23,24 +24,93 @@ class ClientAuthRequest(BaseModel):
     # Data sent by client immediately after WebSocket connection
     password: str = Field(..., description="Server password required for connection attempt")
     name: Optional[str] = Field(None, max_length=50, description="Optional display name")
+    resume_token: Optional[str] = Field(None, description="Token from a previous session, to resume it without media teardown")
 
-class Client(ClientBase):
-    # Full client representation stored on the server
-    id: str = Field(..., description="Unique identifier for the client (e.g., WebSocket connection ID)")
-    status: ClientStatus = Field(default=ClientStatus.PENDING, description="Current authorization status")
-    websocket: Optional[object] = Field(None, exclude=True) # Store the WebSocket object, exclude from serialization
+def _public_attr(slot: str):
+    """ Property for a field that appears in the public view; writing it drops the cached view. """
+    def fget(self):
+        return getattr(self, slot)
 
-    # Permissions will be added later
-    permissions: ClientPermissions = Field(default_factory=ClientPermissions)
-    pc: Optional[RTCPeerConnection] = Field(None, exclude=True) # Server-side peer connection for this client
-    current_channel_id: Optional[str] = Field(None, description="ID of the channel the client is currently active in")
-    listening_channels: Set[str] = Field(default_factory=set, description="Set of channel IDs the client is actively listening to")
-    audio_track: Optional[MediaStreamTrack] = Field(None, exclude=True, description="The audio track received from this client")
+    def fset(self, value):
+        setattr(self, slot, value)
+        self._public = None
+        self._public_json = None
 
-    class Config:
-        arbitrary_types_allowed = True # Allow non-pydantic types like WebSocket
-        # orm_mode = True # Use from_attributes in Pydantic v2
-        from_attributes = True
+    return property(fget, fset)
+
+
+class Client:
+    """
+    Runtime state for one connected client, kept on the server only.
+
+    This is deliberately not a pydantic model: it holds live handles
+    (WebSocket, PeerConnection, tracks) and is mutated constantly, so it uses
+    __slots__ and plain attributes. Pydantic is only used at the edges, via
+    ClientPublic for API I/O. The public view is serialized once and cached;
+    writing any field that appears in it (name, status, permissions,
+    current_channel_id) invalidates the cache. Code that mutates `permissions`
+    in place must call invalidate_public() itself.
+    """
+
+    __slots__ = (
+        "id", "_name", "_status", "_permissions", "_current_channel_id",
+        "websocket", "pc", "audio_track", "listening_channels", "all_call_channels", "resume_token", "rtt_ms",
+        "codec_profile", "_public", "_public_json",
+    )
+
+    name = _public_attr("_name")
+    status = _public_attr("_status")
+    permissions = _public_attr("_permissions")
+    current_channel_id = _public_attr("_current_channel_id")
+
+    def __init__(self, id: str, websocket: Optional[object] = None, status: ClientStatus = ClientStatus.PENDING,
+                 name: Optional[str] = None, permissions: Optional[ClientPermissions] = None):
+        self.id = id
+        self._name = name
+        self._status = status
+        self._permissions = permissions if permissions is not None else ClientPermissions()
+        self._current_channel_id: Optional[str] = None # ID of the channel the client is currently active in
+        self.websocket = websocket # Live WebSocket, None while the session is suspended
+        self.pc: Optional[RTCPeerConnection] = None # Server-side peer connection for this client
+        self.audio_track: Optional[MediaStreamTrack] = None # The audio track received from this client
+        self.listening_channels: Set[str] = set() # Channel IDs the client is actively listening to
+        self.all_call_channels: Set[str] = set() # Channel IDs an active all-call talks to; empty when not in one
+        self.resume_token: Optional[str] = None # Secret allowing a reconnecting WebSocket to resume this session
+        self.rtt_ms: Optional[float] = None # Smoothed signaling round-trip time measured by heartbeat pings
+        self.codec_profile: Optional[str] = None # Opus profile of the last SDP sent to this client
+        self._public: Optional[Dict[str, Any]] = None
+        self._public_json: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return f"Client(id={self.id!r}, name={self._name!r}, status={self._status.value})"
+
+    def talk_channels(self) -> Set[str]:
+        """ Channels this client's audio is routed to: its all-call targets while one is active, else its current channel. """
+        if self.all_call_channels:
+            return self.all_call_channels
+        return {self._current_channel_id} if self._current_channel_id else set()
+
+    def invalidate_public(self):
+        self._public = None
+        self._public_json = None
+
+    def public(self) -> Dict[str, Any]:
+        """ JSON-ready dict matching ClientPublic. Cached; treat it as read-only. """
+        if self._public is None:
+            self._public = {
+                "id": self.id,
+                "name": self._name,
+                "status": self._status.value,
+                "current_channel_id": self._current_channel_id,
+                "permissions": self._permissions.model_dump(),
+            }
+        return self._public
+
+    def public_json(self) -> str:
+        """ The public view already encoded as JSON, for splicing into outgoing messages. """
+        if self._public_json is None:
+            self._public_json = json.dumps(self.public())
+        return self._public_json
 
 class ClientPublic(ClientBase):
     # Information about a client that is safe to expose via API
@@ -48,3 +118,12 @@ class ClientPublic(ClientBase):
     status: ClientStatus
     name: Optional[str]
     permissions: ClientPermissions
+    current_channel_id: Optional[str] = None
+
+class CodecProfileUpdate(BaseModel):
+    profile: str = Field(..., description="Name of the Opus profile to use for this client")
+
+class ClientCodecProfile(BaseModel):
+    client_id: str
+    override: Optional[str] = None # Set for this client explicitly
+    effective: str # What its next negotiation and its encoders use
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Dict
+from typing import Dict, List, Optional
 
 class ChannelPermissions(BaseModel):
     """ Defines talk/listen permissions for a single channel """
@@ -13,4 +13,42 @@ class ClientPermissions(BaseModel):
     """
     # Example: { "channel-uuid-1": {"talk": true, "listen": true}, "channel-uuid-2": {"talk": false, "listen": true} }
     channel_permissions: Dict[str, ChannelPermissions] = Field(default_factory=dict)
+    # Client IDs this client may open private (IFB) routes to; "*" allows any client
+    direct_targets: List[str] = Field(default_factory=list)
 
+
+class ChannelPermissionsPatch(BaseModel):
+    """ Partial update of one client/channel cell. Omitted fields keep their current value. """
+    talk: Optional[bool] = None
+    listen: Optional[bool] = None
+
+class PermissionMatrixPatch(BaseModel):
+    """
+    A clients x channels diff, applied atomically.
+    Maps client ID -> channel ID -> cell patch. A null cell removes the
+    channel from the client's matrix so it falls back to the server defaults.
+    """
+    # Example: { "client-1": {"general": {"talk": true}, "stage": null}, "client-2": {"general": {"listen": false}} }
+    changes: Dict[str, Dict[str, Optional[ChannelPermissionsPatch]]] = Field(default_factory=dict)
+
+class PermissionMatrixResult(BaseModel):
+    """ Outcome of a bulk permission update. """
+    permissions: Dict[str, ClientPermissions] = Field(default_factory=dict, description="New matrix of every changed client")
+    renegotiated: List[str] = Field(default_factory=list, description="Clients whose PC was renegotiated")
+
+class PermissionTemplateBase(BaseModel):
+    """ A named, reusable permission matrix (e.g. "Camera operator") """
+    name: str = Field(..., min_length=1, max_length=50)
+    permissions: ClientPermissions = Field(default_factory=ClientPermissions)
+
+class PermissionTemplate(PermissionTemplateBase):
+    id: str
+
+class ClientPreset(BaseModel):
+    """
+    Permissions applied automatically whenever a given client ID authenticates.
+    Either references a template or carries its own matrix; explicit
+    permissions win if both are set.
+    """
+    template_id: Optional[str] = None
+    permissions: Optional[ClientPermissions] = None
@@ -0,0 +1,9 @@
+from pydantic import BaseModel, Field
+from typing import Optional
+
+class DrainRequest(BaseModel):
+    # Anything left unset keeps its SOUNDMESH_DRAIN_* value
+    target_url: Optional[str] = Field(None, max_length=255, description="Server clients should move to; empty means reconnect to the same address")
+    batch_size: Optional[int] = Field(None, ge=1, le=1000, description="Clients told to migrate per batch")
+    batch_interval: Optional[float] = Field(None, gt=0, le=60, description="Seconds between batches")
+    deadline: Optional[float] = Field(None, gt=0, le=3600, description="Seconds after which remaining clients are disconnected")
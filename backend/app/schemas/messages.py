@@ -0,0 +1,65 @@
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Optional
+
+# Schemas for messages received over the client WebSocket.
+# Each message type is validated on its own when it is dispatched, so a message
+# is only ever parsed against the schema registered for its "type".
+
+class WsMessage(BaseModel):
+    """ Base for all inbound WebSocket messages. Unknown fields are ignored. """
+    model_config = ConfigDict(extra="ignore")
+
+    type: str
+
+class OfferMessage(WsMessage):
+    sdp: str = Field(..., min_length=1, description="SDP offer from the client")
+
+class AnswerMessage(WsMessage):
+    sdp: str = Field(..., min_length=1, description="SDP answer from the client")
+
+class IceCandidatePayload(BaseModel):
+    """ Mirrors the browser's RTCIceCandidate.toJSON() output. """
+    model_config = ConfigDict(extra="ignore")
+
+    candidate: str = ""
+    sdpMid: Optional[str] = None
+    sdpMLineIndex: Optional[int] = None
+    usernameFragment: Optional[str] = None
+
+class CandidateMessage(WsMessage):
+    candidate: Optional[IceCandidatePayload] = None
+
+class CandidatesMessage(WsMessage):
+    """ A burst of trickled candidates sent as one message. """
+    candidates: List[IceCandidatePayload] = Field(default_factory=list, max_length=64)
+
+class JoinChannelMessage(WsMessage):
+    channel_id: str = Field(..., min_length=1)
+
+class UpdateListenChannelsMessage(WsMessage):
+    channel_ids: List[str]
+
+class ReplayMessage(WsMessage):
+    channel_id: str = Field(..., min_length=1)
+    seconds: Optional[float] = Field(None, gt=0, le=300, description="How far back to start; the channel's whole window if unset")
+
+class DirectRouteStartMessage(WsMessage):
+    target_ids: List[str] = Field(..., min_length=1, max_length=16, description="Clients to talk to privately")
+    duck_gain: Optional[float] = Field(None, ge=0, le=1, description="Gain for the listeners' other audio; server default if unset")
+
+class DirectRouteStopMessage(WsMessage):
+    route_id: Optional[str] = Field(None, description="Route to end; all of the sender's routes if unset")
+
+class AllCallStartMessage(WsMessage):
+    group_id: Optional[str] = Field(None, description="Channel group to talk to")
+    channel_ids: Optional[List[str]] = Field(None, max_length=64, description="Channels to talk to, in addition to the group's")
+
+class AllCallStopMessage(WsMessage):
+    pass
+
+class EchoMessage(WsMessage):
+    model_config = ConfigDict(extra="allow")
+
+class PongMessage(WsMessage):
+    seq: Optional[int] = None
+    ts: Optional[int] = None
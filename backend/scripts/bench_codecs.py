@@ -0,0 +1,208 @@
+"""
+Measured bandwidth and latency of each Opus codec profile.
+
+For every profile, two local PeerConnections stand in for the server and a
+listener. The server side sends a 20 ms audio source (a tone under noise,
+with a loud click every `--click-interval` seconds) through the same path
+a real listener gets: the encoder is built from the listener's profile, and
+the offer the listener sees is munged for that profile. On the listener
+side every RTP packet is recorded as it arrives, and clicks are detected in
+the decoded audio.
+
+Reported per profile:
+- pkt/s and ts step: packets per second and the RTP timestamp step per
+  packet (the frame duration actually on the wire)
+- gap avg/p95: packet inter-arrival time
+- rtp kbps: measured RTP bytes (header, extensions and payload)
+- wire kbps: the same plus the SRTP tag and IPv4/UDP headers, next to the
+  nominal figure /debug/codecs computes for the profile
+- latency avg/p95: from the moment a click's frame leaves the source to
+  the moment the listener decodes it (encode, packetization, jitter buffer
+  and decode; the network is loopback)
+
+    cd backend && python scripts/bench_codecs.py [--seconds 5] [--profiles talent crew] 2>/dev/null
+"""
+import argparse
+import array
+import asyncio
+import fractions
+import math
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SOUNDMESH_DB_PATH", ":memory:")
+
+from av import AudioFrame
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
+from aiortc.rtcdtlstransport import RTCDtlsTransport
+from aiortc.rtp import is_rtcp
+
+from app.core.opus import SAMPLE_RATE, codec_profiles
+
+LISTENER_ID = "bench-listener"
+FRAME_SAMPLES = 960 # 20 ms, what browsers and most sources deliver
+SRTP_TAG_BYTES = 10
+IP_UDP_BYTES = 20 + 8
+CLICK_LEVEL = 28000
+CLICK_THRESHOLD = 16000 # Background stays well below this even after decoding
+
+
+class ClickSource(MediaStreamTrack):
+    """ Real-time 20 ms frames of a tone under noise, with a click every `click_interval` seconds. """
+
+    kind = "audio"
+
+    def __init__(self, click_interval: float):
+        super().__init__()
+        self.click_every = max(1, int(click_interval * SAMPLE_RATE / FRAME_SAMPLES))
+        self.clicks: List[float] = [] # When each click's frame was handed to the sender
+        self._frames = 0
+        self._started = None
+        self._random = random.Random(1)
+
+    async def recv(self) -> AudioFrame:
+        if self._started is None:
+            self._started = time.monotonic()
+        self._frames += 1
+        # Like a capture device: a frame is available once its last sample has been captured
+        wait = self._started + self._frames * FRAME_SAMPLES / SAMPLE_RATE - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        offset = (self._frames - 1) * FRAME_SAMPLES
+        click = self._frames % self.click_every == 0
+        samples = array.array("h", (
+            CLICK_LEVEL if click and i < 48 else
+            int(3000 * math.sin(2 * math.pi * 330 * (offset + i) / SAMPLE_RATE)) + self._random.randint(-1500, 1500)
+            for i in range(FRAME_SAMPLES)
+        ))
+        frame = AudioFrame(format="s16", layout="mono", samples=FRAME_SAMPLES)
+        frame.planes[0].update(samples.tobytes())
+        frame.sample_rate = SAMPLE_RATE
+        frame.pts = offset
+        frame.time_base = fractions.Fraction(1, SAMPLE_RATE)
+        if click:
+            self.clicks.append(time.monotonic())
+        return frame
+
+
+class PacketLog:
+    """ Records the decrypted RTP packets a listener's DTLS transport receives. """
+
+    def __init__(self):
+        self.transports: set = set()
+        self.packets: List[Tuple[float, int, int]] = [] # (arrival, RTP timestamp, RTP bytes)
+        self._handle = RTCDtlsTransport._handle_rtp_data
+
+    def install(self):
+        log = self
+
+        async def handle(transport, data: bytes, arrival_time_ms: int):
+            if transport in log.transports and not is_rtcp(data):
+                log.packets.append((time.monotonic(), int.from_bytes(data[4:8], "big"), len(data)))
+            await log._handle(transport, data, arrival_time_ms)
+        RTCDtlsTransport._handle_rtp_data = handle
+
+    def uninstall(self):
+        RTCDtlsTransport._handle_rtp_data = self._handle
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def measure(name: str, seconds: float, click_interval: float, log: PacketLog) -> Dict[str, object]:
+    profile = codec_profiles.profiles[name]
+    codec_profiles.set_client_override(LISTENER_ID, name)
+    source = ClickSource(click_interval)
+    server, listener = RTCPeerConnection(), RTCPeerConnection()
+    server.addTrack(source)
+    decoded: List[float] = [] # When the listener decoded each click
+
+    @listener.on("track")
+    def on_track(track):
+        async def drain():
+            loud = False
+            try:
+                while True:
+                    frame = await track.recv()
+                    peak = max(map(abs, array.array("h", bytes(frame.planes[0]))))
+                    if peak >= CLICK_THRESHOLD and not loud:
+                        decoded.append(time.monotonic())
+                    loud = peak >= CLICK_THRESHOLD
+            except MediaStreamError:
+                pass
+        asyncio.ensure_future(drain())
+
+    # The signaling path of a server-initiated offer: encoders built for the listener's profile, SDP munged for it
+    with codec_profiles.negotiating(LISTENER_ID):
+        await server.setLocalDescription(await server.createOffer())
+        offer = codec_profiles.munge(server.localDescription.sdp, profile)
+        await listener.setRemoteDescription(RTCSessionDescription(offer, "offer"))
+        await listener.setLocalDescription(await listener.createAnswer())
+        await server.setRemoteDescription(listener.localDescription)
+    log.transports = {transceiver.receiver.transport for transceiver in listener.getTransceivers()}
+    log.packets = []
+    await asyncio.sleep(1.0) # Let ICE, DTLS and the jitter buffer settle
+    settled = time.monotonic()
+    await asyncio.sleep(seconds)
+    await server.close()
+    await listener.close()
+
+    packets = [packet for packet in log.packets if packet[0] >= settled]
+    span = packets[-1][0] - packets[0][0]
+    gaps = [(b[0] - a[0]) * 1000 for a, b in zip(packets, packets[1:])]
+    steps = [((b[1] - a[1]) % 2**32) * 1000 / SAMPLE_RATE for a, b in zip(packets, packets[1:])]
+    rtp_bytes = sum(packet[2] for packet in packets)
+    latencies = []
+    for sent in (click for click in source.clicks if click >= settled):
+        arrived = next((at for at in decoded if at >= sent), None)
+        if arrived is not None and arrived - sent < click_interval / 2:
+            latencies.append((arrived - sent) * 1000)
+    return {
+        "profile": name,
+        "ptime": profile.ptime,
+        "packets_per_s": len(packets) / span,
+        "ts_step_ms": percentile(steps, 0.5),
+        "gap_avg_ms": sum(gaps) / len(gaps),
+        "gap_p95_ms": percentile(gaps, 0.95),
+        "rtp_kbps": rtp_bytes * 8 / span / 1000,
+        "wire_kbps": (rtp_bytes + len(packets) * (SRTP_TAG_BYTES + IP_UDP_BYTES)) * 8 / span / 1000,
+        "nominal_wire_kbps": profile.nominal()["wire_kbps"],
+        "latency_avg_ms": sum(latencies) / len(latencies) if latencies else None,
+        "latency_p95_ms": percentile(latencies, 0.95) if latencies else None,
+        "clicks": f"{len(latencies)}/{len([click for click in source.clicks if click >= settled])}",
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--profiles", nargs="+", default=list(codec_profiles.profiles), help="Profiles to measure")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Measured seconds per profile")
+    parser.add_argument("--click-interval", type=float, default=0.5)
+    args = parser.parse_args()
+    codec_profiles.install()
+    log = PacketLog()
+    log.install()
+    try:
+        print(f"{'profile':<12}{'ptime':>6}{'pkt/s':>8}{'ts step':>9}{'gap avg':>9}{'gap p95':>9}"
+              f"{'rtp kbps':>10}{'wire kbps':>11}{'nominal':>9}{'lat avg':>9}{'lat p95':>9}{'clicks':>8}")
+        for name in args.profiles:
+            r = await measure(name, args.seconds, args.click_interval, log)
+            latency = (f"{r['latency_avg_ms']:>9.1f}{r['latency_p95_ms']:>9.1f}" if r["latency_avg_ms"] is not None
+                       else f"{'-':>9}{'-':>9}")
+            print(f"{r['profile']:<12}{r['ptime']:>6}{r['packets_per_s']:>8.1f}{r['ts_step_ms']:>9.1f}{r['gap_avg_ms']:>9.1f}"
+                  f"{r['gap_p95_ms']:>9.1f}{r['rtp_kbps']:>10.1f}{r['wire_kbps']:>11.1f}{r['nominal_wire_kbps']:>9.1f}"
+                  f"{latency}{r['clicks']:>8}", flush=True)
+    finally:
+        log.uninstall()
+        codec_profiles.uninstall()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
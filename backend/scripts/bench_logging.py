@@ -0,0 +1,67 @@
+"""
+Emit-side cost of a log call, with the queued pipeline against formatting
+and writing synchronously on the calling thread.
+
+Logs SDP-sized INFO records (what signaling logs most) at about 2k
+records/s and reports the average and p99 time spent inside the logger
+call, which is what the event loop pays. Each mode runs in a fresh
+interpreter, since both configure the root logger.
+
+    cd backend && python scripts/bench_logging.py [--records 3000] 2>/dev/null
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+SDP = (
+    "{'type': 'answer', 'sdp': 'v=0\\r\\no=- 1 2 IN IP4 0.0.0.0\\r\\n"
+    + "a=candidate:1 1 udp 2130706431 10.0.0.1 5000 typ host\\r\\n" * 20
+    + "'}"
+)
+
+
+def run(mode: str, records: int, interval: float):
+    if mode == "pipeline":
+        from app.core.logs import log_pipeline
+        log_pipeline.configure()
+    else:
+        from app.core.logs import JsonFormatter
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter(2000))
+        logging.basicConfig(level=logging.INFO, handlers=[handler], force=True)
+    logger = logging.getLogger("app.core.handlers")
+    costs = []
+    for i in range(records):
+        started = time.perf_counter_ns()
+        logger.info(f"Sending message to c{i}: {SDP}")
+        costs.append(time.perf_counter_ns() - started)
+        time.sleep(interval)
+    costs.sort()
+    print(f"{mode:>8}: avg {sum(costs) / len(costs) / 1000:.1f} us, p99 {costs[int(len(costs) * 0.99)] / 1000:.1f} us")
+    if mode == "pipeline":
+        log_pipeline.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=3000)
+    parser.add_argument("--interval", type=float, default=0.0005, help="Seconds between records")
+    parser.add_argument("--mode", choices=("pipeline", "sync"), help="Run one mode in this process")
+    args = parser.parse_args()
+    if args.mode:
+        run(args.mode, args.records, args.interval)
+        return
+    for mode in ("pipeline", "sync"):
+        subprocess.run(
+            [sys.executable, __file__, "--mode", mode, "--records", str(args.records), "--interval", str(args.interval)],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
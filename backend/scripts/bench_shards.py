@@ -0,0 +1,81 @@
+"""
+Outbound streams per box as the number of media shards grows.
+
+Each shard's event loop runs the per-packet work of a sending PC as fast
+as it can: Opus-encode a 20 ms frame with aiortc's encoder, wrap it in RTP
+and SRTP-protect it. Frames per second over all shards, divided by 50,
+is roughly how many outbound streams the box keeps up with in real time.
+ICE, DTLS and socket I/O are left out, so these are upper bounds; how
+they grow from K=1 to K=N is the part worth comparing between machines.
+
+    cd backend && python scripts/bench_shards.py [--shards 1 2 4] [--seconds 3]
+"""
+import argparse
+import array
+import asyncio
+import fractions
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from av import AudioFrame
+from aiortc.codecs.opus import OpusEncoder
+from aiortc.rtp import RtpPacket
+from pylibsrtp import Policy, Session
+
+from app.core.shards import MediaShards
+
+SAMPLES = array.array("h", [int(8000 * math.sin(i / 10)) for i in range(960)]).tobytes()
+
+
+async def encode_loop(deadline: float) -> int:
+    """ Runs on one shard until `deadline`, yielding to its loop between frames like a sender does. """
+    encoder = OpusEncoder()
+    session = Session(policy=Policy(key=os.urandom(30), ssrc_type=Policy.SSRC_ANY_OUTBOUND))
+    frames = sequence = 0
+    while time.monotonic() < deadline:
+        frame = AudioFrame(format="s16", layout="mono", samples=960)
+        frame.planes[0].update(SAMPLES)
+        frame.sample_rate = 48000
+        frame.pts = frames * 960
+        frame.time_base = fractions.Fraction(1, 48000)
+        payloads, timestamp = encoder.encode(frame)
+        for payload in payloads:
+            packet = RtpPacket(payload_type=111, sequence_number=sequence & 0xFFFF, timestamp=timestamp, ssrc=1234, payload=payload)
+            session.protect(packet.serialize())
+            sequence += 1
+        frames += 1
+        await asyncio.sleep(0)
+    return frames
+
+
+async def measure(count: int, seconds: float) -> float:
+    shards = MediaShards(count=count)
+    shards.start()
+    try:
+        deadline = time.monotonic() + seconds
+        futures = [asyncio.run_coroutine_threadsafe(encode_loop(deadline), shard.loop) for shard in shards.shards]
+        frames = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+    finally:
+        await shards.stop()
+    return sum(frames) / seconds
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4], help="Shard counts to measure")
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+    print(f"{os.cpu_count()} CPUs")
+    baseline = None
+    for count in args.shards:
+        fps = await measure(count, args.seconds)
+        baseline = baseline or fps
+        print(f"K={count}: {fps:.0f} frames/s, ~{fps / 50:.0f} outbound streams in real time ({fps / baseline:.2f}x K={args.shards[0]})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,205 @@
+"""
+Join/leave soak for the resource registry.
+
+One listener stays connected while talkers join, send audio for a moment
+and leave, thousands of times over. Every talker goes through the real
+signaling path: apply_offer for its offer, renegotiation of the listener
+to carry it, and handle_disconnect when it leaves, with real aiortc
+PeerConnections standing in for the browsers on the other end. Every
+`--direct-every` cycles the talker also opens a private route to the
+listener and leaves with it open, which exercises direct route legs and
+relay subscriptions.
+
+At each checkpoint the registry's counters and the process RSS are
+printed. The run fails (exit status 1) if handlers, PCs, transceivers,
+owned tracks or relay subscriptions grow with the number of cycles, if
+torn-down PCs or tracks stay referenced, if per-client state elsewhere
+(replay levels, encoder sets) piles up, or if RSS grows more than
+`--max-growth-mb` between the end of the warm-up and the end of the run.
+
+    cd backend && python scripts/soak_resources.py [--cycles 3000] 2>/dev/null
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import resource
+import sys
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("SOUNDMESH_DB_PATH", ":memory:")
+
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import AudioStreamTrack
+
+import app.core.handlers as handlers
+import app.core.state as state
+from app.core.direct import direct_routes
+from app.core.opus import codec_profiles
+from app.core.replay import replay_buffer
+from app.core.resources import resources
+from app.models.channel import Channel
+from app.models.client import Client, ClientStatus
+from app.models.permissions import ClientPermissions
+from app.schemas.messages import AnswerMessage, DirectRouteStartMessage
+
+LISTENER_ID = "soak-listener"
+FLAT = ("clients", "pcs", "transceivers", "handlers", "owned_tracks", "relay_subscriptions")
+
+
+class _Socket:
+    """ Enough of a WebSocket for the server to consider the listener reachable. """
+
+    async def send_text(self, text: str):
+        pass
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        pass
+
+
+browsers: Dict[str, RTCPeerConnection] = {}
+
+
+async def signal(client_id: str, message: dict):
+    """ Delivers what the server sends a client to that client's browser-side PC, answering its offers. """
+    browser = browsers.get(client_id)
+    if browser is None:
+        return
+    if message["type"] == "answer":
+        await browser.setRemoteDescription(RTCSessionDescription(message["sdp"], "answer"))
+    elif message["type"] == "offer":
+        async def answer():
+            await browser.setRemoteDescription(RTCSessionDescription(message["sdp"], "offer"))
+            await browser.setLocalDescription(await browser.createAnswer())
+            reply = AnswerMessage(type="answer", sdp=browser.localDescription.sdp)
+            await handlers.handle_answer(handlers.ConnectionContext(client_id, None), reply)
+        asyncio.ensure_future(answer())
+
+
+async def offer(client_id: str, client: Client, browser: RTCPeerConnection):
+    browsers[client_id] = browser
+    await browser.setLocalDescription(await browser.createOffer())
+    await handlers.apply_offer(client_id, client, RTCSessionDescription(browser.localDescription.sdp, "offer"))
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError: # Not Linux: peak RSS is the best there is
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def checkpoint(cycle: int, started: float) -> Dict[str, object]:
+    stats = resources.stats(collect=True)
+    stats["rss_mb"] = round(rss_mb(), 1)
+    stats["replay_levels"] = len(replay_buffer.levels)
+    stats["encoder_sets"] = len(codec_profiles._encoders)
+    print(
+        f"{cycle:>6} cycles {time.monotonic() - started:>6.0f}s  rss {stats['rss_mb']:>6.1f} MB  "
+        + "  ".join(f"{key} {stats[key]}" for key in FLAT)
+        + f"  retired_alive {stats['retired_alive']}  levels {stats['replay_levels']}  encoders {stats['encoder_sets']}",
+        flush=True,
+    )
+    return stats
+
+
+def verdict(first: Dict[str, object], samples: List[Dict[str, object]], warmup: Dict[str, object], max_growth_mb: float) -> List[str]:
+    problems = []
+    last = samples[-1]
+    for key in FLAT:
+        if last[key] > first[key]:
+            problems.append(f"{key} grew from {first[key]} to {last[key]}")
+    for kind, alive in last["retired_alive"].items():
+        if alive > 2: # The latest talker's objects may still be on their way out
+            problems.append(f"{alive} torn-down {kind} objects still referenced")
+    if last["relay_subscriptions_retired"]:
+        problems.append(f"{last['relay_subscriptions_retired']} stopped direct legs still subscribed to the relay")
+    if last["replay_levels"] > 1 or last["encoder_sets"] > 1:
+        problems.append(f"per-client state left behind: {last['replay_levels']} levels, {last['encoder_sets']} encoder sets")
+    growth = last["rss_mb"] - warmup["rss_mb"]
+    if growth > max_growth_mb:
+        problems.append(f"RSS grew {growth:.1f} MB after warm-up (limit {max_growth_mb} MB)")
+    return problems
+
+
+async def soak(cycles: int, hold: float, direct_every: int, checkpoints: int, warmup_cycles: int, max_growth_mb: float) -> int:
+    handlers.notify_client = state.notify_client = signal
+    channel = Channel(name="soak")
+    state.active_channels[channel.id] = channel
+
+    listener = Client(LISTENER_ID, status=ClientStatus.AUTHORIZED)
+    listener.listening_channels = {channel.id}
+    listener.websocket = _Socket()
+    state.active_clients[LISTENER_ID] = listener
+    listener_browser = RTCPeerConnection()
+    listener_browser.addTransceiver("audio", direction="recvonly")
+    await offer(LISTENER_ID, listener, listener_browser)
+    # Offers on a reused PC replace its handlers instead of adding to them
+    for _ in range(3):
+        await offer(LISTENER_ID, listener, listener_browser)
+    stats = resources.stats()
+    print(f"listener after 4 offers on one PC: {stats['handlers']} handlers, {stats['replaced']} replaced")
+
+    started = time.monotonic()
+    first = checkpoint(0, started)
+    samples: List[Dict[str, object]] = []
+    warmup = first
+    every = max(1, cycles // checkpoints)
+    for cycle in range(1, cycles + 1):
+        talker_id = f"soak-talker-{cycle}"
+        talker = Client(talker_id, status=ClientStatus.AUTHORIZED)
+        talker.current_channel_id = channel.id
+        state.active_clients[talker_id] = talker
+        browser = RTCPeerConnection()
+        browser.addTrack(AudioStreamTrack())
+        await offer(talker_id, talker, browser)
+        await asyncio.sleep(hold)
+        if direct_every and cycle % direct_every == 0 and talker.audio_track is not None:
+            await handlers.apply_permissions({talker_id: ClientPermissions(direct_targets=[LISTENER_ID])})
+            await handlers.handle_direct_route_start(
+                handlers.ConnectionContext(talker_id, None),
+                DirectRouteStartMessage(type="direct_route_start", target_ids=[LISTENER_ID]),
+            )
+            await asyncio.sleep(hold)
+        await state.handle_disconnect(talker_id)
+        await browser.close()
+        browsers.pop(talker_id, None)
+        if cycle % every == 0 or cycle == cycles:
+            await asyncio.sleep(0.5) # Let closes and renegotiations settle
+            samples.append(checkpoint(cycle, started))
+            if cycle <= warmup_cycles:
+                warmup = samples[-1]
+
+    await state.handle_disconnect(LISTENER_ID)
+    await listener_browser.close()
+    problems = verdict(first, samples, warmup, max_growth_mb)
+    print(f"RSS {warmup['rss_mb']} MB after warm-up, {samples[-1]['rss_mb']} MB after {cycles} cycles")
+    print(f"Direct routes opened: {direct_routes.stats()['started']}")
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    if not problems:
+        print("OK: resources flat")
+    return 1 if problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=3000)
+    parser.add_argument("--hold", type=float, default=0.2, help="Seconds each talker stays connected")
+    parser.add_argument("--direct-every", type=int, default=10, help="Open a private route every N cycles; 0 never")
+    parser.add_argument("--checkpoints", type=int, default=15)
+    parser.add_argument("--warmup", type=int, default=300, help="Cycles before RSS is expected to level off")
+    parser.add_argument("--max-growth-mb", type=float, default=8.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    gc.collect()
+    sys.exit(asyncio.run(soak(args.cycles, args.hold, args.direct_every, args.checkpoints, args.warmup, args.max_growth_mb)))
+
+
+if __name__ == "__main__":
+    main()
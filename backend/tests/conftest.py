@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The app reads its settings at import; keep tests off the working directory's database
+os.environ.setdefault("SOUNDMESH_DB_PATH", ":memory:")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
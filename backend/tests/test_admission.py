@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from app.core.admission import AdmissionController, AdmissionRejected, PacedScheduler
+
+
+async def _closed_socket(position: int, total: int):
+    raise RuntimeError("Cannot call send once a close message has been sent")
+
+
+def test_failing_position_callback_does_not_leak_an_admission_slot():
+    async def scenario():
+        admission = AdmissionController(max_active=1, max_queued=5, queue_timeout=0.2, position_interval=0.01)
+        await admission.acquire()
+        waiting = asyncio.ensure_future(admission.acquire(on_position=_closed_socket))
+        await asyncio.sleep(0.01)
+        assert admission.queued == 1 # Still queued despite the failed position update
+        admission.release()
+        await waiting # Got the slot
+        admission.release()
+        assert admission.stats()["active"] == 0 and admission.queued == 0
+        await admission.acquire() # Capacity is intact
+        admission.release()
+
+        # A waiter whose callback fails and that then times out leaves nothing behind
+        await admission.acquire()
+        with pytest.raises(AdmissionRejected):
+            await admission.acquire(on_position=_closed_socket)
+        assert admission.queued == 0
+        admission.release()
+        assert admission.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_failing_position_callback_does_not_leak_a_scheduler_slot():
+    async def scenario():
+        scheduler = PacedScheduler(concurrency=1, position_interval=0.01)
+        order = []
+
+        async def work(name, on_position=None):
+            async with scheduler.slot(on_position=on_position):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(work("first"), work("second", _closed_socket), work("third"))
+        assert order == ["first", "second", "third"]
+        assert scheduler.running == 0 and scheduler.queued == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,37 @@
+import asyncio
+
+import app.core.handlers as handlers
+from app.core.store import Store
+from app.models.channel import Channel, ChannelGroup
+
+
+def test_removing_last_channel_of_a_group_deletes_it_and_store_reopens(tmp_path, monkeypatch):
+    path = str(tmp_path / "groups.db")
+
+    async def scenario():
+        store = Store(path, flush_interval=0.01)
+        monkeypatch.setattr(handlers, "store", store)
+        await store.open()
+        store.channels.clear()
+        solo, kept = Channel(name="solo"), Channel(name="kept")
+        store.save_channel(solo)
+        store.save_channel(kept)
+        store.save_group(ChannelGroup(id="only-solo", name="Only solo", channel_ids=[solo.id]))
+        store.save_group(ChannelGroup(id="both", name="Both", channel_ids=[solo.id, kept.id]))
+
+        store.delete_channel(solo.id)
+        await handlers.forget_channel(solo.id)
+        await store.close()
+        assert "only-solo" not in store.groups
+        assert store.groups["both"].channel_ids == [kept.id]
+
+        reopened = Store(path, flush_interval=0.01)
+        await reopened.open() # Used to fail validating a group with no channels
+        try:
+            assert set(reopened.groups) == {"both"}
+            assert reopened.groups["both"].channel_ids == [kept.id]
+        finally:
+            await reopened.close()
+            reopened.channels.clear()
+
+    asyncio.run(scenario())
@@ -0,0 +1,43 @@
+import asyncio
+
+from aiortc import RTCPeerConnection
+from aiortc.mediastreams import AudioStreamTrack
+
+from app.core.congestion import BandwidthController, ListenerLink
+from app.core.handlers import _remove_track
+from app.models.client import Client, ClientStatus
+
+
+def test_sender_reused_after_a_dropped_talker_leaves_is_audible():
+    async def scenario():
+        listener = Client("listener", status=ClientStatus.AUTHORIZED)
+        listener.pc = RTCPeerConnection()
+        other = Client("other", status=ClientStatus.AUTHORIZED)
+        other.audio_track = AudioStreamTrack()
+        kept = listener.pc.addTrack(other.audio_track)
+        first = Client("first", status=ClientStatus.AUTHORIZED)
+        first.audio_track = AudioStreamTrack()
+        sender = listener.pc.addTrack(first.audio_track)
+        talkers = {id(other.audio_track): other, id(first.audio_track): first}
+
+        # The link only fits one stream at the floor bitrate: the latest talker is muted for this listener
+        controller = BandwidthController(interval=1.0, min_stream_bitrate=10_000_000)
+        link = ListenerLink(listener.id)
+        controller._update(link, listener, [kept, sender], talkers)
+        assert link.dropped == ["first"] and not sender._enabled
+
+        # The talker leaves; its sender is released and reused by the next talker
+        assert _remove_track(listener.pc, first.audio_track)
+        second = Client("second", status=ClientStatus.AUTHORIZED)
+        second.audio_track = AudioStreamTrack()
+        reused = listener.pc.addTrack(second.audio_track)
+        assert reused is sender
+        assert reused._enabled
+
+        controller.min_stream_bitrate = 8000
+        talkers = {id(other.audio_track): other, id(second.audio_track): second}
+        controller._update(link, listener, [kept, reused], talkers)
+        assert link.dropped == [] and reused._enabled
+        await listener.pc.close()
+
+    asyncio.run(scenario())
@@ -2,13 +2,14 @@ import React from 'react';
 import { ChannelWithUiState } from '@/types'; // Import from shared types file
 import { ScrollArea } from "@/components/ui/scroll-area";
 import { Button } from "@/components/ui/button";
-import { Headphones, Mic } from 'lucide-react'; // Icons
+import { Headphones, Mic, RotateCcw } from 'lucide-react'; // Icons
 
 interface ChannelListProps {
   channels: ChannelWithUiState[];
   activeChannelId: string | null;
   onJoinChannel: (channelId: string) => void;
   onToggleListen: (channelId: string) => void; // Add this prop type
+  onReplay?: (channelId: string) => void; // Instant replay of the channel's last seconds
   // Add other interaction handlers as needed (leave, toggle listen/talk)
 }
 
@@ -17,6 +18,7 @@ export const ChannelList: React.FC<ChannelListProps> = ({
   activeChannelId,
   onJoinChannel,
   onToggleListen, // Receive the prop
+  onReplay,
 }) => {
   if (!channels || channels.length === 0) {
     return <div className="p-4 text-center text-muted-foreground">No channels available.</div>;
@@ -49,6 +51,17 @@ export const ChannelList: React.FC<ChannelListProps> = ({
                 >
                   <Headphones className={`h-4 w-4 ${channel.isListening ? 'text-primary' : 'text-muted-foreground'}`} />
                 </Button>
+                {onReplay && channel.replay_seconds !== 0 && (
+                  <Button
+                    variant="ghost"
+                    size="icon"
+                    className="h-7 w-7"
+                    title="Replay what was just said"
+                    onClick={() => onReplay(channel.id)}
+                  >
+                    <RotateCcw className="h-4 w-4 text-muted-foreground" />
+                  </Button>
+                )}
                 <Button variant="ghost" size="icon" className="h-7 w-7" title="Talk (Toggle)">
                   <Mic className={`h-4 w-4 ${channel.isTalking ? 'text-primary' : 'text-muted-foreground'}`} />
                 </Button>
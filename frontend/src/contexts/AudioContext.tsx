@@ -29,6 +29,11 @@ interface AudioContextType {
   authenticate: (name: string, password?: string) => Promise<boolean>;
   disconnect: () => void;
   joinChannel: (channelId: string) => void;
+  requestReplay: (channelId: string, seconds?: number) => void;
+  startDirectRoute: (targetIds: string[], duckGain?: number) => void;
+  stopDirectRoute: (routeId?: string) => void;
+  startAllCall: (groupId?: string, channelIds?: string[]) => void;
+  stopAllCall: () => void;
   toggleChannelListen: (channelId: string) => void;
   toggleChannelTalk: (channelId: string) => void;
   setChannelVolume: (channelId: string, volume: number) => void;
@@ -56,6 +61,11 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
     clients: [],
     isRtcReady: false, // Initialize new state
   });
+  // Latest committed state, for socket handlers that need to read it without waiting for a render
+  const clientStateRef = useRef<ClientState>(clientState);
+  useEffect(() => {
+    clientStateRef.current = clientState;
+  }, [clientState]);
 
   // Ref to store the WebSocket instance
   const webSocketRef = useRef<WebSocket | null>(null);
@@ -69,6 +79,9 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
     JSON.parse(localStorage.getItem('soundmesh_credentials') || '{"name":"","password":""}')
   );
   
+  // Token issued by the server to resume our session (keeping the audio connection) after a drop
+  const resumeTokenRef = useRef<string | null>(localStorage.getItem('soundmesh_resumeToken'));
+
   // Track authentication in progress to prevent multiple simultaneous attempts
   const isAuthenticatingRef = useRef<boolean>(false);
 
@@ -76,9 +89,17 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
   const peerConnectionRef = useRef<RTCPeerConnection | null>(null);
   const localStreamRef = useRef<MediaStream | null>(null);
   const remoteAudioStreamsRef = useRef<Map<string, MediaStream>>(new Map()); // Map track.id to stream for remote audio
+  const remoteAudioElementsRef = useRef<Map<string, HTMLAudioElement>>(new Map()); // Map stream.id to the element playing it
+  // Set while moving to another server during a drain, so the channels we were in can be restored there
+  const migrationRef = useRef<{ channelId: string | null, listening: string[] } | null>(null);
+  // Set by the server while private (IFB) routes reach us: everything except their streams plays at `gain`
+  const duckingRef = useRef<{ gain: number, exceptStreams: Set<string> }>({ gain: 1, exceptStreams: new Set() });
 
   // Reference to store pending ICE candidates when WebSocket is not available
-  const pendingIceCandidatesRef = useRef<any[]>([]);
+  const pendingIceCandidatesRef = useRef<RTCIceCandidateInit[]>([]);
+  // Locally gathered candidates waiting to be sent together in one 'candidates' message
+  const iceCandidateBatchRef = useRef<RTCIceCandidateInit[]>([]);
+  const iceCandidateBatchTimerRef = useRef<number | null>(null);
 
   // Helper to send signaling messages
   const sendSignalingMessage = useCallback((message: object) => {
@@ -106,20 +127,17 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
       }
       
       // For ICE candidates, we can queue them to send later when connection is restored
-      if ((message as any).type === 'candidate' && (message as any).candidate) {
-        // Store ICE candidates to be sent when connection is restored
-        // Check if this candidate is already in the queue to avoid duplicates
-        const candidateJson = JSON.stringify((message as any).candidate);
-        const isDuplicate = pendingIceCandidatesRef.current.some(item => 
-          JSON.stringify((item as any).candidate) === candidateJson
-        );
-        
-        if (!isDuplicate) {
-          pendingIceCandidatesRef.current.push(message);
-          console.log('Stored ICE candidate for later transmission');
-        } else {
-          console.log('Skipped duplicate ICE candidate');
-        }
+      const type = (message as any).type;
+      if ((type === 'candidate' && (message as any).candidate) || type === 'candidates') {
+        const candidates: RTCIceCandidateInit[] = type === 'candidates' ? (message as any).candidates : [(message as any).candidate];
+        // Store ICE candidates to be sent when connection is restored, skipping duplicates
+        candidates.forEach(candidate => {
+          const candidateJson = JSON.stringify(candidate);
+          if (!pendingIceCandidatesRef.current.some(item => JSON.stringify(item) === candidateJson)) {
+            pendingIceCandidatesRef.current.push(candidate);
+          }
+        });
+        console.log(`Stored ICE candidates for later transmission (${pendingIceCandidatesRef.current.length} pending)`);
       } else if ((message as any).type !== 'authenticate') {
         // Don't show warnings for authentication messages as they'll be retried automatically
         toast.warning('Connection issue, cannot send signal.');
@@ -135,46 +153,48 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
         webSocketRef.current.readyState === WebSocket.OPEN &&
         clientState.isAuthenticated) {
       console.log(`Sending ${pendingIceCandidatesRef.current.length} pending ICE candidates`);
-      
-      // Create a copy of the candidates to send
-      const candidatesToSend = [...pendingIceCandidatesRef.current];
-      
-      // Add a small delay between sending each candidate to avoid overwhelming the server
-      candidatesToSend.forEach((candidate, index) => {
-        setTimeout(() => {
-          if (webSocketRef.current?.readyState === WebSocket.OPEN) {
-            try {
-              webSocketRef.current.send(JSON.stringify(candidate));
-              console.log(`Sent pending ICE candidate ${index + 1}/${candidatesToSend.length}`);
-              
-              // Remove the candidate from the pending list after successful send
-              // We use filter instead of splice to avoid modifying the array while iterating
-              if (index === candidatesToSend.length - 1) {
-                // Only clear candidates after the last one is sent
-                pendingIceCandidatesRef.current = [];
-                console.log('Cleared pending ICE candidates queue after sending all candidates');
-              }
-            } catch (e) {
-              console.error(`Failed to send ICE candidate ${index + 1}:`, e);
-            }
-          } else {
-            console.warn(`WebSocket not open when trying to send ICE candidate ${index + 1}`);
-          }
-        }, index * 100); // 100ms delay between each candidate for more reliability
-      });
-      
-      // Clear the queue after sending all candidates (after the last timeout)
-      const totalDelay = pendingIceCandidatesRef.current.length * 50;
-      setTimeout(() => {
+      try {
+        // Whole backlog in as few messages as possible; the server buffers them until our offer is applied
+        const pending = pendingIceCandidatesRef.current;
+        for (let i = 0; i < pending.length; i += 32) {
+          webSocketRef.current.send(JSON.stringify({ type: 'candidates', candidates: pending.slice(i, i + 32) }));
+        }
         pendingIceCandidatesRef.current = [];
-        console.log('Cleared pending ICE candidates queue');
-      }, totalDelay + 100);
+      } catch (e) {
+        console.error('Failed to send pending ICE candidates:', e);
+      }
     } else if (!clientState.isAuthenticated) {
       console.log('Not sending pending ICE candidates: not authenticated yet');
     }
   }, [clientState.isAuthenticated]);
 
+  // Sends the candidates gathered during the current burst as one 'candidates' message
+  const flushIceCandidateBatch = useCallback(() => {
+    if (iceCandidateBatchTimerRef.current !== null) {
+      window.clearTimeout(iceCandidateBatchTimerRef.current);
+      iceCandidateBatchTimerRef.current = null;
+    }
+    const candidates = iceCandidateBatchRef.current;
+    iceCandidateBatchRef.current = [];
+    if (candidates.length > 0) {
+      sendSignalingMessage({ type: 'candidates', candidates });
+    }
+  }, [sendSignalingMessage]);
+
   // --- API Interaction ---
+  // Add default/initial UI state to a channel from the server
+  const withUiState = (channel: Channel, index: number): ChannelWithUiState => ({
+    ...channel,
+    color: ['#3b82f6', '#ef4444', '#22c55e', '#eab308', '#a855f7'][index % 5], // Cycle through some colors
+    canListen: true, // TODO: Determine based on permissions
+    canTalk: true, // TODO: Determine based on permissions
+    isListening: false,
+    isTalking: false,
+    audioLevel: 0,
+    volume: 100,
+    isMuted: false,
+  });
+
   // Fetch channels function (memoized with useCallback)
   const fetchChannels = useCallback(async () => {
     if (!clientState.isConnected) {
@@ -196,18 +216,7 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
       const rawChannels: Channel[] = JSON.parse(responseText);
 
       // Map raw channels to ChannelWithUiState, adding default UI state
-      const channelsWithUiState: ChannelWithUiState[] = rawChannels.map((channel, index) => ({
-        ...channel,
-        // Add default/initial UI state properties here
-        color: ['#3b82f6', '#ef4444', '#22c55e', '#eab308', '#a855f7'][index % 5], // Cycle through some colors
-        canListen: true, // TODO: Determine based on permissions
-        canTalk: true, // TODO: Determine based on permissions
-        isListening: false,
-        isTalking: false,
-        audioLevel: 0,
-        volume: 100,
-        isMuted: false,
-      }));
+      const channelsWithUiState: ChannelWithUiState[] = rawChannels.map(withUiState);
 
       setClientState(prev => ({ ...prev, channels: channelsWithUiState }));
       toast.success(`Fetched ${rawChannels.length} channels.`);
@@ -301,6 +310,17 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
     }
   };
   
+  // Replace (or add) several clients in the roster in one state update
+  const mergeClientUpdates = (updatedClients: ClientPublic[]) => {
+    setClientState(prev => {
+      const updatedIds = new Set(updatedClients.map(c => c.id));
+      const otherClients = prev.clients.filter(c => !updatedIds.has(c.id));
+      // Don't add ourselves to the list of *other* clients
+      const newClients = [...otherClients, ...updatedClients.filter(c => c.id !== prev.clientId)];
+      return { ...prev, clients: newClients };
+    });
+  };
+
   // --- WebSocket Message Handling ---
   const handleWebSocketMessage = async (event: MessageEvent) => {
     try {
@@ -346,6 +366,18 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
               clientIdRef.current = clientId;
             }
 
+            // Keep the latest resume token so a reconnect can reattach to this session
+            if (message.resume_token) {
+              resumeTokenRef.current = message.resume_token;
+              localStorage.setItem('soundmesh_resumeToken', message.resume_token);
+            } else if (status === ClientStatus.REJECTED) {
+              resumeTokenRef.current = null;
+              localStorage.removeItem('soundmesh_resumeToken');
+            }
+            if (message.resumed) {
+              console.log('Session resumed, keeping existing audio connection');
+            }
+
             setClientState(prev => ({
               ...prev,
               isAuthenticated: status === ClientStatus.AUTHORIZED,
@@ -357,6 +389,10 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
             if (status === ClientStatus.AUTHORIZED) {
               isAuthenticatingRef.current = false;
               toast.success("Authentication successful!");
+              if (migrationRef.current) {
+                toast.dismiss('migrate');
+                setTimeout(() => startAudioCommunication(), 500); // Channels are restored once audio is up
+              }
               // No longer call fetchChannels directly here, useEffect will handle it
               
               // Now that we're authenticated, send any pending ICE candidates
@@ -471,6 +507,17 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
           }
           break;
 
+        case 'candidates':
+          // A batch of ICE candidates from the server
+          if (peerConnectionRef.current && Array.isArray(message.candidates)) {
+            const pc = peerConnectionRef.current;
+            message.candidates.forEach((candidate: RTCIceCandidateInit) => {
+              pc.addIceCandidate(candidate)
+                .catch(e => console.error('Error adding received ICE candidate:', e));
+            });
+          }
+          break;
+
         case 'candidate':
           if (peerConnectionRef.current && message.candidate) {
             console.log('Received ICE candidate:', message.candidate);
@@ -525,7 +572,142 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
           }
           break;
 
-        // TODO: Handle permissions_update etc.
+        case 'ping':
+          // Server heartbeat: echo it back straight away so the server can measure RTT
+          if (webSocketRef.current?.readyState === WebSocket.OPEN) {
+            webSocketRef.current.send(JSON.stringify({ type: 'pong', seq: message.seq, ts: message.ts }));
+          }
+          break;
+
+        case 'queue_position':
+          // Server is busy (e.g. everyone reconnecting at once) and has queued us
+          console.log(`Queued for ${message.stage}: position ${message.position}/${message.queue_length}`);
+          toast.info('Server busy, you are in the queue', {
+            id: 'queue-position', // Replace the previous toast instead of stacking
+            description: `Position ${message.position} of ${message.queue_length}`,
+            duration: 3000
+          });
+          break;
+
+        case 'permissions_update':
+          // An admin changed our permission matrix; the server may have moved us out of channels we lost
+          console.log('Received permissions_update:', message.permissions);
+          setClientState(prev => {
+            if (prev.activeChannel && message.current_channel_id !== prev.activeChannel) {
+              toast.warning('You can no longer talk in your current channel.');
+            }
+            return { ...prev, activeChannel: message.current_channel_id ?? null };
+          });
+          if (Array.isArray(message.clients)) {
+            // Other clients changed by the same bulk update
+            mergeClientUpdates(message.clients);
+          }
+          toast.info('Your channel permissions were updated.', { id: 'permissions-update' });
+          break;
+
+        case 'clients_update':
+          // Several clients changed at once (e.g. a bulk permission update)
+          mergeClientUpdates(message.payload.clients);
+          break;
+
+        case 'channel_added':
+          // Channel list changes arrive as deltas; UI state of other channels is untouched
+          setClientState(prev => {
+            const existing = prev.channels.filter(ch => ch.id !== message.channel.id);
+            return { ...prev, channels: [...existing, withUiState(message.channel, existing.length)] };
+          });
+          break;
+
+        case 'channel_updated':
+          setClientState(prev => ({
+            ...prev,
+            channels: prev.channels.map(ch => ch.id === message.channel.id ? { ...ch, ...message.channel } : ch)
+          }));
+          break;
+
+        case 'channel_removed':
+          setClientState(prev => ({
+            ...prev,
+            channels: prev.channels.filter(ch => ch.id !== message.channel_id),
+            activeChannel: prev.activeChannel === message.channel_id ? null : prev.activeChannel
+          }));
+          break;
+
+        case 'replay_started': {
+          // Played on extra tracks that arrive with the renegotiation offer that follows
+          const replayChannelName = clientStateRef.current.channels.find(ch => ch.id === message.channel_id)?.name ?? 'the channel';
+          toast.info(`Replaying the last ${Math.round(message.seconds)}s of ${replayChannelName}`, {
+            id: 'replay',
+            duration: Math.max(3000, message.seconds * 1000)
+          });
+          break;
+        }
+
+        case 'replay_ended':
+          toast.dismiss('replay');
+          break;
+
+        case 'migrate': {
+          // The server is draining: reconnect (to message.url if given) after the delay it picked for us
+          const current = clientStateRef.current;
+          migrationRef.current = {
+            channelId: current.activeChannel,
+            listening: current.channels.filter(ch => ch.isListening).map(ch => ch.id)
+          };
+          if (message.url) {
+            serverUrlRef.current = message.url;
+            localStorage.setItem('soundmesh_serverUrl', message.url);
+          }
+          // Sessions can't be resumed on another server
+          resumeTokenRef.current = null;
+          localStorage.removeItem('soundmesh_resumeToken');
+          toast.info('Server is restarting, moving you over...', { id: 'migrate' });
+          setTimeout(() => {
+            stopAudioCommunication();
+            webSocketRef.current?.close(1000, 'Migrating');
+          }, message.delay_ms ?? 0);
+          break;
+        }
+
+        case 'ducking':
+          duckingRef.current = { gain: message.gain, exceptStreams: new Set(message.except_streams) };
+          remoteAudioElementsRef.current.forEach((audio, streamId) => applyDucking(audio, streamId));
+          if (message.routes.length > 0) {
+            toast.info('Private audio incoming', { id: 'ducking' });
+          } else {
+            toast.dismiss('ducking');
+          }
+          break;
+
+        case 'all_call_started':
+          toast.success(`All-call live on ${message.channel_ids.length} channel(s), ${message.listeners} listener(s)`, {
+            id: 'all-call',
+            duration: Infinity
+          });
+          if (message.denied.length > 0) {
+            toast.warning(`Not permitted to talk in: ${message.denied.join(', ')}`);
+          }
+          break;
+
+        case 'all_call_ended':
+          toast.dismiss('all-call');
+          break;
+
+        case 'direct_route_started':
+          toast.success(`Private route open to ${message.target_ids.length} client(s)`, { id: `direct-${message.route_id}` });
+          if (message.denied.length > 0) {
+            toast.warning(`Not allowed to reach: ${message.denied.join(', ')}`);
+          }
+          break;
+
+        case 'direct_route_ended':
+          toast.dismiss(`direct-${message.route_id}`);
+          if (message.reason !== 'stopped') {
+            toast.info('Private route closed');
+          }
+          break;
+
+        // TODO: Handle remaining server messages
 
         default:
           console.warn('Received unknown WS message type:', messageType);
@@ -695,7 +877,12 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
     localStorage.setItem('soundmesh_credentials', JSON.stringify(credentials));
 
     console.log('Sending authentication request...');
-    const authMessage = JSON.stringify({ type: 'authenticate', name, password: password ?? '' });
+    const authMessage = JSON.stringify({
+      type: 'authenticate',
+      name,
+      password: password ?? '',
+      resume_token: resumeTokenRef.current ?? undefined, // Lets the server resume our previous session
+    });
     webSocketRef.current.send(authMessage);
 
     // Note: Authentication result is handled asynchronously by the onmessage handler
@@ -887,6 +1074,79 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
     // Confirmation is handled by the 'channel_joined' message
   };
 
+  // Asks the server to play back the last seconds of a channel (the whole kept window if unset)
+  const requestReplay = (channelId: string, seconds?: number) => {
+    if (!webSocketRef.current || webSocketRef.current.readyState !== WebSocket.OPEN) {
+      toast.error('Not connected');
+      return;
+    }
+    if (!clientState.isRtcReady) {
+      toast.error('Audio is not connected yet');
+      return;
+    }
+    webSocketRef.current.send(JSON.stringify({ type: 'replay', channel_id: channelId, seconds }));
+    // Playback starts with 'replay_started'; refusals arrive as 'error'
+  };
+
+  // After a migration, rejoins the channel we talked in and listens to what we listened to before
+  const restoreAfterMigration = () => {
+    const migration = migrationRef.current;
+    if (!migration || webSocketRef.current?.readyState !== WebSocket.OPEN) {
+      return;
+    }
+    migrationRef.current = null;
+    if (migration.listening.length > 0) {
+      webSocketRef.current.send(JSON.stringify({ type: 'update_listen_channels', channel_ids: migration.listening }));
+      setClientState(prev => ({
+        ...prev,
+        channels: prev.channels.map(ch => migration.listening.includes(ch.id) ? { ...ch, isListening: true } : ch)
+      }));
+    }
+    if (migration.channelId) {
+      webSocketRef.current.send(JSON.stringify({ type: 'join_channel', channel_id: migration.channelId }));
+    }
+  };
+
+  // Opens a private route: our audio goes straight to these clients and their other audio is ducked
+  const startDirectRoute = (targetIds: string[], duckGain?: number) => {
+    if (!webSocketRef.current || webSocketRef.current.readyState !== WebSocket.OPEN) {
+      toast.error('Not connected');
+      return;
+    }
+    webSocketRef.current.send(JSON.stringify({ type: 'direct_route_start', target_ids: targetIds, duck_gain: duckGain }));
+    // Confirmed by 'direct_route_started'; refusals arrive as 'error'
+  };
+
+  // Closes one private route, or all of ours if no ID is given
+  const stopDirectRoute = (routeId?: string) => {
+    if (!webSocketRef.current || webSocketRef.current.readyState !== WebSocket.OPEN) {
+      return;
+    }
+    webSocketRef.current.send(JSON.stringify({ type: 'direct_route_stop', route_id: routeId }));
+  };
+
+  // Talks to a channel group and/or a list of channels at once until stopAllCall
+  const startAllCall = (groupId?: string, channelIds?: string[]) => {
+    if (!webSocketRef.current || webSocketRef.current.readyState !== WebSocket.OPEN) {
+      toast.error('Not connected');
+      return;
+    }
+    webSocketRef.current.send(JSON.stringify({ type: 'all_call_start', group_id: groupId, channel_ids: channelIds }));
+    // Confirmed by 'all_call_started'; refusals arrive as 'error'
+  };
+
+  const stopAllCall = () => {
+    if (!webSocketRef.current || webSocketRef.current.readyState !== WebSocket.OPEN) {
+      return;
+    }
+    webSocketRef.current.send(JSON.stringify({ type: 'all_call_stop' }));
+  };
+
+  const applyDucking = (audio: HTMLAudioElement, streamId: string) => {
+    const { gain, exceptStreams } = duckingRef.current;
+    audio.volume = exceptStreams.has(streamId) ? 1 : gain;
+  };
+
   // --- WebRTC Core Logic ---
   const startAudioCommunication = async () => {
     if (peerConnectionRef.current) {
@@ -985,11 +1245,14 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
       // 3. Setup Event Handlers
       peerConnectionRef.current.onicecandidate = (event) => {
         if (event.candidate) {
-          console.log('Generated ICE candidate:', event.candidate);
-          // Send candidate to server
-          sendSignalingMessage({ type: 'candidate', candidate: event.candidate.toJSON() });
+          // Candidates come in bursts; collect them briefly and send them to the server together
+          iceCandidateBatchRef.current.push(event.candidate.toJSON());
+          if (iceCandidateBatchTimerRef.current === null) {
+            iceCandidateBatchTimerRef.current = window.setTimeout(flushIceCandidateBatch, 25);
+          }
         } else {
           console.log('ICE candidate gathering complete');
+          flushIceCandidateBatch();
         }
       };
       
@@ -1009,12 +1272,15 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
             audio.autoplay = true;
             // audio.controls = true; // Optional: for debugging
             document.body.appendChild(audio); // Append somewhere, maybe hidden
+            remoteAudioElementsRef.current.set(stream.id, audio);
+            applyDucking(audio, stream.id);
             console.log(`Playing remote audio track ${event.track.id}`);
 
             stream.onremovetrack = () => {
               console.log(`Remote audio track ${event.track.id} removed`);
               audio.remove();
               remoteAudioStreamsRef.current.delete(event.track.id);
+              remoteAudioElementsRef.current.delete(stream.id);
             };
           } else {
             console.warn("Received audio track without a stream?");
@@ -1050,6 +1316,7 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
             console.log('RTC connection is now ready');
             toast.success('Audio connection established', { duration: 3000 });
             setClientState(prev => ({ ...prev, isRtcReady: true }));
+            restoreAfterMigration();
           }
         }
       };
@@ -1116,6 +1383,8 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
       console.log(`Stopped remote stream for track ${trackId}`);
     });
     remoteAudioStreamsRef.current.clear();
+    remoteAudioElementsRef.current.clear();
+    duckingRef.current = { gain: 1, exceptStreams: new Set() };
     // Find and remove any lingering audio elements we created (simple approach)
     document.querySelectorAll('audio[autoplay]').forEach(el => {
       // Cast to HTMLAudioElement first to safely access srcObject
@@ -1165,6 +1434,11 @@ export const AudioProvider: React.FC<{ children: ReactNode }> = ({ children }) =
     authenticate,
     disconnect,
     joinChannel,
+    requestReplay,
+    startDirectRoute,
+    stopDirectRoute,
+    startAllCall,
+    stopAllCall,
     toggleChannelListen,
     toggleChannelTalk,
     setChannelVolume,
@@ -20,6 +20,7 @@ const ClientApp: React.FC = () => {
     toggleMasterMute,
     activatePTT,
     joinChannel,
+    requestReplay,
     connectToServer,
     authenticate
   } = useAudio();
@@ -74,6 +75,7 @@ const ClientApp: React.FC = () => {
           activeChannelId={clientState.activeChannel} 
           onJoinChannel={joinChannel} 
           onToggleListen={toggleChannelListen}
+          onReplay={requestReplay}
         />
       </div>
 
@@ -15,9 +15,18 @@ export interface Channel {
   id: string;
   name: string;
   description?: string | null;
+  replay_seconds?: number | null; // Instant replay window; 0 when replay is disabled
   // Add other relevant fields like members, permissions etc.
 }
 
+// Named set of channels a talker can all-call at once
+export interface ChannelGroup {
+  id: string;
+  name: string;
+  description?: string | null;
+  channel_ids: string[];
+}
+
 // Extend Channel type with UI-specific state for the client application
 export interface ChannelWithUiState extends Channel {
   color: string; // Example UI state (can be dynamically assigned or configured)